@@ -0,0 +1,241 @@
+"""
+Serves traffic recorded by `bna.recorder` in place of the nodes and exchanges.
+
+    RECORD_PATH=traffic.jsonl python main.py           # in production, records everything
+    python -m bench.playback traffic.jsonl --port 9100 --speed 10
+
+Every recorded host is served under its own path, so `https://api.idena.io/api/` becomes
+`http://127.0.0.1:9100/api.idena.io/api/` and `wss://bsc-ws.example/ws` becomes
+`ws://127.0.0.1:9100/bsc-ws.example/ws`. Point the URL env vars of the listeners there and they
+run unchanged. HTTP requests get the recorded responses for the same request in the recorded
+order, falling back to a request to the same path if the query or body differ (like trade polls
+with a start time), and the last response is repeated after they run out. Websocket frames are
+sent with the recorded timing divided by `--speed`, or as fast as the client reads them with
+`--speed 0`, and never before the client sent the messages that preceded them.
+"""
+import json
+import asyncio
+import logging
+import argparse
+from collections import defaultdict
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from aiohttp import web, WSMsgType
+
+from bna import init_logging
+from bna.recorder import decode_body, normalize_body, request_key
+
+
+@dataclass
+class Responses:
+    "Recorded responses to one kind of request, served in order"
+    records: list[dict] = field(default_factory=list)
+    served: int = 0
+
+
+@dataclass
+class WsConnection:
+    url: str
+    opened: float
+    frames: list[dict] = field(default_factory=list)
+
+
+def playback_url(base: str, url: str) -> str:
+    "Where `url` is served by a playback server at `base`"
+    parts = urlsplit(url)
+    scheme = {'https': 'http', 'wss': 'ws'}.get(parts.scheme, parts.scheme)
+    base = urlsplit(base)
+    return f"{scheme}://{base.netloc}/{parts.netloc}{parts.path or '/'}" + (f"?{parts.query}" if parts.query else '')
+
+
+def jsonrpc_ids(body: str | None):
+    try:
+        j = json.loads(body) if body else None
+    except ValueError:
+        return None
+    if isinstance(j, list):
+        return [c.get('id') if isinstance(c, dict) else None for c in j]
+    return j.get('id') if isinstance(j, dict) else None
+
+
+def with_ids(body: bytes | str, ids) -> bytes | str:
+    "Gives the recorded JSON-RPC response the ids of the request it's answering"
+    if ids is None:
+        return body
+    try:
+        j = json.loads(body)
+    except ValueError:
+        return body
+    if isinstance(j, dict) and 'id' in j and not isinstance(ids, list):
+        j['id'] = ids
+    elif isinstance(j, list) and isinstance(ids, list) and len(j) == len(ids):
+        for c, id in zip(j, ids):
+            if isinstance(c, dict) and 'id' in c:
+                c['id'] = id
+    else:
+        return body
+    return json.dumps(j)
+
+
+class Playback:
+    def __init__(self, log: logging.Logger, path: str, speed: float = 1, host: str = '127.0.0.1', port: int = 0):
+        self.log = log.getChild("PB")
+        self.speed = speed
+        self.host = host
+        self.port = port
+        self.exact: dict[tuple, Responses] = defaultdict(Responses)
+        self.loose: dict[tuple, Responses] = defaultdict(Responses)
+        self.connections: dict[tuple, list[WsConnection]] = defaultdict(list)
+        self.origins: set[str] = set()
+        self.stats = {'http': 0, 'unmatched': 0, 'ws': 0, 'frames': 0}
+        self.runner: web.AppRunner = None
+        self.load(path)
+
+    def load(self, path: str):
+        conns: dict[int, WsConnection] = {}
+        for line in open(path):
+            r = json.loads(line)
+            if r['type'] == 'http':
+                key = request_key(r['method'], r['url'], r['request'])
+                self.exact[key].records.append(r)
+                self.loose[key[:3]].records.append(r)
+                self.origins.add(f"{urlsplit(r['url']).scheme}://{key[1]}")
+            elif r['type'] == 'ws_open':
+                parts = urlsplit(r['url'])
+                conns[r['conn']] = conn = WsConnection(r['url'], r['t'])
+                self.connections[(parts.netloc, parts.path or '/')].append(conn)
+                self.origins.add(f"{parts.scheme}://{parts.netloc}")
+            elif r['type'] in ('ws_send', 'ws_recv') and r['conn'] in conns:
+                conns[r['conn']].frames.append(r)
+        self.log.info(f"Loaded {sum(len(r.records) for r in self.exact.values())} HTTP responses and "
+                      f"{sum(len(c) for c in self.connections.values())} websocket connections from {path}")
+
+    def response_for(self, key: tuple) -> dict | None:
+        for responses in (self.exact.get(key), self.loose.get(key[:3])):
+            if not responses:
+                continue
+            # A response served through the other index isn't served again
+            while responses.served < len(responses.records) and responses.records[responses.served].get('_served'):
+                responses.served += 1
+            if responses.served < len(responses.records):
+                r = responses.records[responses.served]
+                r['_served'] = True
+                responses.served += 1
+                return r
+            return responses.records[-1]
+        return None
+
+    def split(self, request: web.Request) -> tuple[str, str]:
+        "Recorded host and path of a request"
+        host, _, path = request.rel_url.raw_path.lstrip('/').partition('/')
+        return host, '/' + path
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self.handle_ws(request)
+        host, path = self.split(request)
+        body = await request.text() if request.can_read_body else None
+        r = self.response_for((request.method, host, path, request.rel_url.raw_query_string, normalize_body(body)))
+        if r is None:
+            self.stats['unmatched'] += 1
+            self.log.warning(f"Nothing recorded for {request.method} {host}{path}")
+            return web.Response(status=404)
+        self.stats['http'] += 1
+        if self.speed:
+            await asyncio.sleep(r.get('latency', 0) / self.speed)
+        resp_body = with_ids(decode_body(r['body'], r['b64']) or b'', jsonrpc_ids(body))
+        return web.Response(status=r['status'], headers=r['headers'],
+                            body=resp_body.encode() if isinstance(resp_body, str) else resp_body)
+
+    async def handle_ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        conns = self.connections.get(self.split(request))
+        if not conns:
+            self.log.warning(f"No websocket recorded for {request.path}")
+            await ws.close()
+            return ws
+        conn = conns.pop(0) if len(conns) > 1 else conns[0]
+        self.stats['ws'] += 1
+        sent = asyncio.Event()
+        received = 0
+
+        async def reader():
+            nonlocal received
+            async for msg in ws:
+                if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    received += 1
+                    sent.set()
+            sent.set()  # wakes the sender up to notice the client is gone
+
+        reader_task = asyncio.create_task(reader(), name="playback_ws_reader")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        expected = 0
+        try:
+            for frame in conn.frames:
+                if frame['type'] == 'ws_send':
+                    expected += 1
+                    continue
+                while received < expected and not ws.closed:
+                    sent.clear()
+                    await sent.wait()
+                if self.speed:
+                    await asyncio.sleep(max(0, started + (frame['t'] - conn.opened) / self.speed - loop.time()))
+                if ws.closed:
+                    break
+                data = decode_body(frame['data'], frame['b64'])
+                await (ws.send_bytes(data) if frame['b64'] else ws.send_str(data))
+                self.stats['frames'] += 1
+            # Staying connected, so the listener doesn't reconnect and get the recording again
+            await reader_task
+        finally:
+            reader_task.cancel()
+        return ws
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.port = self.runner.addresses[0][1]
+        self.log.info(f"Playing back on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+
+async def serve(path: str, host: str, port: int, speed: float):
+    log = init_logging()
+    playback = Playback(log, path, speed, host, port)
+    await playback.start()
+    for origin in sorted(playback.origins):
+        print(f"{origin} -> {playback_url(playback.base_url(), origin)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await playback.stop()
+        print(playback.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded node and exchange traffic")
+    parser.add_argument('path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--speed', type=float, default=1, help="websocket timing speedup, 0 sends frames right away")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.path, args.host, args.port, args.speed))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Replays stored transfers and trades through the tracker to see what events a config would have produced.
+
+    python -m bench.replay --from 2023-03-01 --to 2023-03-08 \\
+        --config '{"recent_transfers_threshold": 50000}' --config '{"cex_volume_threshold": 20000}'
+
+Records are loaded from Postgres once and fed to a `Tracker` in time order, block by block, with
+a virtual clock that jumps to each block's timestamp, so a week of history takes seconds instead
+of a week. The first config is the one in `--conf-path` (or the defaults), every `--config` is a
+JSON object of `TrackerConfig` fields that override it. Each config is replayed in its own process
+and the emitted events are compared against the first one.
+"""
+import os
+import sys
+import json
+import heapq
+import asyncio
+import logging
+import argparse
+from copy import deepcopy
+from itertools import groupby
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from dacite import from_dict
+
+from bna import init_logging
+from bna.config import Config
+from bna.event import Event, TransferEvent, MassPoolEvent, CexEvent, ChainTransferEvent
+from bna.tracker import Tracker, TRADE_CHECK_INTERVAL
+from bna.pg_store import PgStore
+from bna.transfer import Transfer
+from bna.cex_listeners import Trade
+from bench.tracker_bench import BenchDatabase
+
+# Records loaded by the parent process, inherited by the workers
+_records: tuple[list[Transfer], list[Trade]] = ([], [])
+
+
+class VirtualClock:
+    "Clock that only moves when the replay moves it"
+    def __init__(self, now: datetime):
+        self.now = now
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def advance(self, to: datetime):
+        if to > self.now:
+            self.now = to
+
+
+async def load(conninfo: str, start: datetime, end: datetime) -> tuple[list[Transfer], list[Trade]]:
+    "Loads records from the store, sorted the way the listeners would have delivered them"
+    store = PgStore(conninfo, logging.getLogger("replay"))
+    await store.connect()
+    try:
+        tfs = await store.get_transfers(start, end)
+        trs = await store.get_trades(start, end)
+    finally:
+        await store.close()
+    return (sorted(tfs.values(), key=lambda tf: (tf.timeStamp, tf.blockNumber, tf.logIndex)),
+            sorted(trs.values(), key=lambda tr: tr.timeStamp))
+
+
+def stream(tfs: list[Transfer], trs: list[Trade]):
+    "Yields (time, transfers of one block or trades with one timestamp, is_trades) in time order"
+    blocks = ((group[0].timeStamp, group, False) for group in
+              (list(g) for _, g in groupby(tfs, key=lambda tf: (tf.chain, tf.blockNumber))))
+    trades = ((group[0].timeStamp, group, True) for group in
+              (list(g) for _, g in groupby(trs, key=lambda tr: tr.timeStamp)))
+    yield from heapq.merge(blocks, trades, key=lambda step: step[0])
+
+
+def describe(ev: Event) -> dict:
+    "Identifies an event well enough to tell if another replay emitted the same one"
+    if isinstance(ev, TransferEvent):
+        key = ','.join(sorted(tf.hash for tf in ev.tfs))
+    elif isinstance(ev, MassPoolEvent):
+        key = f"{ev.subtype}:{ev.pool}:{ev.count}"
+    elif isinstance(ev, CexEvent):
+        key = ','.join(ev.markets)
+    else:
+        key = ''
+    return {'type': type(ev).__name__, 'key': key}
+
+
+async def replay(tfs: list[Transfer], trs: list[Trade], conf: Config, stats: bool = True) -> dict:
+    "Runs the tracker over the records as fast as it can and returns the events it emitted"
+    log = init_logging()
+    log.setLevel(logging.WARNING)
+    start = min(tfs[0].timeStamp if tfs else datetime.max.replace(tzinfo=timezone.utc),
+                trs[0].timeStamp if trs else datetime.max.replace(tzinfo=timezone.utc))
+    clock = VirtualClock(start)
+    known = {a.lower(): i for a, i in json.load(open("known_addresses.json")).items()}
+    db = BenchDatabase(log, conf, known, clock=clock)
+    queue = asyncio.Queue()
+    tracker = Tracker(db, conf.tracker, None, None, None, queue, log, clock=clock)
+
+    events = []
+    def collect():
+        while not queue.empty():
+            ev = queue.get_nowait()
+            events.append({'time': clock().isoformat(), **describe(ev)})
+
+    have_trades = False
+    next_stats = start + timedelta(seconds=conf.tracker.stats_interval)
+    steps = 0
+    for ts, records, is_trades in stream(tfs, trs):
+        clock.advance(ts)
+        if stats and clock() >= next_stats:
+            queue.put_nowait(await tracker.generate_stats_event())
+            next_stats += timedelta(seconds=conf.tracker.stats_interval)
+        if is_trades:
+            await db.insert_trades(records)
+            have_trades = True
+        else:
+            await tracker.handle_chain_event(ChainTransferEvent(chain=records[0].chain, tfs=records))
+        # Same as the trade worker, minus its timeout since the clock never stands still here
+        if have_trades and clock() - tracker.trades_notified_at > timedelta(seconds=TRADE_CHECK_INTERVAL):
+            await tracker.check_cex_events()
+            have_trades = False
+        collect()
+        steps += 1
+
+    return {'transfers': len(tfs), 'trades': len(trs), 'steps': steps, 'events': events,
+            'counts': dict(Counter(ev['type'] for ev in events))}
+
+
+def _init_worker(tfs: list[Transfer], trs: list[Trade]):
+    global _records
+    _records = (tfs, trs)
+
+
+def _replay_worker(conf: Config, stats: bool) -> dict:
+    return asyncio.run(replay(*_records, conf, stats))
+
+
+def replay_configs(tfs: list[Transfer], trs: list[Trade], confs: list[Config], stats: bool = True,
+                   processes: int = None, mp_context=None) -> list[dict]:
+    "Replays every config in its own process, results are in the same order as `confs`"
+    # Workers get the records once when they start instead of with every config. Forked ones
+    # inherit them without pickling, spawned ones (macOS, or Linux since Python 3.14) get a copy.
+    with ProcessPoolExecutor(max_workers=processes or min(len(confs), os.cpu_count() or 1), mp_context=mp_context,
+                             initializer=_init_worker, initargs=(tfs, trs)) as pool:
+        return list(pool.map(_replay_worker, confs, [stats] * len(confs)))
+
+
+def compare(base: dict, other: dict) -> dict:
+    "Events that only one of the two replays emitted"
+    base_keys = Counter((ev['type'], ev['key']) for ev in base['events'])
+    other_keys = Counter((ev['type'], ev['key']) for ev in other['events'])
+    return {'missing': sorted((base_keys - other_keys).elements()), 'extra': sorted((other_keys - base_keys).elements())}
+
+
+def report(results: list[dict], labels: list[str]) -> str:
+    types = sorted({t for r in results for t in r['counts']})
+    lines = [f"{results[0]['transfers']} transfers, {results[0]['trades']} trades in {results[0]['steps']} steps",
+             f"{'config':<40}" + ''.join(f"{t:>24}" for t in types)]
+    for label, r in zip(labels, results):
+        lines.append(f"{label[:39]:<40}" + ''.join(f"{r['counts'].get(t, 0):>24}" for t in types))
+    for label, r in zip(labels[1:], results[1:]):
+        diff = compare(results[0], r)
+        lines.append(f"{label}: {len(diff['missing'])} events missing, {len(diff['extra'])} extra")
+    return '\n'.join(lines)
+
+
+def parse_time(s: str) -> datetime:
+    t = datetime.fromisoformat(s)
+    return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored transfers and trades through the tracker")
+    parser.add_argument('--from', dest='start', type=parse_time, required=True)
+    parser.add_argument('--to', dest='end', type=parse_time, default=datetime.now(tz=timezone.utc))
+    parser.add_argument('--conf-path', help="config to start from, defaults are used otherwise")
+    parser.add_argument('--config', action='append', default=[], help="JSON tracker config overrides, can be repeated")
+    parser.add_argument('--no-stats', action='store_true', help="don't generate stats events")
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--save', help="write emitted events to this JSON file")
+    args = parser.parse_args()
+
+    base = Config()
+    if args.conf_path:
+        base = from_dict(data_class=Config, data=json.load(open(args.conf_path)))
+    confs, labels = [base], ['base']
+    for overrides in args.config:
+        conf = deepcopy(base)
+        conf.tracker.__dict__.update(json.loads(overrides))
+        confs.append(conf)
+        labels.append(overrides)
+
+    tfs, trs = asyncio.run(load(os.environ['POSTGRES_CONNSTRING'], args.start, args.end))
+    if not tfs and not trs:
+        print("Nothing stored in that range")
+        sys.exit(1)
+    results = replay_configs(tfs, trs, confs, not args.no_stats, args.processes)
+    print(report(results, labels))
+    if args.save:
+        json.dump(dict(zip(labels, results)), open(args.save, 'w'), indent=4)
+
+
+if __name__ == '__main__':
+    main()
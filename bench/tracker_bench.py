@@ -0,0 +1,292 @@
+"""
+Measures the tracker's hot path under synthetic chain load.
+
+    python -m bench.tracker_bench --blocks 300 --save baseline.json
+    python -m bench.tracker_bench --blocks 300 --compare baseline.json
+
+Generates Idena and BSC blocks with sends, whale transfers, DEX swaps, LP ops, pool kills and
+CEX trades, feeds them to a `Tracker` backed by an in-memory `Database`, and reports per-block
+latency percentiles of each check, events per second and memory growth. Memory is traced with
+`tracemalloc` only with `--trace-memory`, because tracing slows everything down a few times.
+With `--compare`, exits with 1 if a stage's p90 latency got slower than the baseline by more
+than `--tolerance`.
+"""
+import sys
+import json
+import time
+import random
+import resource
+import asyncio
+import logging
+import argparse
+import tracemalloc
+from decimal import Decimal
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta, timezone
+
+from bna import init_logging
+from bna.config import Config
+from bna.database import Database
+from bna.pool_index import PoolIndex
+from bna.price_service import PriceService
+from bna.write_behind import WriteBehind
+from bna.tracker import Tracker
+from bna.utils import utc_now
+from bna.transfer import Transfer, CHAIN_BSC, CHAIN_IDENA
+from bna.cex_listeners import Trade, MARKET_BITMART, MARKET_PROBIT, MARKETS
+from bna.tags import *
+
+IDENA_BLOCK_TIME = 20  # seconds
+IDENA_FIRST_BLOCK = 6_000_000
+BSC_FIRST_BLOCK = 30_000_000
+BSC_BLOCKS_PER_IDENA_BLOCK = 7
+STAGES = ['insert', 'check_interesting_events', 'check_dex_events', 'check_transfers', 'generate_stats_event']
+
+
+@dataclass
+class Load:
+    "Average number of each kind of record per Idena block"
+    sends: float = 20
+    whales: float = 0.2
+    dex_swaps: float = 3
+    lp_ops: float = 0.2
+    kills: float = 0.5
+    pool_kill_bursts: float = 0.02  # a pool killing many identities at once
+    pool_kill_size: int = 30
+    interesting: float = 0.05
+    trades: float = 2
+    stats_every: int = 50  # blocks between stats events
+
+
+class BenchDatabase(Database):
+    "The real `Database` cache with nothing behind it"
+    def __init__(self, log, conf: Config, known: dict, clock=utc_now):
+        self.log = log.getChild("DB")
+        self.clock = clock
+        self.cache = {'transfers': {}, 'trades': {}, 'identities': {}}
+        self.pools = PoolIndex()
+        # Everything is in the cache, the store is never queried
+        self.oldest_cached_tf = datetime.min.replace(tzinfo=timezone.utc)
+        self.oldest_cached_tr = datetime.min.replace(tzinfo=timezone.utc)
+        self.cache_cleaned_at = self.clock()
+        self.conf = conf
+        self.store = None
+        self.writes = WriteBehind(self.log, self._discard, tables=('transfers', 'trades'))
+        self.known = known
+        self.known_version = 1
+        self.prices = PriceService(self.log, {'cg:bitcoin': 22000, 'cg:idena': 0.035, 'cg:binancecoin': 300,
+                                              'cg:binance-usd': 1, 'cg:tether': 1})
+
+    async def _discard(self, **tables):
+        pass
+
+
+class SyntheticChain:
+    "Generates blocks of random transfers that look enough like real ones to trigger every check"
+    def __init__(self, load: Load, known: dict, seed: int = 1):
+        self.load = load
+        self.rng = random.Random(seed)
+        self.pools = [a for a, i in known.items() if i['type'] == 'pool']
+        self.interesting = [a for a, i in known.items() if i['type'] in ('premine', 'foundation') and 'chain' not in i]
+        self.identity_pools = [self.addr() for _ in range(5)]
+        self.tx_num = 0
+
+    def addr(self, n: int = None) -> str:
+        return "0x{:040x}".format(self.rng.getrandbits(160) if n is None else n)
+
+    def count(self, rate: float) -> int:
+        "Poisson-ish number of records for an average `rate`"
+        n = int(rate)
+        return n + (1 if self.rng.random() < rate - n else 0)
+
+    def transfer(self, changes: dict, block: int, index: int, ts: datetime, chain: str, signer: str = None,
+                 tags: list = None, meta: dict = None) -> Transfer:
+        self.tx_num += 1
+        return Transfer(changes={a: Decimal(v) for a, v in changes.items()}, hash=f"0x{self.tx_num:064x}",
+                        blockNumber=block, logIndex=index, timeStamp=ts, chain=chain,
+                        signer=signer or next(iter(changes)), tags=tags or [], meta=meta or {})
+
+    def idena_block(self, block: int, ts: datetime) -> list[Transfer]:
+        tfs = []
+        def add(**kw):
+            tfs.append(self.transfer(block=block, index=len(tfs), ts=ts, chain=CHAIN_IDENA, **kw))
+
+        for _ in range(self.count(self.load.sends)):
+            amount = round(self.rng.lognormvariate(5, 2), 4)
+            add(changes={self.addr(): -amount, self.addr(): amount}, tags=[IDENA_TAG_SEND])
+        for _ in range(self.count(self.load.whales)):
+            amount = self.rng.randint(100_000, 5_000_000)
+            add(changes={self.addr(): -amount, self.addr(): amount}, tags=[IDENA_TAG_SEND])
+        for _ in range(self.count(self.load.interesting)):
+            if self.interesting:
+                signer, amount = self.rng.choice(self.interesting), self.rng.randint(1000, 100_000)
+                add(changes={signer: -amount, self.addr(): amount}, signer=signer, tags=[IDENA_TAG_SEND])
+        for _ in range(self.count(self.load.kills)):
+            self.kill(add, self.rng.choice(self.identity_pools))
+        if self.rng.random() < self.load.pool_kill_bursts:
+            pool = self.rng.choice(self.identity_pools)
+            for _ in range(self.load.pool_kill_size):
+                self.kill(add, pool)
+        return tfs
+
+    def kill(self, add, pool: str):
+        stake = round(self.rng.uniform(100, 5000), 4)
+        killed = self.addr()
+        add(changes={pool: stake}, signer=pool, tags=[IDENA_TAG_KILL],
+            meta={'killedIdentity': killed, 'age': self.rng.randint(1, 30), 'pool': pool, 'usd_value': stake * 0.035})
+
+    def bsc_block(self, block: int, ts: datetime) -> list[Transfer]:
+        tfs = []
+        for _ in range(self.count(self.load.dex_swaps / BSC_BLOCKS_PER_IDENA_BLOCK)):
+            pool, trader = self.rng.choice(self.pools), self.addr()
+            amount = round(self.rng.lognormvariate(8, 1.5), 4)
+            buy = self.rng.random() < 0.5
+            changes = {pool: -amount, trader: amount} if buy else {trader: -amount, pool: amount}
+            tags = [DEX_TAG, DEX_TAG_BUY if buy else DEX_TAG_SELL]
+            tfs.append(self.transfer(changes, block, len(tfs), ts, CHAIN_BSC, signer=trader, tags=tags,
+                                     meta={'usd_value': amount * 0.035, 'usd_price': 0.035}))
+        for _ in range(self.count(self.load.lp_ops / BSC_BLOCKS_PER_IDENA_BLOCK)):
+            pool, provider = self.rng.choice(self.pools), self.addr()
+            amount = round(self.rng.lognormvariate(10, 1), 4)
+            excess = Decimal(round(amount * self.rng.uniform(-0.1, 0.1), 4)) or Decimal(1)
+            tfs.append(self.transfer({provider: -amount, pool: amount}, block, len(tfs), ts, CHAIN_BSC, signer=provider,
+                                     tags=[DEX_TAG, DEX_TAG_PROVIDE_LP],
+                                     meta={'usd_value': amount * 0.07, 'usd_price': 0.035, 'lp_excess': excess}))
+        return tfs
+
+    def trades(self, ts: datetime) -> list[Trade]:
+        trs = []
+        for _ in range(self.count(self.load.trades)):
+            self.tx_num += 1
+            market = self.rng.choice([MARKET_BITMART, MARKET_PROBIT])
+            amount = Decimal(round(self.rng.lognormvariate(7, 1.5), 2))
+            trs.append(Trade(id=self.tx_num, market=market, timeStamp=ts, amount=amount, price=Decimal("0.035"),
+                             usd_value=float(amount) * 0.035, quote=MARKETS[market]['quote'], buy=self.rng.random() < 0.5))
+        return trs
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(blocks: int, load: Load, seed: int = 1, trace_memory: bool = False) -> dict:
+    log = init_logging()
+    log.setLevel(logging.WARNING)
+    conf = Config()
+    known = {a.lower(): i for a, i in json.load(open("known_addresses.json")).items()}
+    db = BenchDatabase(log, conf, known)
+    tracker = Tracker(db, conf.tracker, None, None, None, asyncio.Queue(), log)
+    chain = SyntheticChain(load, known, seed)
+
+    timings = {stage: [] for stage in STAGES}
+    def timed(stage, f, *args):
+        start = time.perf_counter()
+        result = f(*args)
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    if trace_memory:
+        tracemalloc.start()
+        mem_start = tracemalloc.get_traced_memory()[0]
+    else:
+        mem_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    started = time.perf_counter()
+    # Blocks end at the current time, so the tracker's cleanups see them as recent
+    ts = datetime.now(tz=timezone.utc) - timedelta(seconds=blocks * IDENA_BLOCK_TIME)
+    bsc_block = BSC_FIRST_BLOCK
+    tf_count = event_count = 0
+    for block in range(blocks):
+        ts += timedelta(seconds=IDENA_BLOCK_TIME)
+        tfs = chain.idena_block(IDENA_FIRST_BLOCK + block, ts)
+        for _ in range(BSC_BLOCKS_PER_IDENA_BLOCK):
+            bsc_block += 1
+            tfs += chain.bsc_block(bsc_block, ts)
+        tf_count += len(tfs)
+
+        start = time.perf_counter()
+        await db.insert_transfers(tfs)
+        await db.insert_trades(chain.trades(ts))
+        timings['insert'].append(time.perf_counter() - start)
+
+        recent = await db.recent_transfers(conf.tracker.recent_transfers_period)
+        event_count += len(timed('check_interesting_events', tracker.check_interesting_events, recent))
+        event_count += len(timed('check_dex_events', tracker.check_dex_events, recent))
+        event_count += len(timed('check_transfers', tracker.check_transfers, recent))
+        if load.stats_every and block % load.stats_every == load.stats_every - 1:
+            start = time.perf_counter()
+            await tracker.generate_stats_event(conf.tracker.stats_interval)
+            timings['generate_stats_event'].append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    if trace_memory:
+        mem_end, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        # Only the peak is known, so growth is how much the peak went up
+        mem_end = mem_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    state = {'cached_transfers': len(db.cache['transfers']), 'cached_trades': len(db.cache['trades']),
+             'sents': len(tracker.sents), 'sents_notified': len(tracker.sents_notified),
+             'hashes_notified': len(tracker.hashes_notified),
+             'pool_events': sum(len(p) for pools in tracker.pool_events.values() for p in pools.values())}
+
+    return {
+        'blocks': blocks, 'transfers': tf_count, 'events': event_count, 'seconds': elapsed,
+        'blocks_per_sec': blocks / elapsed, 'events_per_sec': event_count / elapsed,
+        'memory_growth_mb': (mem_end - mem_start) / 2**20, 'memory_peak_mb': mem_peak / 2**20, 'state': state,
+        'stages': {stage: {'p50': percentile(t, 0.5), 'p90': percentile(t, 0.9), 'p99': percentile(t, 0.99),
+                           'max': max(t, default=0), 'total': sum(t), 'calls': len(t)}
+                   for stage, t in timings.items()},
+    }
+
+
+def report(result: dict) -> str:
+    lines = [f"{result['blocks']} blocks, {result['transfers']} transfers, {result['events']} events in {result['seconds']:.2f}s",
+             f"{result['blocks_per_sec']:.1f} blocks/s, {result['events_per_sec']:.1f} events/s, "
+             f"memory growth {result['memory_growth_mb']:.1f} MB (peak {result['memory_peak_mb']:.1f} MB)",
+             "state sizes: " + ', '.join(f"{k} {v}" for k, v in result['state'].items()),
+             f"{'stage':<26}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'calls':>8}"]
+    for stage, s in result['stages'].items():
+        lines.append(f"{stage:<26}{s['p50'] * 1000:>10.3f}{s['p90'] * 1000:>10.3f}{s['p99'] * 1000:>10.3f}"
+                     f"{s['max'] * 1000:>10.3f}{s['calls']:>8}")
+    return '\n'.join(lines)
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for stage, s in result['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base and base['p90'] and s['p90'] > base['p90'] * (1 + tolerance):
+            found.append(f"{stage}: p90 {s['p90'] * 1000:.3f}ms, was {base['p90'] * 1000:.3f}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tracker with synthetic chain load")
+    parser.add_argument('--blocks', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=1, help="multiplies all record rates")
+    parser.add_argument('--trace-memory', action='store_true', help="measure memory with tracemalloc")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="compare with results saved earlier")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p90 slowdown, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    load = Load()
+    for k, v in asdict(load).items():
+        if type(v) is float:
+            setattr(load, k, v * args.scale)
+    result = asyncio.run(run(args.blocks, load, args.seed, args.trace_memory))
+    print(report(result))
+    if args.save:
+        json.dump(result, open(args.save, 'w'), indent=4)
+    if args.compare:
+        found = regressions(result, json.load(open(args.compare)), args.tolerance)
+        for r in found:
+            print(f"REGRESSION {r}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,27 @@
 import os
 import time
 import json
-import aiohttp
 import asyncio
 import websockets
 from copy import deepcopy
 from logging import Logger
 from decimal import Decimal
 from collections import defaultdict
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from sortedcontainers import SortedDict
 from asyncio.queues import Queue as AsyncQueue
 
 from bna.database import Database
+from bna.http_client import HttpClient
+from bna.resilience import Backoff
+from bna.rpc_pool import RpcPool, parse_urls
+from bna.dex_price import DexPriceEngine
 from bna.config import BscConfig
 from bna.transfer import CHAIN_BSC, Transfer, BscLog
 from bna.tags import *
-from bna.event import BlockEvent, ChainTransferEvent
-from bna.utils import any_in, calculate_usd_value, widen
+from bna.event import BlockEvent, ChainTransferEvent, ChainRevertEvent
+from bna.utils import any_in, calculate_usd_value, price_of, widen
 
 
 WIDNA_CONTRACT = "0x0de08c1abe5fb86dd7fd2ac90400ace305138d5b"
@@ -31,53 +35,95 @@ CURRENT_CONTRACT = WIDNA_CONTRACT
 TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
 LP_MINT_TOPIC = "0x4c209b5fc8ad50758f13e2e1088ba56a560dff690a1c6fef26394f4c03821c4f"
 LP_BURN_TOPIC = "0xdccd412f0b1252819cb1fd330b93224ca42612892bb3f4f789976e6d81936496"
-LP_TOPICS = [[LP_MINT_TOPIC, LP_BURN_TOPIC]]
+LP_SYNC_TOPIC = "0x1c411e9a96e071241c2f21f7726b17ae89e3cab4c78be50e062b03a9fffbbad1"
+LP_TOPICS = [[LP_MINT_TOPIC, LP_BURN_TOPIC, LP_SYNC_TOPIC]]
 NULL_ADDRESS = "0x0000000000000000000000000000000000000000"
+WS_RECONNECT_BACKOFF = Backoff(base=1, cap=60)
+REVISION_DELAY = 1  # seconds to wait for the rest of a reorg's logs before revising a block
+EMPTY_RESULT_BACKOFF = Backoff(base=0.5, cap=4)  # for txs and blocks the node hasn't indexed yet
+
+
+@dataclass
+class JournaledBlock:
+    "A block whose transfers were already sent, kept to revise them if the block changes"
+    hash: str
+    logs: dict[int, BscLog]
+    tfs: list[Transfer]
+
+
+def same_transfer(a: Transfer, b: Transfer) -> bool:
+    return (a.blockNumber, a.logIndex, a.changes, a.tags) == (b.blockNumber, b.logIndex, b.changes, b.tags)
+
 
 class BscListener:
-    def __init__(self, conf: BscConfig, db: Database, log: Logger):
+    def __init__(self, conf: BscConfig, db: Database, log: Logger, http: HttpClient = None):
         self.log = log.getChild("BL")
         self.db = db
         self.conf = conf
         self.last_block = 0
         self.logs: SortedDict[int, dict[int, BscLog]] = SortedDict()
-        self.rpc_session = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
+        # Transfers are sent as soon as their block is seen, blocks that change afterwards are revised
+        self.journal: SortedDict[int, JournaledBlock] = SortedDict()
+        self.revised: dict[int, float] = {}  # block number -> when it changed
+        self.http = http if http else HttpClient(log)
         self.block_timestamps: dict[int, int] = {}
         self.tx_signers: dict[str, str] = {}  # @TODO: leaks
-        self.subs = {}
-        self.last_sub_id = 0
+        self.head_lock = asyncio.Lock()
+        self.dex_price = DexPriceEngine(db, log, idna_token=WIDNA_CONTRACT)
+        self.ws_live: set[int] = set()
 
-        self.rpc_url = os.environ['BSC_RPC_URL']
-        self.ws_url = os.environ['BSC_WS_URL']
+        # All endpoint variables accept a comma separated list of URLs
+        self.rpc_pool = RpcPool('bsc_rpc', parse_urls(os.environ['BSC_RPC_URL']), self.http, log)
+        self.ws_urls = parse_urls(os.environ['BSC_WS_URL'])
         if os.environ.get("BSC_HISTORY_RPC_URL"):
-            self.history_rpc_url = os.environ['BSC_HISTORY_RPC_URL']
+            self.history_pool = RpcPool('bsc_history_rpc', parse_urls(os.environ['BSC_HISTORY_RPC_URL']), self.http, log)
         else:
-            self.history_rpc_url = self.rpc_url
+            self.history_pool = self.rpc_pool
 
     async def run(self, event_chan):
-        ws_read_timeout = self.conf.ws_event_timeout
         logs_task = asyncio.create_task(self.logs_reader(event_chan), name="logs_reader")
         self.log.info("BSC listener started")
         # await self.fetch_missing(from_=25416520, until=25416525)
         self.last_block = (await self.db.get_last_block(CHAIN_BSC)) or 0
         self.log.debug(f"Resuming from block {self.last_block}")
+        await self.dex_price.load(self.rpc_req)
+        # Every WS endpoint keeps its own subscriptions running, so when one connection drops
+        # the others are already subscribed and no blocks are missed. Duplicates are ignored.
+        workers = [asyncio.create_task(self.ws_worker(i, url, event_chan), name=f"bsc_ws_{i}")
+                   for i, url in enumerate(self.ws_urls)]
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            self.log.debug("Cancelled")
+        for worker in workers:
+            worker.cancel()
+        logs_task.cancel()
+
+    async def ws_worker(self, index: int, url: str, event_chan):
+        ws_read_timeout = self.conf.ws_event_timeout
+        ws_failures = 0
+        websocket = None
         while True:
-            self.last_sub_id = 0
-            self.subs.clear()
+            subs = {}
             try:
-                websocket = await websockets.connect(self.ws_url, max_size=None, max_queue=None)
+                websocket = await websockets.connect(url, max_size=None, max_queue=None)
+                if self.http.recorder is not None:
+                    websocket = self.http.recorder.wrap_ws(websocket, url)
                 # @TODO Future: This is ~1M messages per month for not much benefit
-                await self.ws_sub(websocket, ["newHeads"], 'head')
-                await self.ws_sub(websocket, ["logs", {'address': WIDNA_CONTRACT, 'topics': [TRANSFER_TOPIC]}], 'log')
+                await self.ws_sub(websocket, subs, ["newHeads"], 'head')
+                await self.ws_sub(websocket, subs, ["logs", {'address': WIDNA_CONTRACT, 'topics': [TRANSFER_TOPIC]}], 'log')
                 for lp in self.db.known_by_type['pool'].keys():
-                    await self.ws_sub(websocket, ["logs", {'address': lp, 'topics': LP_TOPICS}], 'log')
-                    await self.ws_sub(websocket, ["logs", {'topics': [TRANSFER_TOPIC, None, widen(lp)]}], 'log')
-                    await self.ws_sub(websocket, ["logs", {'topics': [TRANSFER_TOPIC, widen(lp), None]}], 'log')
+                    await self.ws_sub(websocket, subs, ["logs", {'address': lp, 'topics': LP_TOPICS}], 'log')
+                    await self.ws_sub(websocket, subs, ["logs", {'topics': [TRANSFER_TOPIC, None, widen(lp)]}], 'log')
+                    await self.ws_sub(websocket, subs, ["logs", {'topics': [TRANSFER_TOPIC, widen(lp), None]}], 'log')
+                self.ws_live.add(index)
+                self.log.info(f"WS #{index} subscribed, {len(self.ws_live)}/{len(self.ws_urls)} connections live")
                 while True:
                     # @Update: for Python 3.11
                     # try:
                     #     async with asyncio.timeout(ws_read_timeout):
                     r = await websocket.recv()
+                    ws_failures = 0
                     # except TimeoutError:
                     #     self.log.warn(f"Timeout on socket read after {ws_read_timeout}, reconnecting")
                     #     try:
@@ -89,23 +135,24 @@ class BscListener:
                     j = json.loads(r)
                     if 'id' in j:
                         # print(j)
-                        self.subs[j['result']] = self.subs[j['id']]
+                        subs[j['result']] = subs[j['id']]
                     if 'method' in j:
                         if j['method'] == 'eth_subscription':
-                            sub_name = self.subs[j['params']['subscription']]
+                            sub_name = subs[j['params']['subscription']]
                             if sub_name == 'head':
                                 await self.new_head(j['params']['result'], event_chan)
                             elif sub_name == 'log':
                                 await self.new_log(j['params']['result'])
             except asyncio.CancelledError:
-                self.log.debug("Cancelled")
                 break
             except Exception as e:
-                self.log.error(f"WS exception: \"{e}\"", exc_info=True)
-                await asyncio.sleep(1)
-        logs_task.cancel()
-        await self.rpc_session.close()
-        await websocket.close()
+                ws_failures += 1
+                self.ws_live.discard(index)
+                self.log.error(f"WS #{index} exception #{ws_failures}, {len(self.ws_live)} connections live: \"{e}\"", exc_info=True)
+                await asyncio.sleep(WS_RECONNECT_BACKOFF.delay(ws_failures))
+        self.ws_live.discard(index)
+        if websocket is not None:
+            await websocket.close()
 
     async def logs_reader(self, event_chan: AsyncQueue):
         "Consumes logs after some delay (for finality) and generates transfer events"
@@ -116,6 +163,8 @@ class BscListener:
                 self.log.info('BSC event generator started')
                 while True:
                     await asyncio.sleep(1)
+                    if self.revised:
+                        await self.process_revisions(event_chan)
                     if len(self.logs) == 0:
                         continue
                     block: list[BscLog] = list(self.logs.peekitem(0)[1].values())
@@ -128,13 +177,19 @@ class BscListener:
                     if not block_time or time.time() < block_time + self.conf.transfer_delay:
                         self.log.debug(f"Block {num} is early: {block_time}")
                         continue
-                    await asyncio.sleep(2)  # load-bearing sleep for when a block is late and logs are disjunct
                     block = list(self.logs[num].values())
                     self.log.info(f"Processing block {num}, ts={block_time}, {len(block)=}, {block}")
                     tfs = self.process_block(block)
                     self.logs.popitem(0)
+                    # Logs that arrive late or get removed now revise the block instead
+                    block_hash = block[0].blockHash
+                    self.journal[num] = JournaledBlock(block_hash, {log.logIndex: log for log in block}, tfs)
+                    for tf in tfs:
+                        tf.meta['block_hash'] = block_hash
+                    while self.journal.peekitem(0)[0] <= num - self.conf.reorg_window:
+                        self.journal.popitem(0)
                     if tfs:
-                        event_chan.put_nowait(ChainTransferEvent(chain=CHAIN_BSC, tfs=tfs))
+                        await event_chan.put(ChainTransferEvent(chain=CHAIN_BSC, tfs=tfs))
             except Exception as e:
                 self.log.error(f"Reader exc, retry={retry_block}: {e}", exc_info=True)
                 retry_block += 1
@@ -144,10 +199,11 @@ class BscListener:
                     self.logs.popitem(0)
                     continue
 
-    async def ws_sub(self, ws, params: list, name: str):
-        self.last_sub_id += 1
-        sub = {'id': self.last_sub_id, 'method': 'eth_subscribe', 'params': params}
-        self.subs[self.last_sub_id] = name
+    async def ws_sub(self, ws, subs: dict, params: list, name: str):
+        # Responses aren't read until all subscriptions are sent, so only request ids are in `subs`
+        sub_id = len(subs) + 1
+        sub = {'id': sub_id, 'method': 'eth_subscribe', 'params': params}
+        subs[sub_id] = name
         await ws.send(json.dumps(sub))
 
     async def new_log(self, log: dict):
@@ -159,6 +215,12 @@ class BscListener:
         #      most TXes get moved to the next block.
         #   2. TX rearrangement, index changes within the same block.
         #   3. "Late TX", gets re-inserted in the next block.
+        if not log.removed and log.transactionHash not in self.tx_signers:
+            # Fetched first, since the block can be processed as soon as the log is in it
+            self.tx_signers[log.transactionHash] = await self.fetch_signer(log.transactionHash)
+        if log.blockNumber in self.journal:
+            self.revise(log)
+            return
         if log.removed:
             try:
                 del self.logs[log.blockNumber][log.logIndex]
@@ -169,10 +231,56 @@ class BscListener:
                 pass
             return
         block = self.logs.get(log.blockNumber, {})
+        if block and next(iter(block.values())).blockHash != log.blockHash:
+            # Replaced before it was processed, logs of the old block won't all be removed
+            block = {i: l for i, l in block.items() if l.blockHash == log.blockHash}
         block[log.logIndex] = log
         self.logs[log.blockNumber] = block
-        if log.transactionHash not in self.tx_signers:
-            self.tx_signers[log.transactionHash] = await self.fetch_signer(log.transactionHash)
+
+    def revise(self, log: BscLog) -> bool:
+        "Applies a log to a block that was already sent, returns True if the block changed"
+        entry = self.journal[log.blockNumber]
+        old = entry.logs.get(log.logIndex)
+        if log.removed:
+            if old is None or old.blockHash != log.blockHash:
+                return False
+            del entry.logs[log.logIndex]
+        else:
+            if old is not None and (old.blockHash, old.transactionHash, old.data) == (log.blockHash, log.transactionHash, log.data):
+                return False
+            if log.blockHash != entry.hash:
+                entry.logs = {i: l for i, l in entry.logs.items() if l.blockHash == log.blockHash}
+                entry.hash = log.blockHash
+            entry.logs[log.logIndex] = log
+        self.log.info(f"Block {log.blockNumber} changed after it was sent: {log.logIndex=}, {log.removed=}, {log.blockHash=}")
+        self.revised.setdefault(log.blockNumber, time.time())
+        return True
+
+    async def process_revisions(self, event_chan: AsyncQueue):
+        "Re-processes sent blocks that changed, reverting transfers that aren't in them anymore"
+        now = time.time()
+        for num in sorted(self.revised):
+            if now - self.revised[num] < REVISION_DELAY:
+                continue
+            del self.revised[num]
+            entry = self.journal.get(num)
+            if entry is None:
+                continue
+            # Reserves from the block were already applied, and the price engine only moves forward
+            logs = [log for log in entry.logs.values() if log.topics[0] != LP_SYNC_TOPIC]
+            tfs = self.process_block(logs) if logs else []
+            old = {tf.hash: tf for tf in entry.tfs}
+            new = {tf.hash: tf for tf in tfs}
+            reverted = [tf for h, tf in old.items() if h not in new or not same_transfer(tf, new[h])]
+            added = [tf for h, tf in new.items() if h not in old or not same_transfer(old[h], tf)]
+            for tf in tfs:
+                tf.meta['block_hash'] = entry.hash
+            entry.tfs = tfs
+            self.log.warning(f"Revised block {num}, {len(reverted)} transfers reverted, {len(added)} added")
+            if reverted:
+                await event_chan.put(ChainRevertEvent(chain=CHAIN_BSC, tfs=reverted))
+            if added:
+                await event_chan.put(ChainTransferEvent(chain=CHAIN_BSC, tfs=added))
 
     async def new_head(self, head, event_chan: asyncio.Queue):
         num = int(head['number'], 16)
@@ -181,6 +289,14 @@ class BscListener:
         if abs(now - timestamp) > 2:
             self.log.debug(f"New head: \t{num} {now=}-{timestamp=} = {now-timestamp}")
         self.block_timestamps[num] = timestamp
+        self.dex_price.seen_head()
+        entry = self.journal.get(num)
+        if entry is not None and head.get('hash') and head['hash'] != entry.hash:
+            # Replaced by a block that might have none of our logs, so nothing else would tell
+            self.log.warning(f"Block {num} was replaced: {entry.hash} -> {head['hash']}")
+            entry.logs = {i: l for i, l in entry.logs.items() if l.blockHash == head['hash']}
+            entry.hash = head['hash']
+            self.revised.setdefault(num, time.time())
         for tf in self.logs.get(num, {}).values():
             tf.timeStamp = datetime.fromtimestamp(timestamp, tz=timezone.utc)
 
@@ -188,16 +304,28 @@ class BscListener:
         if len(self.block_timestamps) > 500:
             self.block_timestamps = dict(sorted(list(self.block_timestamps.items()))[300:])
 
-        diff = num - self.last_block
-        if diff > 1 and self.last_block != 0:
-            self.log.warning(f"Block {num} has {diff=}, fetching potentially missing logs")
-            try:
-                await self.fetch_missing(from_=self.last_block, until=num)
-            except Exception as e:
-                self.log.error(f"Error while fetching missing, giving up: {e}", exc_info=True)
-            self.log.info("Finished fetching missing")
-        self.last_block = num
-        event_chan.put_nowait(BlockEvent(chain=CHAIN_BSC, height=int(num)))
+        async with self.head_lock:
+            # Heads from the other WS connections
+            if num <= self.last_block:
+                return
+            diff = num - self.last_block
+            if diff > 1 and self.last_block != 0:
+                self.log.warning(f"Block {num} has {diff=}, fetching potentially missing logs")
+                try:
+                    await self.fetch_missing(from_=self.last_block, until=num)
+                except Exception as e:
+                    self.log.error(f"Error while fetching missing, giving up: {e}", exc_info=True)
+                self.log.info("Finished fetching missing")
+            self.last_block = num
+        await event_chan.put(BlockEvent(chain=CHAIN_BSC, height=int(num)))
+
+    def lag(self) -> tuple[int, float]:
+        "Blocks and seconds the oldest block that wasn't processed yet is behind the head"
+        if len(self.logs) == 0:
+            return 0, 0
+        oldest = self.logs.peekitem(0)[0]
+        block_time = self.block_timestamps.get(oldest)
+        return max(0, self.last_block - oldest + 1), max(0, time.time() - block_time) if block_time else 0
 
     async def get_block_time(self, blockNumber) -> int:
         cached_time = self.block_timestamps.get(blockNumber)
@@ -205,24 +333,25 @@ class BscListener:
             return cached_time
         else:
             self.log.warning(f"Block time cache miss: {blockNumber}")  # actually happens
-            timestamp = time.time()
-            for i in range(3):
-                try:
-                    block = await self.rpc_req('eth_getBlockByNumber', [hex(blockNumber), False])
-                    timestamp = int(block['timestamp'], 16)
-                    self.block_timestamps[blockNumber] = timestamp
-                    break
-                except Exception as e:
-                    self.log.error(f"Error while fetching block time: {e}", exc_info=True)
-                    await asyncio.sleep(2)
-            else:
-                self.block_timestamps[blockNumber] = timestamp
+            try:
+                block = await self.rpc_req('eth_getBlockByNumber', [hex(blockNumber), False], attempts=3, allow_none=False)
+                timestamp = int(block['timestamp'], 16)
+            except Exception as e:
+                self.log.error(f"Error while fetching block time: {e}", exc_info=True)
+                timestamp = time.time()
                 self.log.warning(f"Assigning current time {int(timestamp)} to block {blockNumber}")
+            self.block_timestamps[blockNumber] = timestamp
             return timestamp
 
     def process_block(self, block: list[BscLog]) -> list[Transfer]:
-        "Extract transfers from all logs in a block once it's deemed final"
+        "Extract transfers from all logs in a block"
         block.sort(key=lambda log: log.logIndex)
+        # Pool reserve updates only feed the price engine
+        syncs = [log for log in block if log.topics[0] == LP_SYNC_TOPIC]
+        if syncs:
+            block = [log for log in block if log.topics[0] != LP_SYNC_TOPIC]
+            num = syncs[0].blockNumber
+            self.dex_price.process_syncs(syncs, num, self.block_timestamps.get(num) or time.time())
         by_hash = defaultdict(list)
         for log in block:
             by_hash[log.transactionHash].append(log)
@@ -352,7 +481,7 @@ class BscListener:
                 if any_in(squashed.tags, DEX_LP_TAGS):
                     pool_addr, ch = list(squashed.meta['lp'].items())[0]  # no multi-pool nonsense
                     pool = self.db.known[pool_addr]
-                    token_price = self.db.prices[self.db.known[self.db.known[pool_addr]['token1']]['price_id']]
+                    token_price = price_of(self.db.prices, self.db.known[self.db.known[pool_addr]['token1']]['price_id'], squashed.timeStamp)
                     squashed.meta['usd_price'] = abs((float(ch['token']) * token_price) / float(ch['idna']))
                 elif any_in(squashed.tags, DEX_TRADE_TAGS) and squashed.value():
                     squashed.meta['usd_price'] = squashed.meta['usd_value'] / float(squashed.value())
@@ -364,101 +493,109 @@ class BscListener:
     async def fetch_missing(self, from_: int, until: int, batch=10000):
         # I wrote this batching thing because I thought there was a limit of 10000 blocks per
         # request on QuickNode, but actually it's just 10000 blocks from the tip.
-        url = self.history_rpc_url
+        # All calls go to the same endpoint so that they see the same chain head
+        pool = self.history_pool
+        sticky = f"missing_{until}"
         diff = until - from_
         if diff > 9999:
             self.log.warning("Can't fetch more than 10000 blocks in the past")
             from_ = until - 9999
-        for batch_from in range(from_, until, batch):
-            batch_until = (batch_from + batch) if (until - (batch_from + batch)) > batch else until
-            self.log.debug(f"Processing batch {batch_from}-{batch_until}")
-            params = [{"topics": [TRANSFER_TOPIC], "address": CURRENT_CONTRACT,
-                    #    "fromBlock": from_ + 1, "toBlock": until - 1}]
-                    "fromBlock": hex(batch_from + 1), "toBlock": hex(batch_until - 1)}]
-            # Fetch iDNA transfer logs
-            logs: list[dict] = await self.rpc_req('eth_getLogs', params, url=url) or []
-            for lp in self.db.known_by_type['pool'].keys():
-                # Fetch LP token mint/burn logs
-                params[0]['topics'] = LP_TOPICS
-                params[0]['address'] = lp
-                logs.extend(await self.rpc_req('eth_getLogs', params=params, url=url) or [])
-                await asyncio.sleep(0.3) # rate limiting
-
-                # Fetch transfer of any token to/from pools
-                del params[0]['address']
-                params[0]['topics'] = [TRANSFER_TOPIC, widen(lp), None]
-                logs.extend(await self.rpc_req('eth_getLogs', params=params, url=url) or [])
-                params[0]['topics'] = [TRANSFER_TOPIC, None, widen(lp)]
-                logs.extend(await self.rpc_req('eth_getLogs', params=params, url=url) or [])
-            self.log.debug(f"Fetched {len(logs)=}")
-
-            new_block_times = {}
-            new_signers = {}
-            for log in logs:
-                blockNumber = int(log['blockNumber'], 16)
-                # Since it's possible that "removed=True logs" weren't received,
-                # old logs for newly fetched blocks must be cleared.
-                if blockNumber in self.logs:
-                    del self.logs[blockNumber]
-                if blockNumber not in self.block_timestamps and blockNumber not in new_block_times:
-                    block = await self.rpc_req('eth_getBlockByNumber', [hex(blockNumber), False])
-                    timestamp = int(block['timestamp'], 16)
-                    self.log.debug(f"Missing head: \t{blockNumber} {timestamp}")
-                    new_block_times[blockNumber] = timestamp
-                hash = log['transactionHash']
-                if hash not in self.tx_signers and hash not in new_signers:
-                    signer = await self.fetch_signer(hash)
-                    self.log.debug(f"Missing signer: \t{hash} {signer}")
-                    new_signers[hash] = signer
-
-            # This is done separately to avoid awaiting in the middle of state modification
-            self.block_timestamps.update(new_block_times)
-            self.tx_signers.update(new_signers)
-
-            logs.sort(key=lambda l: (int(l['blockNumber'], 16), int(l['logIndex'], 16)))
-            self.log.debug(f"Inserting {len(logs)=}")
-            for log in logs:
-                # await here is really bad because it could cause the reader to read an incomplete block,
-                # unless timestamps and signers are fetched ahead of time, and they are
-                await self.new_log(log)
+        try:
+            for batch_from in range(from_, until, batch):
+                batch_until = (batch_from + batch) if (until - (batch_from + batch)) > batch else until
+                self.log.debug(f"Processing batch {batch_from}-{batch_until}")
+                params = [{"topics": [TRANSFER_TOPIC], "address": CURRENT_CONTRACT,
+                        #    "fromBlock": from_ + 1, "toBlock": until - 1}]
+                        "fromBlock": hex(batch_from + 1), "toBlock": hex(batch_until - 1)}]
+                # Fetch iDNA transfer logs
+                logs: list[dict] = await self.rpc_req('eth_getLogs', params, pool=pool, sticky=sticky) or []
+                for lp in self.db.known_by_type['pool'].keys():
+                    # Fetch LP token mint/burn logs
+                    params[0]['topics'] = LP_TOPICS
+                    params[0]['address'] = lp
+                    logs.extend(await self.rpc_req('eth_getLogs', params=params, pool=pool, sticky=sticky) or [])
+                    await asyncio.sleep(0.3) # rate limiting
+
+                    # Fetch transfer of any token to/from pools
+                    del params[0]['address']
+                    params[0]['topics'] = [TRANSFER_TOPIC, widen(lp), None]
+                    logs.extend(await self.rpc_req('eth_getLogs', params=params, pool=pool, sticky=sticky) or [])
+                    params[0]['topics'] = [TRANSFER_TOPIC, None, widen(lp)]
+                    logs.extend(await self.rpc_req('eth_getLogs', params=params, pool=pool, sticky=sticky) or [])
+                self.log.debug(f"Fetched {len(logs)=}")
+
+                new_block_times = {}
+                new_signers = {}
+                for log in logs:
+                    blockNumber = int(log['blockNumber'], 16)
+                    # Since it's possible that "removed=True logs" weren't received,
+                    # old logs for newly fetched blocks must be cleared.
+                    if blockNumber in self.logs:
+                        del self.logs[blockNumber]
+                    if blockNumber not in self.block_timestamps and blockNumber not in new_block_times:
+                        block = await self.rpc_req('eth_getBlockByNumber', [hex(blockNumber), False], pool=pool, sticky=sticky)
+                        timestamp = int(block['timestamp'], 16)
+                        self.log.debug(f"Missing head: \t{blockNumber} {timestamp}")
+                        new_block_times[blockNumber] = timestamp
+                    hash = log['transactionHash']
+                    if hash not in self.tx_signers and hash not in new_signers:
+                        signer = await self.fetch_signer(hash)
+                        self.log.debug(f"Missing signer: \t{hash} {signer}")
+                        new_signers[hash] = signer
+
+                # This is done separately to avoid awaiting in the middle of state modification
+                self.block_timestamps.update(new_block_times)
+                self.tx_signers.update(new_signers)
+
+                logs.sort(key=lambda l: (int(l['blockNumber'], 16), int(l['logIndex'], 16)))
+                self.log.debug(f"Inserting {len(logs)=}")
+                for log in logs:
+                    # await here is really bad because it could cause the reader to read an incomplete block,
+                    # unless timestamps and signers are fetched ahead of time, and they are
+                    await self.new_log(log)
+        finally:
+            pool.release(sticky)
 
     async def fetch_signer(self, tx_hash) -> str:
         "Fetched the full transaction from the RPC and returns its signer."
-        # defaulting to the zero address better than failing?
-        signer = NULL_ADDRESS
         # Sometimes TX info isn't available immediately
-        for i in range(3):
-            try:
-                tx = await self.rpc_req('eth_getTransactionByHash', [tx_hash], attempts=3)
-                signer = tx['from'].lower()
-                break
-            except Exception as e:
-                self.log.error(f"Failed to fetch signer for {tx_hash=}: {e}", exc_info=True)
-                self.log.debug(f"{tx=}")
-                await asyncio.sleep(1)
-        return signer
+        try:
+            tx = await self.rpc_req('eth_getTransactionByHash', [tx_hash], attempts=5, allow_none=False)
+            return tx['from'].lower()
+        except Exception as e:
+            self.log.error(f"Failed to fetch signer for {tx_hash=}: {e}", exc_info=True)
+            # defaulting to the zero address better than failing?
+            return NULL_ADDRESS
 
-    async def rpc_req(self, method, params, id=0, attempts=10, url=None) -> dict:
-        if url is None:
-            url = self.rpc_url
-        self.log.debug(f"rpc_req {method=}, {params=} url={url[:30]}")
+    async def rpc_req(self, method, params, id=0, attempts=5, pool: RpcPool = None, allow_none=True,
+                      sticky: str = None) -> dict:
+        """
+        Retries go to other endpoints of the pool. `allow_none=False` also retries empty results, they
+        only mean the node hasn't indexed the tx or block yet, so they don't count as endpoint failures.
+        """
+        if pool is None:
+            pool = self.rpc_pool
+        self.log.debug(f"rpc_req {method=}, {params=} pool={pool.name}")
         req = {"method": method, "params": params, "id": id}
+
+        def result(j: dict):
+            if 'error' in j:
+                self.log.error(f"RPC Error: {j['error']}")
+            if 'result' not in j:
+                raise Exception(f"No result for {method}: {j.get('error')}")
+            return j['result']
+
         attempt = 0
-        resp = None
-        while attempt < attempts:
-            try:
-                resp = await self.rpc_session.post(url, json=req)
-                j = await resp.json(content_type=None)
-                if 'error' in j:
-                    self.log.error(f"RPC Error, returning None: {j['error']}")
-                return j['result']
-            except Exception as e:
-                attempt += 1
-                self.log.warn(f'API fetch #{attempt}/{attempts} error: "{e}"')
-                self.log.debug(f'{resp=}')
-                if attempt == attempts:
-                    raise e
-                await asyncio.sleep(2)
+        while True:
+            attempt += 1
+            res = await pool.request(req, check=result, attempts=attempts, sticky=sticky)
+            if res is not None or allow_none:
+                return res
+            if attempt >= attempts:
+                raise Exception(f"Empty result for {method}")
+            delay = EMPTY_RESULT_BACKOFF.delay(attempt)
+            self.log.debug(f"Empty result for {method} #{attempt}/{attempts}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
     # TODO: Test this
     def squash(transfers: list[Transfer]) -> Transfer:
@@ -1,13 +1,20 @@
+import zlib
+import json
 import random
-import aiohttp
 import asyncio
 import datetime
+import websockets
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from copy import deepcopy
 from decimal import Decimal
 from datetime import datetime, timezone, timedelta
 from dataclasses import dataclass, asdict
 
 from bna.config import CexConfig
+from bna.http_client import HttpClient
+from bna.resilience import Backoff
+from bna.poll_scheduler import PollScheduler, POLL_GROUP_CEX
 
 MARKET_QTRADE = "qtrade"
 MARKET_HOTBIT = "hotbit"
@@ -136,80 +143,276 @@ class Trade:
 #            "time": "2023-01-03T14:16:43.908Z", "side": "buy", "tick_direction": "down"}]}
 
 
-async def vitex_trades(log, conf: CexConfig, prices: dict, event_chan):
-    log = log.getChild('VX')
-    log.info('ViteX trade listener started')
-    s = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
-    last_trade_time = 0
-    while True:
-        try:
-            await asyncio.sleep(conf.interval * 3 + random.random())
-            r = await s.get('https://api.vitex.net/api/v2/trades?symbol=IDNA-000_BTC-000&limit=100')
-            assert r.status == 200
-            raw_trades = (await r.json(content_type=None))['data']
-            quote_price = prices[MARKETS[MARKET_VITEX]['quote']]
-            trades = [Trade.from_vitex(t, quote_price) for t in raw_trades if t['timestamp'] > last_trade_time]
-            if trades and len(trades) > 0:
-                event_chan.put_nowait(trades)
-                last_trade_time = raw_trades[0]['timestamp']
-        except asyncio.CancelledError:
-            log.debug("Cancelled")
-            break
-        except Exception as e:
-            log.error(f'ViteX exception: "{e}"', exc_info=False)
-            await asyncio.sleep(conf.interval)
-    await s.close()
-
-async def probit_trades(log, conf: CexConfig, prices: dict, event_chan):
-    log = log.getChild('PB')
-    log.info('ProBit trade listener started')
-    s = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
-    start_time = datetime.utcnow() - timedelta(days=7)
-    start_time = start_time.isoformat(timespec='milliseconds')
-    resp = None
-    while True:
-        try:
-            await asyncio.sleep(conf.interval + random.random())
-            url = f'https://api.probit.com/api/exchange/v1/trade?market_id=IDNA-USDT&start_time={start_time}Z&end_time=9999-12-21T03:00:00.000Z&limit=1000'
-            r = await s.get(url)
-            resp = await r.json(content_type=None)
-            trades = resp['data']
-            if trades and len(trades) > 0:
-                quote_price = prices[MARKETS[MARKET_PROBIT_USDT]['quote']]
-                trades = list(map(lambda t: Trade.from_probit(t, quote_price, MARKET_PROBIT_USDT), trades))
-                event_chan.put_nowait(trades)
-                start_time = (trades[0].timeStamp.replace(tzinfo=None) + timedelta(microseconds=1000)).isoformat(timespec='milliseconds')
-        except asyncio.CancelledError:
-            log.debug("Cancelled")
-            break
-        except Exception as e:
-            log.error(f'ProBit exception: "{e}"', exc_info=True)
-            log.debug(f"{resp=}")
-            await asyncio.sleep(conf.interval)
-    await s.close()
-
-async def bitmart_trades(log, conf: CexConfig, prices: dict, event_chan):
-    log = log.getChild('BT')
-    log.info('BitMart trade listener started')
-    s = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
-    last_trade_id = 1
-    while True:
-        try:
-            await asyncio.sleep(conf.interval + random.random())
-            r = await s.get('https://api-cloud.bitmart.com/spot/v1/symbols/trades?symbol=IDNA_USDT')
-            trades = (await r.json())['data']['trades']
-            if trades and len(trades) > 0:
-                quote_price = prices[MARKETS[MARKET_BITMART]['quote']]
-                trades = list(map(lambda t: Trade.from_bitmart(t, quote_price),
-                           filter(lambda t: t['order_time'] > last_trade_id, trades)))
-                if len(trades) == 0:
+TRADE_DEDUPE_SIZE = 5000  # recently seen trades remembered per connector
+MAX_IDLE_INTERVAL_FACTOR = 20  # idle markets are polled down to every `interval * factor` seconds
+VITEX_PAGE_SIZE = 100
+VITEX_SMALL_PAGE_SIZE = 10  # usually enough once caught up, the full page is fetched when it isn't
+# ProBit is queried by time. With nothing sent yet only this many recent seconds are fetched, like the
+# latest page of the other markets. It's well over the tracker's `cex_volume_period`.
+PROBIT_BACKFILL_WINDOW = 60 * 60
+PROBIT_FIRST_PAGE_SIZE = 100
+PROBIT_PAGE_SIZE = 1000
+
+
+class CexConnector(ABC):
+    """
+    Trade feed of one exchange market. Trades are streamed over the exchange's websocket if it has
+    one, and fetched over REST only on (re)connects and sequence gaps, or polled while the websocket
+    is down. Trades are deduplicated by (id, market) before they're sent to the tracker.
+    """
+    name = ''
+    log_name = ''
+    market = ''
+    ws_url: str = None
+    rest_url: str = None
+    poll_factor = 1  # multiplier of `CexConfig.interval`
+
+    def __init__(self, log, conf: CexConfig, prices: dict, http: HttpClient, ws_url: str = None, rest_url: str = None,
+                 scheduler: PollScheduler = None):
+        self.log = log.getChild(self.log_name)
+        self.conf = conf
+        self.prices = prices
+        self.http = http
+        self.ws_url = ws_url or self.ws_url
+        self.rest_url = rest_url or self.rest_url
+        self.poll_interval = conf.interval * self.poll_factor
+        self.backoff = Backoff(base=conf.interval, cap=conf.interval * 20)
+        self.scheduler = scheduler if scheduler else PollScheduler(log)
+        self.scheduler.register(self.market, self.poll_interval, self.poll_interval * MAX_IDLE_INTERVAL_FACTOR,
+                                groups=(POLL_GROUP_CEX,))
+        self.seen: OrderedDict[tuple[int, str], None] = OrderedDict()
+        self.last_seq: int = None
+        self.last_id: int = None
+        self.last_time: datetime = None
+        self.stats = {'ws': 0, 'rest': 0, 'duplicates': 0, 'gaps': 0, 'not_modified': 0, 'skipped': 0}
+
+    def quote_price(self) -> float:
+        return self.prices[MARKETS[self.market]['quote']]
+
+    @abstractmethod
+    async def fetch(self) -> list[Trade]:
+        "Recent trades over REST"
+
+    def subscriptions(self) -> list[dict]:
+        return []
+
+    def parse_message(self, msg: dict) -> tuple[list[Trade], bool] | None:
+        "Returns trades from a websocket message and whether they're a snapshot rather than new trades"
+        return None
+
+    @abstractmethod
+    def raw_id(self, raw: dict) -> int:
+        "Trade ID from an API response, without parsing the whole trade"
+
+    def unseen(self, raw_trades: list[dict]) -> list[dict]:
+        "Trade IDs of all markets increase over time, so only trades after the newest sent one are parsed"
+        if self.last_id is None:
+            return raw_trades
+        new = [t for t in raw_trades if self.raw_id(t) > self.last_id]
+        self.stats['skipped'] += len(raw_trades) - len(new)
+        return new
+
+    async def get_if_modified(self, url: str, endpoint: str):
+        j = await self.http.get_json_if_modified(url, endpoint=endpoint)
+        if j is None:
+            self.stats['not_modified'] += 1
+        return j
+
+    def seq(self, trade: Trade) -> int | None:
+        "Sequential trade number, for markets where gaps in the stream can be detected"
+        return None
+
+    def has_gap(self, trades: list[Trade]) -> bool:
+        seqs = [s for s in map(self.seq, trades) if s is not None]
+        return self.last_seq is not None and len(seqs) > 0 and min(seqs) > self.last_seq + 1
+
+    async def emit(self, trades: list[Trade], event_chan, source: str) -> int:
+        new = []
+        for t in trades:
+            key = (t.id, t.market)
+            if key in self.seen:
+                self.stats['duplicates'] += 1
+                continue
+            self.seen[key] = None
+            new.append(t)
+            seq = self.seq(t)
+            if seq is not None and (self.last_seq is None or seq > self.last_seq):
+                self.last_seq = seq
+            if self.last_id is None or t.id > self.last_id:
+                self.last_id = t.id
+            if self.last_time is None or t.timeStamp > self.last_time:
+                self.last_time = t.timeStamp
+        while len(self.seen) > TRADE_DEDUPE_SIZE:
+            self.seen.popitem(last=False)
+        if new:
+            self.stats[source] += len(new)
+            new.sort(key=lambda t: t.timeStamp, reverse=True)  # newest first, like exchange APIs
+            await event_chan.put(new)
+        return len(new)
+
+    async def backfill(self, event_chan) -> int:
+        return await self.emit(await self.fetch(), event_chan, 'rest')
+
+    async def poll(self, event_chan):
+        "Polling intervals adapt to how active the market is, see `PollScheduler`"
+        failures = 0
+        while True:
+            try:
+                async with self.scheduler.turn(self.market):
+                    new = await self.backfill(event_chan)
+                self.scheduler.done(self.market, new)
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.log.error(f'{self.name} REST exception #{failures}: "{e}"', exc_info=failures == 1)
+                self.scheduler.failed(self.market)
+
+    async def stream(self, event_chan):
+        async with websockets.connect(self.ws_url, max_size=None) as ws:
+            if self.http.recorder is not None:
+                ws = self.http.recorder.wrap_ws(ws, self.ws_url)
+            for sub in self.subscriptions():
+                await ws.send(json.dumps(sub))
+            # Trades that happened while the socket was down
+            await self.backfill(event_chan)
+            self.log.info(f"{self.name} trade stream connected")
+            async for raw in ws:
+                if isinstance(raw, bytes):
+                    raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+                parsed = self.parse_message(json.loads(raw))
+                if not parsed:
                     continue
-                event_chan.put_nowait(trades)
-                last_trade_id = trades[0].id
-        except asyncio.CancelledError:
-            log.debug("Cancelled")
-            break
-        except Exception as e:
-            log.error(f'BitMart exception: "{e}"', exc_info=True)
-            await asyncio.sleep(conf.interval)
-    await s.close()
+                trades, snapshot = parsed
+                if not snapshot and self.has_gap(trades):
+                    self.stats['gaps'] += 1
+                    self.log.warning(f"{self.name} trade stream gap after #{self.last_seq}, backfilling")
+                    await self.backfill(event_chan)
+                await self.emit(trades, event_chan, 'ws')
+                self.failures = 0
+
+    async def run(self, event_chan):
+        self.log.info(f'{self.name} trade listener started')
+        self.failures = 0
+        while True:
+            try:
+                if not self.ws_url:
+                    await self.poll(event_chan)
+                await self.stream(event_chan)
+                raise ConnectionError("Trade stream closed")
+            except asyncio.CancelledError:
+                self.log.debug("Cancelled")
+                break
+            except Exception as e:
+                self.failures += 1
+                self.log.error(f'{self.name} stream exception #{self.failures}: "{e}"', exc_info=self.failures == 1)
+                # Trades are polled until it's time to reconnect
+                try:
+                    await asyncio.wait_for(self.poll(event_chan), timeout=self.backoff.delay(self.failures))
+                except asyncio.TimeoutError:
+                    pass
+
+
+class VitexConnector(CexConnector):
+    "ViteX websocket messages are protobuf encoded, so this one only polls"
+    name = 'ViteX'
+    log_name = 'VX'
+    market = MARKET_VITEX
+    rest_url = 'https://api.vitex.net/api/v2/trades?symbol=IDNA-000_BTC-000'
+    poll_factor = 3
+
+    def raw_id(self, raw: dict) -> int:
+        return int(raw['timestamp'])
+
+    async def fetch(self) -> list[Trade]:
+        # There's no cursor parameter, so a small page is fetched first and the full one only if
+        # all trades on the small page are new
+        raw_trades = []
+        page_sizes = [VITEX_SMALL_PAGE_SIZE, VITEX_PAGE_SIZE] if self.last_id is not None else [VITEX_PAGE_SIZE]
+        for limit in page_sizes:
+            j = await self.get_if_modified(f'{self.rest_url}&limit={limit}', endpoint='vitex')
+            if j is None:
+                return []
+            raw_trades = self.unseen(j['data'])
+            if len(raw_trades) < len(j['data']) or len(j['data']) < limit:
+                break
+        quote_price = self.quote_price()
+        return [Trade.from_vitex(t, quote_price) for t in raw_trades]
+
+
+class ProbitConnector(CexConnector):
+    name = 'ProBit'
+    log_name = 'PB'
+    market = MARKET_PROBIT_USDT
+    market_id = 'IDNA-USDT'
+    ws_url = 'wss://api.probit.com/api/exchange/v1/ws'
+    rest_url = 'https://api.probit.com/api/exchange/v1/trade'
+
+    async def fetch(self) -> list[Trade]:
+        if self.last_time is None:
+            start_time, limit = datetime.utcnow() - timedelta(seconds=PROBIT_BACKFILL_WINDOW), PROBIT_FIRST_PAGE_SIZE
+        else:
+            start_time, limit = self.last_time.replace(tzinfo=None), PROBIT_PAGE_SIZE
+        start_time = start_time.isoformat(timespec='milliseconds')
+        url = f'{self.rest_url}?market_id={self.market_id}&start_time={start_time}Z&end_time=9999-12-21T03:00:00.000Z&limit={limit}'
+        trades = self.unseen((await self.http.get_json(url, endpoint='probit'))['data'])
+        quote_price = self.quote_price()
+        return [Trade.from_probit(t, quote_price, self.market) for t in trades]
+
+    def raw_id(self, raw: dict) -> int:
+        return int(raw['id'].split(":")[1])
+
+    def subscriptions(self) -> list[dict]:
+        return [{'type': 'subscribe', 'channel': 'marketdata', 'market_id': self.market_id,
+                 'interval': 100, 'filter': ['recent_trades']}]
+
+    def parse_message(self, msg: dict) -> tuple[list[Trade], bool] | None:
+        if msg.get('channel') != 'marketdata' or not msg.get('recent_trades'):
+            return None
+        quote_price = self.quote_price()
+        trades = [Trade.from_probit(t, quote_price, self.market) for t in msg['recent_trades']]
+        return trades, msg.get('reset', False)
+
+    def seq(self, trade: Trade) -> int | None:
+        return trade.id
+
+
+class BitmartConnector(CexConnector):
+    name = 'BitMart'
+    log_name = 'BT'
+    market = MARKET_BITMART
+    ws_url = 'wss://ws-manager-compress.bitmart.com/api?protocol=1.1'
+    rest_url = 'https://api-cloud.bitmart.com/spot/v1/symbols/trades?symbol=IDNA_USDT'
+    missed_trades = False  # the last stream message had trades that weren't parsed
+
+    def raw_id(self, raw: dict) -> int:
+        return int(raw['order_time'])
+
+    async def fetch(self) -> list[Trade]:
+        j = await self.get_if_modified(self.rest_url, endpoint='bitmart')
+        if j is None:
+            return []
+        trades = self.unseen(j['data']['trades'])
+        quote_price = self.quote_price()
+        return [Trade.from_bitmart(t, quote_price) for t in trades]
+
+    def subscriptions(self) -> list[dict]:
+        return [{'op': 'subscribe', 'args': ['spot/trade:IDNA_USDT']}]
+
+    def parse_message(self, msg: dict) -> tuple[list[Trade], bool] | None:
+        if msg.get('table') != 'spot/trade' or not msg.get('data'):
+            return None
+        quote_price = self.quote_price()
+        # Trade IDs are millisecond times, trades with only a time in seconds would never match the
+        # REST ones, so they're backfilled instead
+        raw_trades = [t for t in msg['data'] if 'ms_t' in t]
+        self.missed_trades = len(raw_trades) < len(msg['data'])
+        # Stream trades have different field names than the REST ones
+        trades = [Trade.from_bitmart({'order_time': int(t['ms_t']), 'count': t['size'],
+                                      'price': t['price'], 'type': t['side']}, quote_price)
+                  for t in raw_trades]
+        return trades, False
+
+    def has_gap(self, trades: list[Trade]) -> bool:
+        return self.missed_trades
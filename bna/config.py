@@ -12,8 +12,11 @@ class CexConfig:
 
 @dataclass
 class BscConfig:
-    # After this many seconds a transfer is considerd finalized and sent to `event_chan`
-    transfer_delay: int = 5
+    # After this many seconds a transfer is sent to `event_chan`. Blocks that change later are
+    # revised by the listener, so this only needs to cover logs that arrive after the block
+    transfer_delay: int = 1
+    # Sent blocks are kept for this many blocks to revise them if they get reorged
+    reorg_window: int = 50
     # Expect a message at least this often
     ws_event_timeout: int = 60
 
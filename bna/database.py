@@ -1,16 +1,21 @@
 from decimal import Decimal
 import os
 import json
-import time
 from dacite import from_dict
 from dataclasses import asdict
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 from bna.config import Config
 from bna.pg_store import PgStore
+from bna.price_service import PriceService
 from bna.transfer import Transfer
+from bna.write_behind import WriteBehind
+from bna.snapshot import Snapshot
 from bna.event import event_from_dict
 from bna.cex_listeners import Trade
+from bna.identity_diff import IdentityChangeSet
+from bna.pool_index import PoolIndex
+from bna.utils import utc_now
 
 INTERESTING_ADDRESS_TYPES = ['premine', 'foundation']
 
@@ -18,20 +23,28 @@ class Database:
     def __init__(self, log, conf_path):
         self.log = log.getChild("DB")
         self.cache = {'transfers': {}, 'trades': {}, 'identities': {}}
+        self.pools = PoolIndex()
+        self.identities_version = 0  # bumped on every full identity refresh
         self.oldest_cached_tf = datetime.max
         self.oldest_cached_tr = datetime.max
         self.oldest_cached_tf = self.oldest_cached_tf.replace(tzinfo=timezone.utc)
         self.oldest_cached_tr = self.oldest_cached_tr.replace(tzinfo=timezone.utc)
-        self.cache_cleaned_at = datetime.now(tz=timezone.utc)
+        self.clock = utc_now
+        self.cache_cleaned_at = self.clock()
         self.test_cache = True
         self.conf_path = conf_path
         self.conf: Config = self.get_config()
         self.store = PgStore(os.environ['POSTGRES_CONNSTRING'], self.log)
+        # Transfers and trades are cached right away and written to the store in the background
+        self.writes = WriteBehind(self.log, self.store.insert_batch, tables=('transfers', 'trades'))
+        # Kept next to the config, which is on a persistent volume in Docker
+        self.snapshot = Snapshot(self, self.log, os.path.join(os.path.dirname(conf_path) or '.', 'snapshot.pickle'))
+        self.known_version = 0  # bumped when known addresses are reloaded, rendered messages depend on them
         self._load_known_addresses()
         # This is updated by the price oracle almost immediately.
         # @TODO: This probably shouldn't be in this class.
-        self.prices = {'cg:bitcoin': 22000, 'cg:idena': 0.035, 'cg:binancecoin': 300, 'cg:binance-usd': 1, 'cg:tether': 1,
-                       'ds:0x331ad6a9372d09d6ecb19399cda6634755c4460b': 0.0013}
+        self.prices = PriceService(self.log, {'cg:bitcoin': 22000, 'cg:idena': 0.035, 'cg:binancecoin': 300, 'cg:binance-usd': 1, 'cg:tether': 1,
+                                              'ds:0x331ad6a9372d09d6ecb19399cda6634755c4460b': 0.0013}, store=self.store)
 
     def get_config(self) -> Config:
         if os.path.exists(self.conf_path):
@@ -56,11 +69,24 @@ class Database:
     async def connect(self, drop_existing=False):
         self.log.debug("Connecting to the backing store")
         await self.store.connect(drop_existing)
-        self.log.debug("Prefetching identities")
-        self.cache['identities'] = await self.store.get_identities()
+        # The store is reconciled with the snapshot in the background
+        if drop_existing or not self.snapshot.load():
+            self.log.debug("Prefetching identities")
+            self.cache['identities'] = await self.store.get_identities()
+        self.pools.rebuild(self.cache['identities'])
+        self.log.debug("Loading delegation ledger")
+        for tf in await self.store.get_pool_transfers():
+            self.pools.record(tf)
+        self.pools.forget_before(self.clock() - timedelta(seconds=self.conf.db.cached_record_age_limit * 8))
+        for tf in self.cache['transfers'].values():
+            self.pools.record(tf)
+        self.log.debug("Loading price history")
+        await self.prices.load()
+        self.writes.start()
+        self.snapshot.start()
 
     async def recent_transfers(self, period: int) -> list[Transfer]:
-        after = datetime.now(tz=timezone.utc) - timedelta(seconds=period)
+        after = self.clock() - timedelta(seconds=period)
         if after < self.oldest_cached_tf:# or self.disable_transfer_cache:
             return await self.fetch_transfers(after)
 
@@ -71,8 +97,15 @@ class Database:
         self.clean_cache()
         return cached_tfs
 
+    async def recent_pool_transfers(self, period: int) -> list[Transfer]:
+        "Delegations, undelegations and kills with a known pool"
+        after = self.clock() - timedelta(seconds=period)
+        if after < self.oldest_cached_tf:
+            return [tf for tf in await self.fetch_transfers(after) if tf.meta.get('pool')]
+        return self.pools.recent(after)
+
     async def recent_trades(self, start: datetime, period: int) -> list[Trade]:
-        now = datetime.now(tz=timezone.utc)
+        now = self.clock()
         period = timedelta(seconds=period)
         if now - start > period:
             start = now - period
@@ -89,18 +122,22 @@ class Database:
     async def fetch_transfers(self, after: datetime) -> list[Trade]:
         self.log.debug(f'Fetching transfers since {after=}')
         tfs = await self.store.get_transfers(after)
-        if after.timestamp() < time.time() - (self.conf.db.cached_record_age_limit * 8):# or self.disable_transfer_cache:
+        tfs.update((k, tf) for k, tf in self.writes.pending['transfers'].items() if tf.timeStamp > after)
+        if after.timestamp() < self.clock().timestamp() - (self.conf.db.cached_record_age_limit * 8):# or self.disable_transfer_cache:
             self.log.debug(f'Records too old to store')
             pass
         else:
             self.cache['transfers'].update(tfs)
+            for tf in tfs.values():
+                self.pools.record(tf)
             self.oldest_cached_tf = after
         return list(tfs.values())
 
     async def fetch_trades(self, start: datetime) -> list[Trade]:
         self.log.debug(f'Fetching trades since {start=}')
         trs = await self.store.get_trades(start)
-        if start.timestamp() < time.time() - (self.conf.db.cached_record_age_limit * 8):
+        trs.update((k, tr) for k, tr in self.writes.pending['trades'].items() if tr.timeStamp > start)
+        if start.timestamp() < self.clock().timestamp() - (self.conf.db.cached_record_age_limit * 8):
             pass
         else:
             self.cache['trades'].update(trs)
@@ -113,7 +150,8 @@ class Database:
                 self.log.warning(f'Block number and index collision on hash={tf.hash}')
             # if not self.disable_transfer_cache:
             self.cache['transfers'][(tf.blockNumber, tf.logIndex)] = tf
-        await self.store.insert_transfers(tfs)
+            self.pools.record(tf)
+        await self.writes.put('transfers', {(tf.blockNumber, tf.logIndex): tf for tf in tfs})
 
     async def insert_trades(self, trs: list[Trade]):
         for tr in trs:
@@ -121,53 +159,92 @@ class Database:
                 pass
             # if not self.disable_transfer_cache:
             self.cache['trades'][(tr.id, tr.market)] = tr
-        await self.store.insert_trades(trs)
+        await self.writes.put('trades', {(tr.id, tr.market): tr for tr in trs})
 
     async def insert_identity(self, ident: dict):
+        self.pools.update(self.cache['identities'].get(ident['address'].lower()), ident)
         self.cache['identities'][ident['address'].lower()] = ident
         await self.store.insert_identities([ident])
 
     async def insert_identities(self, idents: list[dict], full=False):
         if not full:
+            for ident in idents:
+                self.pools.update(self.cache['identities'].get(ident['address'].lower()), ident)
             self.cache['identities'].update(dict(map(lambda ident: (ident['address'].lower(), ident), idents)))
         else:
             del self.cache['identities']
             self.cache['identities'] = dict(map(lambda ident: (ident['address'].lower(), ident), idents))
+            self.identities_version += 1
+            self.pools.rebuild(self.cache['identities'])
         await self.store.insert_identities(idents, full=full)
 
+    async def insert_identity_changes(self, changes: IdentityChangeSet):
+        "Caches all fetched identities, but only writes the ones that changed"
+        idents = {ident['address'].lower(): ident for ident in changes.idents}
+        for change in changes.changes:
+            self.pools.update(change.prev, change.ident)
+        for addr in changes.removed:
+            self.pools.remove(self.cache['identities'][addr])
+        if changes.full:
+            self.cache['identities'] = idents
+            self.identities_version += 1
+        else:
+            self.cache['identities'].update(idents)
+        if changes.changes:
+            await self.store.insert_identities([ch.ident for ch in changes.changes])
+        if changes.removed:
+            await self.store.remove_identities(changes.removed)
+
     async def insert_event(self, msg, ev):
         await self.store.insert_event(chan_id=msg.channel.id, msg_id=msg.id, ev_dict=ev.to_dict())
 
     def get_identity(self, addr: str) -> dict:
         return self.cache['identities'].get(addr.lower())
 
+    def pool_of(self, addr: str) -> str | None:
+        return self.pools.pool_of(addr.lower(), self.cache['identities'])
+
     def get_identities(self) -> list[dict]:
         return self.cache['identities']
 
     async def get_transfer(self, tx_hash: str) -> Transfer:
+        await self.writes.flush()
         return (await self.store.get_transfers_by_hash([tx_hash]))[0]
 
     async def get_transfers(self, tx_hashes: list[str]) -> list[Transfer]:
+        await self.writes.flush()
         return await self.store.get_transfers_by_hash(tx_hashes)
 
-    async def get_event(self, ev_id: int):
+    async def get_event(self, ev_id: int, lazy: bool = False):
+        "With `lazy` the event's transfers are loaded later, page by page"
         self.log.debug(f"Getting event {ev_id=}")
         chan_id, msg_id, ev_dict = await self.store.get_event(ev_id)
         if not ev_dict:
             return None, None, None
         try:
-            ev = await event_from_dict(ev_dict, db=self)
+            ev = await event_from_dict(ev_dict, db=self, lazy=lazy)
         except Exception as e:
             self.log.error(f'Error parsing event {ev_dict=}: {e}', exc_info=True)
             return None, None, None
         return chan_id, msg_id, ev
 
     async def get_last_block(self, chain: str) -> int:
-        return await self.store.get_latest_block(chain)
+        await self.writes.flush()
+        stored = await self.store.get_latest_block(chain)
+        # Blocks in a snapshot of a crashed run may not have made it to the store
+        return max(filter(None, [stored, self.snapshot.cursors.get(chain)]), default=None)
 
     async def close(self):
         self.log.info("Closing DB connections...")
         self.save_config()
+        try:
+            await self.writes.close()
+        except Exception as e:
+            self.log.error(f"Failed to write {len(self.writes)} pending records: {e}", exc_info=True)
+        try:
+            await self.snapshot.close()
+        except Exception as e:
+            self.log.error(f"Failed to save snapshot: {e}", exc_info=True)
         await self.store.close()
         self.log.info("DB connections stopped")
 
@@ -198,20 +275,31 @@ class Database:
     def count_identities_with_age(self, age: int):
         return sum(1 for _ in filter(lambda i: i.get('age', 0) >= age, self.cache['identities'].values()))
 
+    async def remove_transfers(self, tfs: list[Transfer]):
+        "Removes transfers that were reorged out of the chain"
+        # Holding the flush lock, so that none of them are being written while they're removed
+        async with self.writes.lock:
+            for tf in tfs:
+                self.writes.discard('transfers', (tf.blockNumber, tf.logIndex))
+                self.cache['transfers'].pop((tf.blockNumber, tf.logIndex), None)
+            await self.store.remove_transfers(tfs)
+
     async def _remove_transfer(self, tf: Transfer):
         "For testing only"
+        self.writes.discard('transfers', (tf.blockNumber, tf.logIndex))
         await self.store._remove_transfer(tf)
         if (tf.blockNumber, tf.logIndex) in self.cache['transfers']:
             del self.cache['transfers'][(tf.blockNumber, tf.logIndex)]
 
     async def _remove_trade(self, tr: Trade):
         "For testing only"
+        self.writes.discard('trades', (tr.id, tr.market))
         await self.store._remove_trade(tr)
         if (tr.id, tr.market) in self.cache['trades']:
             del self.cache['trades'][(tr.id, tr.market)]
 
     def clean_cache(self):
-        now = datetime.now(tz=timezone.utc)
+        now = self.clock()
         record_age_limit = timedelta(seconds=self.conf.db.cached_record_age_limit * 8)
         if now - timedelta(seconds=60) < self.cache_cleaned_at:
             return
@@ -225,6 +313,7 @@ class Database:
             if now - tr.timeStamp < record_age_limit:
                 new_cache['trades'][k] = tr
         self.cache = new_cache
+        self.pools.forget_before(now - record_age_limit)
         self.cache_cleaned_at = now
         self.log.debug(f"Cleaned cache, sizes after:   tf={len(self.cache['transfers'])}\ttr={len(self.cache['trades'])}")
 
@@ -241,3 +330,4 @@ class Database:
         self.known_by_type = defaultdict(dict)
         for addr, info in self.known.items():
             self.known_by_type[info['type']][addr] = info
+        self.known_version += 1
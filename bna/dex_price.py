@@ -0,0 +1,121 @@
+import time
+from logging import Logger
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from bna.database import Database
+from bna.transfer import BscLog
+
+GET_RESERVES_SELECTOR = "0x0902f1ac"
+VWAP_WINDOW = 20  # blocks, about a minute on BSC
+MIN_LIQUIDITY_USD = 1000  # prices of pools with less liquidity are too easy to move
+LIVE_TIMEOUT = 120  # seconds without new heads before the price is no longer considered live
+
+
+@dataclass
+class PoolReserves:
+    idna: float
+    token: float
+    token_addr: str
+    block: int
+
+
+class DexPriceEngine:
+    """
+    Derives the iDNA price from the reserves of the known DEX pools, which are kept up to date
+    with the pools' Sync events. The price is volume weighted over the last `VWAP_WINDOW` blocks,
+    with volume approximated by reserve changes. Without trades in the window it's weighted by
+    pool liquidity instead. Pool tokens are valued with the price service.
+    """
+    def __init__(self, db: Database, log: Logger, idna_token: str, price_id: str = 'cg:idena',
+                 clock: Callable[[], float] = time.time):
+        self.db = db
+        self.log = log.getChild("DP")
+        self.idna_token = idna_token
+        self.price_id = price_id
+        self.clock = clock
+        self.reserves: dict[str, PoolReserves] = {}
+        self.trades: deque[tuple[int, float, float]] = deque()  # (block, usd price, idna volume)
+        self.last_price: float = None
+        self.head_seen_at = 0
+
+    def set_reserves(self, pool_addr: str, reserve0: int, reserve1: int, block: int) -> PoolReserves | None:
+        pool = self.db.known.get(pool_addr)
+        if pool is None or pool.get('type') != 'pool':
+            return None
+        if pool['token0'] == self.idna_token:
+            token_addr, reserve_idna, reserve_token = pool['token1'], reserve0, reserve1
+        elif pool['token1'] == self.idna_token:
+            token_addr, reserve_idna, reserve_token = pool['token0'], reserve1, reserve0
+        else:
+            return None
+        decimals = self.db.known.get(token_addr, {}).get('decimals', 18)
+        res = PoolReserves(reserve_idna / 10**18, reserve_token / 10**decimals, token_addr, block)
+        self.reserves[pool_addr] = res
+        return res
+
+    def token_price(self, res: PoolReserves) -> float | None:
+        price_id = self.db.known.get(res.token_addr, {}).get('price_id')
+        return self.db.prices.get(price_id) if price_id else None
+
+    def spot_price(self, res: PoolReserves) -> float | None:
+        token_price = self.token_price(res)
+        if not token_price or not res.idna:
+            return None
+        return res.token / res.idna * token_price
+
+    def liquidity_usd(self, res: PoolReserves) -> float:
+        token_price = self.token_price(res)
+        return 2 * res.token * token_price if token_price else 0
+
+    def price(self) -> float | None:
+        volume = sum(v for _, _, v in self.trades)
+        if volume:
+            return sum(p * v for _, p, v in self.trades) / volume
+        weighted = [(self.spot_price(res), self.liquidity_usd(res)) for res in self.reserves.values()]
+        weighted = [(p, l) for p, l in weighted if p and l >= MIN_LIQUIDITY_USD]
+        liquidity = sum(l for _, l in weighted)
+        if not liquidity:
+            return None
+        return sum(p * l for p, l in weighted) / liquidity
+
+    def process_syncs(self, syncs: list[BscLog], block: int, timestamp: float):
+        "Applies the Sync events of a final block and updates the price"
+        for log in sorted(syncs, key=lambda l: l.logIndex):
+            old = self.reserves.get(log.address)
+            res = self.set_reserves(log.address, int(log.data[2:66], 16), int(log.data[66:130], 16), block)
+            if old is None or res is None or self.liquidity_usd(res) < MIN_LIQUIDITY_USD:
+                continue
+            volume = abs(res.idna - old.idna)
+            price = self.spot_price(res)
+            if volume and price:
+                self.trades.append((block, price, volume))
+        while self.trades and self.trades[0][0] <= block - VWAP_WINDOW:
+            self.trades.popleft()
+        self.update(timestamp)
+
+    def update(self, timestamp: float):
+        price = self.price()
+        if price is None:
+            return
+        self.last_price = price
+        self.db.prices.update(self.price_id, price, timestamp)
+
+    async def load(self, rpc_req: Callable[..., Awaitable]):
+        "Fetches current reserves of all known pools, so there's a price before the first Sync"
+        for pool_addr in self.db.known_by_type['pool'].keys():
+            try:
+                result = await rpc_req('eth_call', [{'to': pool_addr, 'data': GET_RESERVES_SELECTOR}, 'latest'], allow_none=False)
+                self.set_reserves(pool_addr, int(result[2:66], 16), int(result[66:130], 16), block=0)
+            except Exception as e:
+                self.log.error(f"Failed to fetch reserves of {pool_addr}: {e}")
+        self.update(self.clock())
+        self.log.info(f"Loaded reserves of {len(self.reserves)} pools, price: {self.last_price}")
+
+    def seen_head(self):
+        self.head_seen_at = self.clock()
+
+    def is_live(self) -> bool:
+        "The BSC listener is receiving blocks and the price is known"
+        return self.last_price is not None and self.clock() - self.head_seen_at < LIVE_TIMEOUT
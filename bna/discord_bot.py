@@ -1,3 +1,4 @@
+import io
 import os
 import time
 import json
@@ -7,7 +8,7 @@ from logging import Logger
 from functools import wraps
 from datetime import datetime, timezone, timedelta
 from disnake import Embed, Color
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from itertools import chain
 from disnake.ext import commands
 
@@ -17,10 +18,19 @@ from bna.config import Config, DiscordBotConfig
 from bna.tags import *
 from bna.event import *
 from bna.tracker import Tracker
+from bna.event_bus import EventBus
+from bna.http_client import HttpClient
+from bna.metrics import COMMAND_LATENCY, HOT_PATH_LATENCY, timed
+from bna.poll_scheduler import PollScheduler
+from bna.pool_index import Pool
+from bna.reward_model import IdentityRank
+from bna.profiler import SamplingProfiler
+from bna.publisher import PublishScheduler
 from bna.transfer import CHAIN_BSC, CHAIN_IDENA, Transfer
 from bna.utils import any_in, average_color, shorten, get_identity_color, trade_color
 
 MAX_PUBLISH_ATTEMPTS = 3
+DESCRIBE_CACHE_SIZE = 10000  # transfer descriptions kept for re-rendering messages and pages
 
 
 class Bot:
@@ -32,6 +42,9 @@ class Bot:
         self.db = db
         self.dev_user = dev_user
         self.tracker: Tracker = None
+        self.bus: EventBus = None
+        self.http: HttpClient = None
+        self.poll_scheduler: PollScheduler = None
         self.bsc_listener: BscListener = None
         self.idena_listener: IdenaListener = None
         self.log = log.getChild('DI')
@@ -40,13 +53,21 @@ class Bot:
         queue_size = max(16, self.conf.user_ratelimit_command_number)  # large size to allow for variable sleep length
         self.user_cmd_times = defaultdict(lambda: deque(maxlen=queue_size))  # TODO: leaks slowly
         self.activity = {'block': {CHAIN_IDENA: 0, CHAIN_BSC: 0}}
-        self.last_activity_update = time.time()
+        self.scheduler = PublishScheduler(self.log, max_attempts=MAX_PUBLISH_ATTEMPTS)
         # Cache of events and messages. Items and their buttons are removed after two days
         self.ev_to_msg: dict[int, (Event, disnake.Message)] = {}
+        # Events with a scheduled message that wasn't sent yet, new events are joined into them
+        self.pending_events: dict[int, Event] = {}
+        # Events whose message is being sent, and the ones of them that had transfers reverted meanwhile
+        self.sending_events: dict[int, Event] = {}
+        self.retracted_while_sending: set[int] = set()
+        # Transfer descriptions by `describe_key`, least recently used first
+        self.describe_cache: OrderedDict[tuple, dict] = OrderedDict()
         self.event_cache_cleaned_at = datetime.now(tz=timezone.utc)
 
     async def run_publisher(self, tracker_event_chan: asyncio.Queue):
         self.log.info("Publisher started")
+        scheduler_task = asyncio.create_task(self.scheduler.run(), name="publish_scheduler")
         start = datetime.now()
         while True:
             try:
@@ -65,6 +86,7 @@ class Bot:
                     break
                 self.log.error(f"Tracker sent bad events {ev=}: e", exc_info=True)
                 pass
+        scheduler_task.cancel()
         self.log.debug("Cancelled")
 
     async def send_response(self, msg: disnake.CommandInteraction, resp: dict):
@@ -93,62 +115,165 @@ class Bot:
         times.append(time.time())
         return not self.stopped
 
+    @timed(HOT_PATH_LATENCY)
     async def publish_event(self, ev: Event):
-        attempt = 0
-        while attempt < MAX_PUBLISH_ATTEMPTS:
-            try:
-                if type(ev) != BlockEvent:
-                    self.log.debug(f"Publishing event {ev=}")
-                if type(ev) in [DexEvent, MassPoolEvent, PoolEvent, CexEvent, TransferEvent]:
-                    try:
-                        if await self.replace_recent(ev):
-                            await asyncio.sleep(0.5)
-                            break
-                    except disnake.errors.NotFound:
-                        self.log.warning(f"Message not found for event {ev=}, publishing new one")
-                        pass
-                await self._publish_event(ev)
-                if type(ev) != BlockEvent:
-                    await asyncio.sleep(0.5)
-                break
-            except Exception as e:
-                self.log.error(f"Publish error: {e}", exc_info=True)
-                if ev.id in self.ev_to_msg:
-                    self.log.warning(f"Error happened but event got published: {ev['_id']}")
-                    break
-                await asyncio.sleep(5)
-                attempt += 1
+        "Joins `ev` into a recent message if possible, otherwise schedules a new message for it"
+        if type(ev) != BlockEvent:
+            self.log.debug(f"Publishing event {ev=}")
+        if type(ev) == RetractEvent:
+            self.retract(ev)
+            return
+        if type(ev) in [DexEvent, MassPoolEvent, PoolEvent, CexEvent, TransferEvent]:
+            if self.replace_recent(ev):
+                return
+        await self._publish_event(ev)
 
     async def _publish_event(self, ev: Event):
-        msg = None
+        build_message = None
         if type(ev) == StatsEvent:
-            msg = self.build_stats_message(ev)
+            build_message = self.build_stats_message
         elif type(ev) in [TransferEvent, DexEvent, InterestingTransferEvent]:
-            msg = self.build_transfer_message(ev)
+            build_message = self.build_transfer_message
         elif type(ev) == KillEvent:
-            msg = self.build_kill_message(ev)
+            build_message = self.build_kill_message
         elif type(ev) == MassPoolEvent:
-            msg = self.build_mass_pool_message(ev)
+            build_message = self.build_mass_pool_message
         elif type(ev) == CexEvent:
-            msg = self.build_cex_trade_message(ev)
+            build_message = self.build_cex_trade_message
         elif type(ev) == ClubEvent:
-            msg = self.build_club_message(ev)
+            build_message = self.build_club_message
         elif type(ev) == BlockEvent:
             await self.update_activity(ev)
         else:
             self.log.warning(f"Unknown event type: {ev=}")
-        if msg:
-            sent_msg = await self.send_notification(msg)
-            await self.save_event(ev, sent_msg)
+        if build_message:
+            # Rendered when the send runs, so events joined into it until then are in the message
+            self.pending_events[ev.id] = ev
+            self.scheduler.send(f'send:{self.conf.notif_channel}', lambda: self._send_event_message(ev, build_message))
         await self.clean_event_cache()
 
-    async def replace_recent(self, new_ev: DexEvent | MassPoolEvent | TransferEvent) -> bool:
+    async def _send_event_message(self, ev: Event, build_message):
+        self.pending_events.pop(ev.id, None)
+        if self.retractable(ev) and self.event_empty(ev):
+            self.log.info(f"Not sending event {ev.id}, all of its transfers were reverted")
+            return
+        self.sending_events[ev.id] = ev
+        try:
+            sent_msg = await self.send_notification(build_message(ev))
+        except Exception:
+            # Retried by the scheduler, until then it can still be joined
+            self.pending_events[ev.id] = ev
+            self.retracted_while_sending.discard(ev.id)
+            raise
+        finally:
+            del self.sending_events[ev.id]
+        # Saving isn't part of the send, a failed insert mustn't send the message again
+        try:
+            await self.save_event(ev, sent_msg)
+        except Exception as e:
+            self.log.error(f"Failed to save event {ev.id}: {e}", exc_info=True)
+        if ev.id in self.retracted_while_sending:
+            self.retracted_while_sending.discard(ev.id)
+            if sent_msg:
+                self.update_retracted(ev, sent_msg)
+
+    async def _edit_event_message(self, ev: Event, msg: disnake.Message, build_message):
+        "Renders the current state of `ev` into its message, runs from the publish scheduler"
+        try:
+            await msg.edit(**build_message(ev))
+        except disnake.errors.NotFound:
+            self.log.warning(f"Message not found for event {ev=}, publishing new one")
+            self.ev_to_msg.pop(ev.id, None)
+            await self._publish_event(ev)
+            return
+        await self.save_event(ev, msg)
+
+    async def _delete_event_message(self, msg: disnake.Message):
+        try:
+            await msg.delete()
+        except disnake.errors.NotFound:
+            pass
+
+    def message_builder(self, ev: Event):
+        if type(ev) == KillEvent:
+            return self.build_kill_message
+        if type(ev) == MassPoolEvent:
+            return self.build_mass_pool_message
+        return self.build_transfer_message
+
+    def retract_args(self, ev: Event, hashes: set[str]) -> tuple:
+        return (hashes, self.db.known) if type(ev) == DexEvent else (hashes,)
+
+    def retractable(self, ev: Event) -> bool:
+        return isinstance(ev, (TransferEvent, MassPoolEvent))
+
+    def event_empty(self, ev: TransferEvent | MassPoolEvent) -> bool:
+        return len(ev.changes) == 0 if type(ev) == MassPoolEvent else len(ev.tfs) == 0
+
+    def retract(self, retract_ev: RetractEvent):
+        """
+        Takes reverted transfers out of events. Messages that weren't sent yet are rendered without them,
+        published ones are edited, or deleted if they only showed reverted transfers. Events that come
+        after `retract_ev` were generated after the revert, so transfers re-added with the same hashes
+        aren't affected.
+        """
+        hashes = set(retract_ev.hashes)
+        for ev in self.pending_events.values():
+            if self.retractable(ev):
+                ev.retract(*self.retract_args(ev, hashes))
+        for ev_id, ev in self.sending_events.items():
+            if self.retractable(ev) and ev.retract(*self.retract_args(ev, hashes)):
+                self.retracted_while_sending.add(ev_id)
+        for ev_id, (ev, msg) in list(self.ev_to_msg.items()):
+            if not self.retractable(ev) or not msg or not self.event_loaded(ev):
+                continue
+            if ev.retract(*self.retract_args(ev, hashes)):
+                self.update_retracted(ev, msg)
+
+    def update_retracted(self, ev: TransferEvent | MassPoolEvent, msg: disnake.Message):
+        if self.event_empty(ev):
+            self.log.info(f"Deleting message {msg.id} of event {ev.id}, its transfers were reverted")
+            self.ev_to_msg.pop(ev.id, None)
+            # Replaces a pending edit of the message, if there is one
+            self.scheduler.edit(f'edit:{msg.channel.id}', msg.id, lambda: self._delete_event_message(msg))
+        else:
+            self.log.info(f"Editing message {msg.id} of event {ev.id}, some of its transfers were reverted")
+            self.schedule_edit(ev, msg, self.message_builder(ev))
+
+    def schedule_edit(self, ev: Event, msg: disnake.Message, build_message):
+        if self.scheduler.edit(f'edit:{msg.channel.id}', msg.id, lambda: self._edit_event_message(ev, msg, build_message)):
+            self.log.debug(f"Coalesced edit of message {msg.id} for event {ev.id}")
+
+    def join_pending(self, new_ev: DexEvent | MassPoolEvent | TransferEvent) -> bool:
+        "Joins `new_ev` into an event whose message wasn't sent yet, it's rendered when it's sent"
+        for ev in self.pending_events.values():
+            if type(ev) != type(new_ev):
+                continue
+            if type(ev) in [MassPoolEvent, PoolEvent] and ev.can_join(new_ev):
+                ev.join(new_ev)
+            elif type(ev) == DexEvent and ev.can_join(new_ev):
+                ev.join(new_ev, self.db.known)
+            elif type(ev) == CexEvent:
+                ev.join(new_ev, self.db.prices)
+            elif type(ev) == TransferEvent and ev.can_join(new_ev):
+                ev.join(new_ev)
+            else:
+                continue
+            self.log.debug(f"Joined event {new_ev.id} into pending event {ev.id}")
+            return True
+        return False
+
+    def replace_recent(self, new_ev: DexEvent | MassPoolEvent | TransferEvent) -> bool:
+        if self.join_pending(new_ev):
+            return True
         for ev_id, (ev, msg) in self.ev_to_msg.items():
             if new_ev.id == ev.id:
                 self.log.warning(f"Event {ev_id} already published, {ev=}")
                 # continue
             if type(ev) != type(new_ev):
                 continue
+            if not self.event_loaded(ev):
+                continue  # rehydrated from the database for its buttons, can't be joined
             if type(ev) in [MassPoolEvent, PoolEvent]:
                 if datetime.now(tz=timezone.utc) - msg.created_at > timedelta(seconds=self.conf.pool_event_replace_period):
                     continue
@@ -158,23 +283,19 @@ class Bot:
 
             if type(ev) in [MassPoolEvent, PoolEvent] and ev.can_join(new_ev):
                 ev.join(new_ev)
-                await msg.edit(**self.build_mass_pool_message(ev))
-                await self.save_event(ev, msg)
+                self.schedule_edit(ev, msg, self.build_mass_pool_message)
                 return True
             elif type(ev) == DexEvent and ev.can_join(new_ev):
                 ev.join(new_ev, self.db.known)
-                await msg.edit(**self.build_transfer_message(ev))
-                await self.save_event(ev, msg)
+                self.schedule_edit(ev, msg, self.build_transfer_message)
                 return True
             elif type(ev) == CexEvent:
                 ev.join(new_ev, self.db.prices)
-                await msg.edit(**self.build_cex_trade_message(ev))
-                await self.save_event(ev, msg)
+                self.schedule_edit(ev, msg, self.build_cex_trade_message)
                 return True
             elif type(ev) == TransferEvent and ev.can_join(new_ev):
                 ev.join(new_ev)
-                await msg.edit(**self.build_transfer_message(ev))
-                await self.save_event(ev, msg)
+                self.schedule_edit(ev, msg, self.build_transfer_message)
                 return True
         return False
 
@@ -350,6 +471,25 @@ class Bot:
         comps = [disnake.ui.Button(label='Show identities', style=disnake.ButtonStyle.blurple, custom_id=f'{ev.id}:show_idents')]
         return {'embed': e, 'components': comps}
 
+    def event_loaded(self, ev: Event) -> bool:
+        if isinstance(ev, MassPoolEvent):
+            return all(transfers_loaded(ch.tfs) for ch in ev.changes)
+        if isinstance(ev, TransferEvent):
+            return transfers_loaded(ev.tfs)
+        return True
+
+    async def load_event_page(self, ev: Event, start_index: int, lines: int):
+        "Loads transfers shown on a page of a rehydrated event's list message"
+        if isinstance(ev, TopEvent):
+            tfs = ev.items
+        elif isinstance(ev, TransferEvent):
+            tfs = ev.tfs
+        else:
+            return
+        if isinstance(tfs, LazyTransfers):
+            start_index = max(0, min(start_index, len(tfs) - lines))
+            await tfs.load(self.db, start_index, start_index + lines)
+
     def build_ident_list_embed(self, ev: MassPoolEvent, start_index: int, lines: int = 10) -> disnake.Embed:
         if ev.subtype == 'kill':
             color = Color.dark_red()
@@ -376,14 +516,14 @@ class Bot:
     def build_tf_list_embed(self, ev: TransferEvent, start_index: int, lines: int = 10) -> disnake.Embed:
         title = 'Transactions (oldest first)'
         tf_text = ""
-        tfs = ev.tfs[start_index:]
-        for i, tf in enumerate(tfs):
+        remaining = len(ev.tfs) - start_index
+        for i, tf in enumerate(ev.tfs[start_index:start_index + lines]):
             dtf = self.describe_tf(tf, ev_by=ev.by)
             tf_text += '\n' if i != 0 else ''
             price = f" _(at ${tf.meta.get('usd_price', 0):,.4f})_" if tf.meta.get('usd_price') is not None else ''
             tf_text += f"{i+1+start_index}\. {dtf['short']}{price}"
-            if i >= (lines - 1) and len(tfs) > lines:
-                tf_text += f'\nAnd {len(tfs) - lines:,} more'
+            if i >= (lines - 1) and remaining > lines:
+                tf_text += f'\nAnd {remaining - lines:,} more'
                 break
         em = Embed(title=title, description=tf_text, color=ev._color)
         return em
@@ -436,38 +576,60 @@ class Bot:
         em.add_field('Stake', f"{ev.stake:,.0f} iDNA", inline=True)
         return {'embed': em}
 
-    def build_rank_message(self, ident: dict, rewards: float) -> dict:
-        addr = ident['address']
+    def build_rank_message(self, rank: IdentityRank) -> dict:
+        addr = rank.addr
         title = f'Rank of {shorten(addr)}'
-        network_size = self.db.count_alive_identities()
-        self.log.debug(f"{network_size=}")
+        network_size = max(rank.network_size, 1)
 
         color = get_identity_color(addr)
         em = Embed(color=color, title=title, url=f'https://scan.idena.io/identity/{addr}')
         em.set_thumbnail(f'https://robohash.idena.io/{addr}')
 
-        stake = Decimal(ident['stake'])
-        rank = self.db.count_identities_with_stake(stake)
-        stake = int(stake)  # to round down
-        perc = rank / network_size * 100
-        em.add_field('Stake', f'**{stake:,.0f}** iDNA – **#{rank}** (top **{perc:.2f}%**)', inline=False)
+        stake = int(rank.stake)  # to round down
+        perc = rank.stake_rank / network_size * 100
+        em.add_field('Stake', f'**{stake:,.0f}** iDNA – **#{rank.stake_rank}** (top **{perc:.2f}%**)', inline=False)
 
-        age = int(ident['age'])
-        rank = self.db.count_identities_with_age(age)
-        perc = rank / network_size * 100
-        em.add_field('Age', f'**{age:,.0f}** epochs – **#{rank}** (top **{perc:.2f}%**)', inline=False)
+        perc = rank.age_rank / network_size * 100
+        em.add_field('Age', f'**{rank.age:,.0f}** epochs – **#{rank.age_rank}** (top **{perc:.2f}%**)', inline=False)
 
-        rewards = f'**{rewards[0]:,.0f}** iDNA (**{rewards[1]:.1f}%** APY)'
-        if ident['state'] in ['Newbie', 'Verified', 'Human']:
+        rewards = f'**{rank.rewards:,.0f}** iDNA (**{rank.apy:.1f}%** APY)'
+        if rank.state in ['Newbie', 'Verified', 'Human']:
             em.add_field('Epoch rewards', f'{rewards}', inline=False)
         else:
-            em.add_field('Epoch rewards', f'~~{rewards}~~ ({ident["state"]})', inline=False)
+            em.add_field('Epoch rewards', f'~~{rewards}~~ ({rank.state})', inline=False)
 
         return {'embed': em}
 
+    def build_pool_message(self, pool: Pool, hours: int = 24) -> dict:
+        addr = pool.addr
+        info = self.db.known.get(addr, {})
+        name = info.get('name') if not info.get('hidden', False) else None
+        em = Embed(color=get_identity_color(addr), title=f"Pool {name if isinstance(name, str) else shorten(addr)}",
+                   url=f'https://scan.idena.io/pool/{addr}')
+        em.set_thumbnail(f'https://robohash.idena.io/{addr}')
+        em.add_field('Status', 'Online' if pool.online else 'Offline', inline=True)
+        em.add_field('Delegators', f'**{len(pool.delegators):,}** (**{pool.mining:,}** mining)', inline=True)
+        em.add_field('Total stake', f'**{pool.stake:,.0f}** iDNA', inline=True)
+        em.add_field('Total age', f'**{pool.age:,}** epochs', inline=True)
+
+        after = datetime.now(tz=timezone.utc) - timedelta(hours=hours)
+        counts = {'delegate': 0, 'undelegate': 0, 'kill': 0}
+        for tf in self.db.pools.recent(after):
+            if tf.meta.get('pool') != addr:
+                continue
+            for tag in counts:
+                if tag in tf.tags:
+                    counts[tag] += 1
+        em.add_field(f'Past {hours} hours', f"**{counts['delegate']:,}** delegated, **{counts['undelegate']:,}** undelegated, "
+                                            f"**{counts['kill']:,}** terminated", inline=False)
+        return {'embed': em}
+
+    def top_lines(self, ev: TopEvent) -> int:
+        return 10 if not ev._long else 20
+
     def build_top_message(self, ev: TopEvent, start_index: int = 0) -> dict:
         DESC_LIMIT = 4096
-        LINES = 10 if not ev._long else 20
+        LINES = self.top_lines(ev)
         desc = f'Total value: **${ev.total_usd_value:,.0f}**'
         if type(ev) in [TopKillEvent, TopStakeEvent]:
             desc += f' (**{ev.total_idna:,.0f}** iDNA)'
@@ -481,7 +643,7 @@ class Bot:
         total_len = 0
         didnt_fit = 0
         start_index = max(0, min(start_index, len(ev) - LINES))
-        page_items = ev.items[start_index:]
+        page_items = ev.items[start_index:start_index + LINES]
         for i, item in enumerate(page_items):
             if type(ev) != TopStakeEvent:
                 tf: Transfer = item
@@ -550,9 +712,27 @@ class Bot:
                 disnake.ui.Button(label='End' if not forward_disabled else 'Start', style=disnake.ButtonStyle.grey, custom_id=f'{ev_id}:{cmd}:{end_index if not forward_disabled else -1}')])
         return comps
 
+    def describe_key(self, tf: Transfer, ev_by: str) -> tuple:
+        # Kills fetched from the indexer get their value and age after they're first described
+        return (tf.chain, tf.hash, tf.logIndex, ev_by, self.db.known_version,
+                tf.meta.get('usd_value'), tf.meta.get('age'), tf.meta.get('cur_stake'))
+
     def describe_tf(self, tf: Transfer, ev_by: str = '') -> dict:
-        "Turns a Transfer into a dict that can [almost] be displayed as an Embed."
-        self.log.debug(f"Describing: {tf}")
+        "Turns a Transfer into a dict that can [almost] be displayed as an Embed, memoised per transfer"
+        key = self.describe_key(tf, ev_by)
+        d = self.describe_cache.get(key)
+        if d is None:
+            d = self._describe_tf(tf, ev_by)
+            self.describe_cache[key] = d
+            if len(self.describe_cache) > DESCRIBE_CACHE_SIZE:
+                self.describe_cache.popitem(last=False)
+        else:
+            self.describe_cache.move_to_end(key)
+        # Callers get their own copy with their own transfer object
+        return {**d, 'tf': tf}
+
+    def _describe_tf(self, tf: Transfer, ev_by: str = '') -> dict:
+        self.log.debug(f"Describing: {tf.hash}")
         d = {'title': 'Transfer', 'desc': '', 'short': self.get_tx_text(tf, 'Unknown transfer'),
              'value': tf.meta.get('usd_value', 0), 'by': tf.signer if not ev_by else ev_by, 'tf': tf,
              'chain': tf.chain, 'color': Color.from_rgb(129, 190, 238), 'url': self.get_tf_url(tf)}
@@ -743,11 +923,12 @@ class Bot:
         return f"{url}/{type}/{tf.hash}"
 
     async def update_activity(self, ev: BlockEvent):
+        "Schedules a presence update, a pending one is superseded since it would show older blocks"
         self.activity['block'].update({ev.chain: ev.height})
-        if time.time() - self.last_activity_update < 10:
-            return
+        self.scheduler.presence(self._change_activity)
+
+    async def _change_activity(self):
         act_str = f"IDNA: {self.activity['block'][CHAIN_IDENA]} BSC: {self.activity['block'][CHAIN_BSC]}"
-        self.last_activity_update = time.time()
         await self.disbot.change_presence(status=disnake.Status.online, activity=disnake.Activity(type=disnake.ActivityType.watching, name=act_str))
 
     async def get_event(self, ev_id: int):
@@ -756,7 +937,7 @@ class Bot:
             return self.ev_to_msg[ev_id]
         else:
             try:
-                chan_id, msg_id, ev = await self.db.get_event(ev_id)
+                chan_id, msg_id, ev = await self.db.get_event(ev_id, lazy=True)
                 if not ev:
                     return (None, None)
                 chan = self.disbot.get_channel(chan_id)
@@ -792,15 +973,11 @@ class Bot:
                 continue
             if datetime.now(tz=timezone.utc) - ev_msg.created_at > timedelta(days=3):
                 self.log.debug(f"Removing event {ev_id=} {ev_msg.id=}")
-                try:
-                    if ev_msg.components:
-                        await ev_msg.edit(components=None)
-                except Exception as e:
-                    self.log.error(f"Failed to remove buttons from event {ev_id=} {ev_msg.id=}: {e}")
+                if ev_msg.components:
+                    self.scheduler.edit(f'edit:{ev_msg.channel.id}', ev_msg.id, lambda m=ev_msg: m.edit(components=None))
                 del self.ev_to_msg[ev_id]
 
     def reset_state(self):
-        self.last_activity_update = 0
         self.ev_to_msg.clear()
         self.event_cache_cleaned_at = datetime.now(tz=timezone.utc)
 
@@ -848,6 +1025,7 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
                 start_index = int(spl[2])
                 first_resp = False
             start_index = max(0, min(start_index, len(ev) - LINES))
+            await bot.load_event_page(ev, start_index, LINES)
             if cmd == 'show_idents':
                 list_embed = bot.build_ident_list_embed(ev, start_index=start_index, lines=LINES)
             elif cmd == 'show_tfs':
@@ -856,6 +1034,7 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
             btn_msg = {'embed': list_embed, 'components': comps, 'ephemeral': True}
         elif cmd == 'top_seek':
             start_index = int(spl[2])
+            await bot.load_event_page(ev, start_index, bot.top_lines(ev))
             btn_msg = bot.build_top_message(ev, start_index=start_index)
         elif cmd == 'pool_seek':
             start_index = int(spl[2])
@@ -930,7 +1109,11 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
                     allowed = True
 
                 if allowed:
-                    return await func(**kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await func(**kwargs)
+                    finally:
+                        COMMAND_LATENCY.observe(time.perf_counter() - start, func.__name__)
                 else:
                     log.warning(f"User {msg.author.id} tried to call a command, denying")
                     return await msg.response.send_message(f"Can't call this command: permission denied", ephemeral=True)
@@ -1008,19 +1191,44 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
 
         try:
             await bot.idena_listener.update_identity(address.lower())
-            rewards = await bot.idena_listener.get_rewards_for_identity(address.lower())
         except Exception as e:
             log.error(f"Error updating identity: {e}", exc_info=True)
         ident = bot.db.get_identity(address.lower())
         if not ident or ident['state'].lower() == 'undefined':
             await bot.send_response(msg, {'content': f"Identity with address `{address}` not found", 'ephemeral': True})
             return
-        ev_msg = bot.build_rank_message(ident, rewards)
+        try:
+            rank = (await bot.idena_listener.rank_identities([address.lower()]))[0]
+        except Exception as e:
+            log.error(f"Error ranking identity: {e}", exc_info=True)
+            await bot.send_response(msg, {'content': "Couldn't get the rewards data, try again later", 'ephemeral': True})
+            return
+        ev_msg = bot.build_rank_message(rank)
         apply_ephemeral(msg, ev_msg)
         if private:
             ev_msg['ephemeral'] = True
         sent_msg = await bot.send_response(msg, ev_msg)
 
+    @disbot.slash_command(options=[disnake.Option("address", description="Address of the pool", required=True, type=disnake.OptionType.string), disnake.Option("hours", description="Count delegations from this far back", required=False, type=disnake.OptionType.integer, min_value=1, max_value=192)])
+    @protect(roles=command_roles, public=True)
+    async def pool(msg: disnake.CommandInteraction, address: str, hours: int = 24):
+        "Show the delegators and recent delegations of a pool"
+        if not await bot.ratelimit(msg):
+            await bot.send_response(msg, {'content': 'Command execution not allowed', 'ephemeral': True})
+            return
+        if len(address) != 42 or address[:2] != '0x':
+            await bot.send_response(msg, {'content': 'Invalid address', 'ephemeral': True})
+            return
+        pool = bot.db.pools.pools.get(address.lower())
+        if pool is None:
+            await bot.send_response(msg, {'content': f"Pool with address `{address}` not found", 'ephemeral': True})
+            return
+        # Recent pool transfers are only kept as long as cached transfers
+        hours = min(hours, bot.db.conf.db.cached_record_age_limit * 8 // (60 * 60))
+        ev_msg = bot.build_pool_message(pool, hours)
+        apply_ephemeral(msg, ev_msg)
+        await bot.send_response(msg, ev_msg)
+
     @disbot.slash_command()
     @protect(roles=command_roles, public=True)
     async def wen(msg: disnake.CommandInteraction):
@@ -1144,7 +1352,7 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
                 ev_constructor = DexEvent
             ev = ev_constructor(time=tf.timeStamp, tfs=[tf])
 
-            bot.tracker.tracker_event_chan.put_nowait(ev)
+            await bot.tracker.tracker_event_chan.put(ev)
 
     @xxdev.sub_command(options=[disnake.Option("event", description="Event in JSON", required=True, type=disnake.OptionType.string)])
     @protect(roles=[], users=[DEV_USER])
@@ -1157,7 +1365,7 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
             parsed_tf = Transfer.from_dict(raw_tf)
             parsed_tfs.append(parsed_tf)
         j['tfs'] = parsed_tfs
-        bot.tracker.tracker_event_chan.put_nowait(j)
+        await bot.tracker.tracker_event_chan.put(j)
         await bot.send_response(msg, {'content': 'Ok', 'ephemeral': True})
 
     @xxdev.sub_command(options=[disnake.Option("message_ids", description="Messages to delete, comma separated", required=True, type=disnake.OptionType.string)])
@@ -1192,12 +1400,75 @@ def create_bot(db: Database, conf: Config, root_log: Logger):
             if old_msg.author != disbot.user:
                 continue
             if len(old_msg.components) > 0 and old_msg.id not in cached_messages:
-                try:
-                    await old_msg.edit(components=None)
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    log.error(f"Failed to edit message {old_msg.id}: {e}", exc_info=True)
-        log.debug("Finished removing buttons")
+                bot.scheduler.edit(f'edit:{old_msg.channel.id}', old_msg.id, lambda m=old_msg: m.edit(components=None))
+        log.debug("Finished scheduling button removal")
+
+    @xxdev.sub_command()
+    @protect(roles=[], users=[DEV_USER])
+    async def queues(msg: disnake.CommandInteraction):
+        "Show event channel depths and delivery lag"
+        lines = []
+        for name, m in bot.bus.metrics().items():
+            lines.append(f"`{name}`: depth {m['depth']}, lag {m['lag']:.2f}s (max {m['max_lag']:.2f}s), "
+                         f"put {m['put']}, dropped {m['dropped']}, blocked {m['blocked']}")
+        m = bot.db.writes.metrics()
+        lines.append(f"`write_behind`: pending {m['pending']}, written {m['written']} in {m['batches']} batches, "
+                     f"coalesced {m['coalesced']}, failures {m['failures']}, writers waited {m['waits']} times")
+        await bot.send_response(msg, {'content': '\n'.join(lines), 'ephemeral': True})
+
+    @xxdev.sub_command()
+    @protect(roles=[], users=[DEV_USER])
+    async def pollers(msg: disnake.CommandInteraction):
+        "Show current polling intervals"
+        lines = []
+        for name, m in sorted(bot.poll_scheduler.metrics().items()):
+            lines.append(f"`{name}`: every {m['interval']:.0f}s, next in {m['next_in']:.0f}s, "
+                         f"{m['active_polls']}/{m['polls']} polls with activity, {m['refreshes']} refreshes, {m['failures']} failures")
+        await bot.send_response(msg, {'content': '\n'.join(lines) or 'No pollers', 'ephemeral': True})
+
+    @xxdev.sub_command()
+    @protect(roles=[], users=[DEV_USER])
+    async def prices(msg: disnake.CommandInteraction):
+        "Show current prices and how old they are"
+        lines = []
+        for price_id, m in sorted(bot.db.prices.metrics().items()):
+            age = f"{m['age']:.0f}s ago" if m['age'] is not None else "never updated"
+            lines.append(f"`{price_id}`: {m['price']}, {age}, {m['points']} points{' **STALE**' if m['stale'] else ''}")
+        await bot.send_response(msg, {'content': '\n'.join(lines) or 'No prices', 'ephemeral': True})
+
+    @xxdev.sub_command(options=[disnake.Option("seconds", description="How long to profile for", required=False, type=disnake.OptionType.integer, min_value=1, max_value=600), disnake.Option("top", description="Functions to show per table", required=False, type=disnake.OptionType.integer, min_value=5, max_value=200)])
+    @protect(roles=[], users=[DEV_USER])
+    async def profile(msg: disnake.CommandInteraction, seconds: int = 30, top: int = 40):
+        "Sample the event loop for a while and attach the busiest functions and slow callbacks"
+        await bot.send_response(msg, {'content': f'Profiling for {seconds}s...', 'ephemeral': True})
+        profiler = SamplingProfiler()
+        await profiler.run(seconds)
+        report = io.BytesIO(profiler.report(top).encode())
+        await bot.send_response(msg, {'content': profiler.summary(), 'ephemeral': True,
+                                      'file': disnake.File(report, filename=f"profile_{int(time.time())}.txt")})
+
+    @xxdev.sub_command()
+    @protect(roles=[], users=[DEV_USER])
+    async def http_stats(msg: disnake.CommandInteraction):
+        "Show request counts and latency per HTTP endpoint"
+        lines = []
+        breakers = bot.http.resilience.metrics()
+        pools = {}
+        if bot.bsc_listener:
+            pools.update(bot.bsc_listener.rpc_pool.metrics())
+            pools.update(bot.bsc_listener.history_pool.metrics())
+        for endpoint, m in sorted(bot.http.metrics().items()):
+            line = (f"`{endpoint}`: {m['requests']} requests, {m['errors']} errors, {m['retries']} retries, "
+                    f"avg {m['avg_latency'] * 1000:.0f}ms (max {m['max_latency'] * 1000:.0f}ms)")
+            if endpoint in breakers:
+                b = breakers[endpoint]
+                line += f", circuit {b['state']} (opened {b['opened']}x, rejected {b['rejected']})"
+            if endpoint in pools:
+                line += f", health {pools[endpoint]['score']:.1f} ({pools[endpoint]['error_rate'] * 100:.0f}% errors)"
+            lines.append(line)
+        if bot.bsc_listener:
+            lines.append(f"BSC WS connections live: {len(bot.bsc_listener.ws_live)}/{len(bot.bsc_listener.ws_urls)}")
+        await bot.send_response(msg, {'content': '\n'.join(lines) or 'No requests', 'ephemeral': True})
 
     @xxdev.sub_command(options=[disnake.Option("add", description="User or role to add to admins", required=False, type=disnake.OptionType.mentionable), disnake.Option("remove", description="User or role to remove from admins", required=False, type=disnake.OptionType.mentionable)])
     @protect(roles=[], users=[DEV_USER])
@@ -10,6 +10,81 @@ from bna.transfer import Transfer
 from bna.utils import aggregate_dex_trades, trade_color
 from bna.tags import IDENA_TAG_KILL
 
+class LazyTransfers:
+    """
+    List of transfers of a rehydrated event that are only loaded from the database when a page
+    of them needs to be shown. Items that weren't loaded with `load()` can't be accessed.
+    """
+    def __init__(self, hashes: list[str]):
+        self.hashes = list(hashes)
+        self.loaded: dict[str, Transfer] = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(h) for h in self.hashes[index]]
+        return self._get(self.hashes[index])
+
+    def __iter__(self):
+        return (self._get(h) for h in self.hashes)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyTransfers):
+            return self.hashes == other.hashes
+        if isinstance(other, list):
+            return self.hashes == [tf.hash for tf in other]
+        return NotImplemented
+
+    def __repr__(self):
+        return f"LazyTransfers({len(self.loaded)}/{len(self.hashes)} loaded)"
+
+    def _get(self, tx_hash: str) -> Transfer:
+        tf = self.loaded.get(tx_hash)
+        if tf is None:
+            raise LookupError(f"Transfer {tx_hash} is not loaded")
+        return tf
+
+    def is_loaded(self, start: int = 0, stop: int = None) -> bool:
+        return all(h in self.loaded for h in self.hashes[start:stop])
+
+    async def load(self, db, start: int = 0, stop: int = None):
+        "Loads transfers in `[start:stop]` that weren't loaded yet in a single query"
+        missing = list(dict.fromkeys(h for h in self.hashes[start:stop] if h not in self.loaded))
+        if len(missing) == 0:
+            return
+        tfs = await db.get_transfers(missing)
+        if any([tf is None for tf in tfs]):
+            raise Exception(f"Could not find all transfers: {missing=}")
+        self.loaded.update({tf.hash: tf for tf in tfs})
+
+    def append(self, tf: Transfer):
+        self.hashes.append(tf.hash)
+        self.loaded[tf.hash] = tf
+
+    def extend(self, tfs: list[Transfer]):
+        for tf in tfs:
+            self.append(tf)
+
+
+def transfers_loaded(tfs) -> bool:
+    return not isinstance(tfs, LazyTransfers) or tfs.is_loaded()
+
+def transfer_hashes(tfs) -> list[str]:
+    if isinstance(tfs, LazyTransfers):
+        return list(tfs.hashes)
+    return [tf.hash for tf in tfs]
+
+async def load_transfers(hashes: list[str], db, lazy: bool = False) -> list[Transfer] | LazyTransfers:
+    if lazy:
+        return LazyTransfers(hashes)
+    tfs = await db.get_transfers(hashes)
+    if any([tf is None for tf in tfs]):
+        raise Exception(f"Could not find all transfers: {hashes=}")
+    return tfs
+
+
 @dataclass(kw_only=True)
 class Event:
     id: int = -1
@@ -52,6 +127,16 @@ class TransferEvent(Event):
         self.time = event.time
         self.amount += event.amount
 
+    def retract(self, hashes: set[str]) -> int:
+        "Removes transfers in `hashes`, returns how many were removed"
+        removed = [tf for tf in self.tfs if tf.hash in hashes]
+        if removed:
+            self.tfs = [tf for tf in self.tfs if tf.hash not in hashes]
+            self.amount = max(Decimal(0), self.amount - sum(tf.value() for tf in removed))
+            if self.tfs:
+                self.time = max(tf.timeStamp for tf in self.tfs)
+        return len(removed)
+
     def can_join(self, event):
         if type(event) != TransferEvent:
             return False
@@ -69,20 +154,18 @@ class TransferEvent(Event):
         d['type'] = 'transfer'
         d['by'] = self.by
         d['time'] = self.time.isoformat()
-        d['tfs'] = [tf.hash for tf in self.tfs]
+        d['tfs'] = transfer_hashes(self.tfs)
         d['amount'] = str(self.amount)
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         te = TransferEvent()
         te.__dict__.update(super().from_dict(d).__dict__)  # I LOVE OOP
         te.amount = Decimal(d['amount'])
         te.time = datetime.fromisoformat(d['time'])
         te.by = d['by']
-        te.tfs = await db.get_transfers(d['tfs'])
-        if any([tf is None for tf in te.tfs]):
-            raise Exception(f"Could not find all transfers for event: {d=}")
+        te.tfs = await load_transfers(d['tfs'], db, lazy)
         return te
 
     def __len__(self):
@@ -100,6 +183,23 @@ class ChainTransferEvent(Event):
     def __post_init__(self):
         super().__init__()
 
+@dataclass(kw_only=True)
+class ChainRevertEvent(Event):
+    "Internal event for transfers that were removed from the chain by a reorg"
+    chain: str
+    tfs: list[Transfer]
+
+    def __post_init__(self):
+        super().__init__()
+
+@dataclass(kw_only=True)
+class RetractEvent(Event):
+    "Tells the publisher to take reverted transfers out of published messages"
+    hashes: list[str]
+
+    def __post_init__(self):
+        super().__init__()
+
 @dataclass(kw_only=True)
 class InterestingTransferEvent(TransferEvent):
     pass
@@ -128,6 +228,17 @@ class DexEvent(TransferEvent):
         self.lp_usd = aggr['lp_usd']
         self.avg_price = aggr['avg_price']
 
+    def retract(self, hashes: set[str], known_addr: dict) -> int:
+        removed = super().retract(hashes)
+        if removed and self.tfs:
+            self.amount = sum([tf.value() for tf in self.tfs])
+            aggr = aggregate_dex_trades(self.tfs, known_addr)
+            self.buy_usd = aggr['buy_usd']
+            self.sell_usd = aggr['sell_usd']
+            self.lp_usd = aggr['lp_usd']
+            self.avg_price = aggr['avg_price']
+        return removed
+
     def can_join(self, event):
         if type(event) != DexEvent:
             return False
@@ -149,9 +260,9 @@ class DexEvent(TransferEvent):
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         de = DexEvent()
-        de.__dict__.update((await super().from_dict(d, db)).__dict__)
+        de.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         de.buy_usd = d['buy_usd']
         de.sell_usd = d['sell_usd']
         de.avg_price = d['avg_price']
@@ -210,9 +321,9 @@ class KillEvent(TransferEvent):
         return ke
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         ke = KillEvent()
-        ke.__dict__.update((await super().from_dict(d, db)).__dict__)
+        ke.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         ke.killed = d['killed']
         ke.stake = Decimal(d['stake'])
         ke.age = d['age']
@@ -256,9 +367,9 @@ class PoolEvent(TransferEvent):
         return pe
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         pe = PoolEvent()
-        pe.__dict__.update((await super().from_dict(d, db)).__dict__)
+        pe.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         pe.subtype = d['subtype']
         pe.addr = d['addr']
         pe.stake = Decimal(d['stake'])
@@ -284,6 +395,17 @@ class MassPoolEvent(Event):
         self.stake = sum([ch.stake for ch in self.changes])
         self.age = sum([ch.age for ch in self.changes])
 
+    def retract(self, hashes: set[str]) -> int:
+        "Removes changes caused by transfers in `hashes`, returns how many were removed"
+        changes = [ch for ch in self.changes if ch.tfs[0].hash not in hashes]
+        removed = len(self.changes) - len(changes)
+        if removed:
+            self.changes = changes
+            self.count = len(self.changes)
+            self.stake = sum([ch.stake for ch in self.changes])
+            self.age = sum([ch.age for ch in self.changes])
+        return removed
+
     def can_join(self, new_ev):
         if type(new_ev) not in [MassPoolEvent, PoolEvent]:
             return False
@@ -305,7 +427,7 @@ class MassPoolEvent(Event):
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         pe = MassPoolEvent()
         pe.__dict__.update(super().from_dict(d).__dict__)
         pe.subtype = d['subtype']
@@ -313,7 +435,7 @@ class MassPoolEvent(Event):
         pe.count = d['count']
         pe.age = d['age']
         pe.stake = Decimal(d['stake'])
-        pe.changes = [(await PoolEvent.from_dict(c, db)) for c in d['changes']]
+        pe.changes = [(await PoolEvent.from_dict(c, db, lazy)) for c in d['changes']]
         return pe
 
     def __len__(self):
@@ -519,19 +641,17 @@ class TopEvent(Event):
         d['type'] = 'top'
         d['period'] = self.period
         d['total_usd_value'] = self.total_usd_value
-        d['_tfs'] = [tf.hash for tf in self._tfs]
+        d['_tfs'] = transfer_hashes(self._tfs)
         d['_long'] = self._long
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         te = TopEvent()
         te.__dict__.update(super().from_dict(d).__dict__)
         te.period = d['period']
         if '_tfs' in d:
-            te._tfs = await db.get_transfers(d['_tfs'])
-            if any([tf is None for tf in te._tfs]):
-                raise Exception(f"Could not find all transfers for event: {d=}")
+            te._tfs = await load_transfers(d['_tfs'], db, lazy)
         te.total_usd_value = d['total_usd_value']
         if '_long' in d:
             te._long = d['_long']
@@ -555,9 +675,9 @@ class TopDexEvent(TopEvent):
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         te = TopDexEvent()
-        te.__dict__.update((await super().from_dict(d, db)).__dict__)
+        te.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         te.buy_usd = d['buy_usd']
         te.sell_usd = d['sell_usd']
         te.lp_usd = d['lp_usd']
@@ -576,9 +696,9 @@ class TopKillEvent(TopEvent):
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         te = TopKillEvent()
-        te.__dict__.update((await super().from_dict(d, db)).__dict__)
+        te.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         te.total_idna = Decimal(d['total_idna'])
         te.total_age = d['total_age']
         return te
@@ -606,9 +726,9 @@ class TopStakeEvent(TopEvent):
         return d
 
     @classmethod
-    async def from_dict(cls, d: dict, db):
+    async def from_dict(cls, d: dict, db, lazy: bool = False):
         te = TopStakeEvent()
-        te.__dict__.update((await super().from_dict(d, db)).__dict__)
+        te.__dict__.update((await super().from_dict(d, db, lazy)).__dict__)
         te.total_idna = Decimal(d['total_idna'])
         te._identities = deepcopy(d['_identities'])
         for i in te._identities:
@@ -656,7 +776,8 @@ class PoolStatsEvent(Event):
         super().__init__()
 
 
-async def event_from_dict(d: dict, db) -> Event:
+async def event_from_dict(d: dict, db, lazy: bool = False) -> Event:
+    "With `lazy` transfers aren't loaded from the database, see `LazyTransfers`"
     type_map = {
         'event': {'type': Event, 'need_db': False},
         'transfer': {'type': TransferEvent, 'need_db': True},
@@ -679,7 +800,7 @@ async def event_from_dict(d: dict, db) -> Event:
     ev_type = ev_type_spec['type']
 
     if ev_type_spec['need_db']:
-        ev = await ev_type.from_dict(d=d, db=db)
+        ev = await ev_type.from_dict(d=d, db=db, lazy=lazy)
     else:
         ev = ev_type.from_dict(d=d)
     return ev
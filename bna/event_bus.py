@@ -0,0 +1,158 @@
+import time
+import asyncio
+from logging import Logger
+from collections import deque
+
+from bna.event import *
+
+# Lower priority values are delivered first. Status events are only useful in their latest
+# form, so their lane is bounded and the oldest ones are dropped when it's full.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_STATUS = 9
+
+EVENT_PRIORITIES = {
+    ChainTransferEvent: PRIORITY_HIGH,
+    # Reverts share the lane of the transfers re-added after them, so they can't be overtaken
+    ChainRevertEvent: PRIORITY_HIGH,
+    RetractEvent: PRIORITY_HIGH,
+    TransferEvent: PRIORITY_HIGH,  # and all of its subclasses
+    MassPoolEvent: PRIORITY_HIGH,
+    CexEvent: PRIORITY_HIGH,
+    ClubEvent: PRIORITY_NORMAL,
+    StatsEvent: PRIORITY_NORMAL,
+    BlockEvent: PRIORITY_STATUS,
+}
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_STATUS_CAPACITY = 16
+
+
+def event_priority(ev, priorities: dict = EVENT_PRIORITIES) -> int:
+    for cls in type(ev).__mro__:
+        if cls in priorities:
+            return priorities[cls]
+    return PRIORITY_NORMAL
+
+
+class EventChannel:
+    """
+    Bounded priority queue with the same interface as `asyncio.Queue`.
+    `put()` waits when the channel is full (backpressure), `put_nowait()` raises
+    `asyncio.QueueFull` instead. Status events never block and displace older ones.
+    """
+    def __init__(self, name: str, capacity: int = DEFAULT_CAPACITY, status_capacity: int = DEFAULT_STATUS_CAPACITY,
+                 priorities: dict = EVENT_PRIORITIES):
+        self.name = name
+        self.capacity = capacity
+        self.status_capacity = status_capacity
+        self.priorities = priorities
+        self.lanes: dict[int, deque] = {}
+        self.size = 0  # not counting the status lane
+        self.stats = {'put': 0, 'got': 0, 'dropped': 0, 'blocked': 0, 'max_depth': 0, 'last_lag': 0.0, 'max_lag': 0.0}
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def empty(self) -> bool:
+        return all(len(lane) == 0 for lane in self.lanes.values())
+
+    def full(self) -> bool:
+        return self.size >= self.capacity
+
+    def put_nowait(self, ev):
+        prio = event_priority(ev, self.priorities)
+        lane = self.lanes.get(prio)
+        if lane is None:
+            lane = self.lanes[prio] = deque()
+            self.lanes = dict(sorted(self.lanes.items()))
+        if prio == PRIORITY_STATUS:
+            if len(lane) >= self.status_capacity:
+                lane.popleft()
+                self.stats['dropped'] += 1
+        else:
+            if self.full():
+                raise asyncio.QueueFull(f"Channel {self.name} is full")
+            self.size += 1
+        lane.append((time.monotonic(), ev))
+        self.stats['put'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.qsize())
+        self._not_empty.set()
+
+    async def put(self, ev):
+        if event_priority(ev, self.priorities) != PRIORITY_STATUS:
+            if self.full():
+                self.stats['blocked'] += 1
+            while self.full():
+                self._not_full.clear()
+                await self._not_full.wait()
+        self.put_nowait(ev)
+
+    def get_nowait(self):
+        for prio, lane in self.lanes.items():
+            if len(lane) == 0:
+                continue
+            put_time, ev = lane.popleft()
+            if prio != PRIORITY_STATUS:
+                self.size -= 1
+                self._not_full.set()
+            lag = time.monotonic() - put_time
+            self.stats['got'] += 1
+            self.stats['last_lag'] = lag
+            self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+            return ev
+        raise asyncio.QueueEmpty()
+
+    async def get(self, timeout: float = None):
+        "Waits for the next event, raises `asyncio.TimeoutError` if none arrived in `timeout` seconds"
+        # Only the wakeup is awaited, the event itself is taken synchronously, so a timeout or
+        # cancellation can never lose it
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.empty():
+            self._not_empty.clear()
+            if deadline is None:
+                await self._not_empty.wait()
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    await asyncio.wait_for(self._not_empty.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+        return self.get_nowait()
+
+    def lag(self) -> float:
+        "Age in seconds of the oldest undelivered event"
+        oldest = [lane[0][0] for lane in self.lanes.values() if len(lane) > 0]
+        return time.monotonic() - min(oldest) if oldest else 0.0
+
+    def metrics(self) -> dict:
+        m = dict(self.stats)
+        m['depth'] = self.qsize()
+        m['lag'] = self.lag()
+        m['depth_by_priority'] = {prio: len(lane) for prio, lane in self.lanes.items()}
+        return m
+
+
+class EventBus:
+    "Creates the channels between listeners, the tracker and the bot, and reports on them"
+    def __init__(self, log: Logger):
+        self.log = log.getChild("EB")
+        self.channels: dict[str, EventChannel] = {}
+
+    def channel(self, name: str, **kwargs) -> EventChannel:
+        if name not in self.channels:
+            self.channels[name] = EventChannel(name, **kwargs)
+        return self.channels[name]
+
+    def metrics(self) -> dict[str, dict]:
+        return {name: chan.metrics() for name, chan in self.channels.items()}
+
+    def log_metrics(self):
+        for name, m in self.metrics().items():
+            self.log.debug(f"Channel {name}: depth={m['depth']} lag={m['lag']:.2f}s max_lag={m['max_lag']:.2f}s dropped={m['dropped']}")
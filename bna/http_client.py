@@ -0,0 +1,185 @@
+import time
+import json
+import aiohttp
+from logging import Logger
+from typing import Any, Callable
+from urllib.parse import urlsplit
+from dataclasses import dataclass, field
+
+from bna.resilience import Resilience
+from bna.recorder import Recorder
+
+# Timeout profiles for different kinds of endpoints
+TIMEOUT_PROFILES = {
+    'fast': aiohttp.ClientTimeout(total=2),  # node RPC on the hot path
+    'default': aiohttp.ClientTimeout(total=10),
+    'slow': aiohttp.ClientTimeout(total=60),  # bulk fetches like dna_identities
+}
+
+# Connection pool settings
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 10
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, url: str, body: bytes = b''):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+        self.body = body
+
+
+def is_retryable(e: Exception) -> bool:
+    "Client errors mean the endpoint is fine, so they're neither retried nor count as failures"
+    return not isinstance(e, HttpError) or e.status == 429 or e.status >= 500
+
+
+@dataclass
+class HttpResponse:
+    status: int
+    headers: dict
+    body: bytes
+
+    def json(self):
+        return json.loads(self.body)
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    errors: int = 0
+    retries: int = 0
+    total_latency: float = 0
+    max_latency: float = 0
+    statuses: dict[int, int] = field(default_factory=dict)
+
+    def record(self, latency: float, status: int | None):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if status is not None:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def to_dict(self) -> dict:
+        d = dict(self.__dict__)
+        d['statuses'] = dict(self.statuses)
+        d['avg_latency'] = self.total_latency / self.requests if self.requests else 0
+        return d
+
+
+class HttpClient:
+    """
+    Shared HTTP client for all outbound requests. Uses one session with per-host connection
+    pools, DNS caching and keep-alive, so connections to the same hosts are reused.
+    Requests are grouped by endpoint name (or host) for latency and error metrics, and
+    retries and circuit breaking per endpoint are handled by `Resilience`.
+    """
+    def __init__(self, log: Logger, limit: int = POOL_LIMIT, limit_per_host: int = POOL_LIMIT_PER_HOST,
+                 dns_ttl: int = DNS_CACHE_TTL, keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+                 resilience: Resilience = None):
+        self.log = log.getChild("HC")
+        self.resilience = resilience if resilience else Resilience(log)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.stats: dict[str, EndpointStats] = {}
+        self.validators: dict[str, tuple[str | None, str | None]] = {}  # url -> (ETag, Last-Modified)
+        self._session: aiohttp.ClientSession = None
+        # Set to record all traffic, listeners also record their websockets with it
+        self.recorder: Recorder = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        "Created on first use so that it's bound to the running event loop"
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=self.dns_ttl, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, headers={"Content-Type": "application/json"},
+                                                  timeout=TIMEOUT_PROFILES['default'])
+        return self._session
+
+    async def request(self, method: str, url: str, endpoint: str = None, profile: str = 'default',
+                      attempts: int = 1, raise_for_status: bool = True,
+                      check: Callable[[Any], Any] = None, **kwargs) -> HttpResponse:
+        """
+        Sends a request and reads the whole response. Connection errors, timeouts, 5xx/429
+        responses and exceptions raised by `check` are retried up to `attempts` times.
+        """
+        endpoint = endpoint or urlsplit(url).hostname
+        stats = self.stats.get(endpoint)
+        if stats is None:
+            stats = self.stats[endpoint] = EndpointStats()
+        attempt = 0
+
+        async def send_once() -> HttpResponse:
+            nonlocal attempt
+            attempt += 1
+            if attempt > 1:
+                stats.retries += 1
+            start = time.monotonic()
+            status = None
+            try:
+                async with self.session.request(method, url, timeout=TIMEOUT_PROFILES[profile], **kwargs) as resp:
+                    status = resp.status
+                    body = await resp.read()
+                    headers = dict(resp.headers)
+                if raise_for_status and status >= 400:
+                    raise HttpError(status, url, body)
+                if self.recorder is not None:
+                    self.recorder.http(method, url, endpoint, kwargs.get('data', json.dumps(kwargs['json']) if 'json' in kwargs else None),
+                                       status, headers, body, time.monotonic() - start)
+                resp = HttpResponse(status, headers, body)
+                if check is not None:
+                    check(resp)
+                return resp
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.record(time.monotonic() - start, status)
+
+        return await self.resilience.call(endpoint, send_once, attempts, retry_on=is_retryable)
+
+    async def request_json(self, method: str, url: str, check: Callable[[Any], Any] = None, **kwargs):
+        "Returns the parsed JSON body, `check` is called with it and can raise to retry the request"
+        result = None
+
+        def parse(resp: HttpResponse):
+            nonlocal result
+            result = resp.json()
+            if check is not None:
+                result = check(result)
+
+        await self.request(method, url, check=parse, **kwargs)
+        return result
+
+    async def get_json(self, url: str, **kwargs):
+        return await self.request_json('GET', url, **kwargs)
+
+    async def post_json(self, url: str, **kwargs):
+        return await self.request_json('POST', url, **kwargs)
+
+    async def get_json_if_modified(self, url: str, **kwargs):
+        "Conditional GET with the validators of the last response, returns None if nothing changed"
+        headers = dict(kwargs.pop('headers', {}))
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        resp = await self.request('GET', url, headers=headers, **kwargs)
+        if resp.status == 304:
+            return None
+        resp_headers = {k.lower(): v for k, v in resp.headers.items()}
+        if 'etag' in resp_headers or 'last-modified' in resp_headers:
+            self.validators[url] = (resp_headers.get('etag'), resp_headers.get('last-modified'))
+        return resp.json()
+
+    def metrics(self) -> dict[str, dict]:
+        return {endpoint: stats.to_dict() for endpoint, stats in self.stats.items()}
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
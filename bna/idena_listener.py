@@ -1,21 +1,25 @@
 import os
 import time
 import json
-import aiohttp
 import asyncio
 from logging import Logger
 from decimal import Decimal
 from urllib.parse import urljoin
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta, timezone
 from sortedcontainers import SortedDict
 
 from bna.config import IdenaConfig
 from bna.database import Database
+from bna.http_client import HttpClient
+from bna.metrics import RPC_LATENCY
+from bna.resilience import Backoff
 from bna.tags import *
 from bna.event import BlockEvent, ChainTransferEvent, ClubEvent
+from bna.identity_diff import diff_identities
+from bna.reward_model import EpochData, IdentityRank, RewardModel
 from bna.transfer import CHAIN_IDENA, Transfer
-from bna.utils import calculate_usd_value
+from bna.utils import calculate_usd_value, price_of
 from bna.models_pb2 import ProtoTransaction, ProtoCallContractAttachment
 
 RPC_API_TYPE_MAP = {
@@ -49,12 +53,54 @@ USELESS_IDENT_FIELDS = ['code', 'flips', 'inviter', 'pubkey', 'invites', 'shardI
                         'penalty', 'penaltySeconds', 'flipKeyWordPairs', 'lastValidationFlags',
                         'totalQualifiedFlips', 'totalShortFlipPoints', 'flipsWithPair']
 
-MINING_STATES = {'Newbie', 'Verified', 'Human'}
-
 BNA_CONTRACT_ADDRESS = '0xa877f4632dff78f8b87f835379f844e260d0245d'
+# About a minute in total, which is usually enough for the indexer to catch up
+KILLTX_ATTEMPTS = 5
+KILLTX_BACKOFF = Backoff(base=8, cap=30)
+EPOCH_CHECK_INTERVAL = timedelta(minutes=5)  # how often the epoch is checked once the validation is due
+# Mempool transactions are kept until their block is processed, which is usually seconds later
+TX_CACHE_SIZE = 5000
+TX_CACHE_TTL = 10 * 60
+MEMPOOL_FETCH_CONCURRENCY = 16  # the mempool holds thousands of transactions during the validation
+# Transactions that change the identity they're processed with, fetched while they're in the mempool
+PREWARMED_TX_TYPES = [IDENA_TAG_KILL, IDENA_TAG_KILL_DELEGATOR, IDENA_TAG_STAKE]
+
+
+class TxCache:
+    "Transactions by hash, the oldest are dropped after `ttl` seconds or when there are more than `size`"
+    def __init__(self, size: int = TX_CACHE_SIZE, ttl: float = TX_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.txs: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, tx: dict):
+        self.txs[tx['hash']] = (time.time(), tx)
+        self.txs.move_to_end(tx['hash'])
+        while len(self.txs) > self.size:
+            self.txs.popitem(last=False)
+
+    def pop(self, tx_hash: str) -> dict | None:
+        "Returns a copy, since processing a transaction modifies it"
+        added, tx = self.txs.pop(tx_hash, (0, None))
+        if tx is None or time.time() - added > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(tx)
+
+    def expire(self):
+        now = time.time()
+        while self.txs and now - next(iter(self.txs.values()))[0] > self.ttl:
+            self.txs.popitem(last=False)
+
+    def __len__(self):
+        return len(self.txs)
+
 
 class IdenaListener:
-    def __init__(self, conf: IdenaConfig, log: Logger, db: Database):
+    def __init__(self, conf: IdenaConfig, log: Logger, db: Database, http: HttpClient = None):
         self.conf = conf
         self.db = db
         print(os.environ)
@@ -67,12 +113,17 @@ class IdenaListener:
             self.log = log.getChild("IL")
         self.trs = SortedDict()
         self.block_timestamps = {}
-        self.rpc_session = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=2))
-        self.api_session = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
+        self.http = http if http else HttpClient(self.log)
         self.slow_tfs = []  # for killtx, which can take a minute to fetch from the indexer
         self.update_identities = set() # to get correct stake after replenishment
+        self.tx_cache = TxCache()  # filled by the mempool watcher, read by block processing
         self.event_chan = None
-        self.apy_data = {'updated': datetime.min.replace(tzinfo=timezone.utc)}
+        self.last_block: int = None
+        self.last_block_time: int = None
+        self.caught_up = False
+        self.epoch: EpochData = None
+        self.epoch_checked_at = datetime.min.replace(tzinfo=timezone.utc)
+        self.reward_model: RewardModel = None
 
     async def run(self, event_chan):
         self.log.info("Idena listener started")
@@ -97,6 +148,7 @@ class IdenaListener:
                     state = 'GET_NEXT_BLOCK'
                 elif state == 'GET_NEXT_BLOCK':
                     block = await self.rpc_req('bcn_blockAt', [last_block + 1])
+                    self.caught_up = not block
                     if block:
                         self.log.debug(f"Got block: {block['height']}")
                         state = 'PROCESS_BLOCK'
@@ -106,16 +158,17 @@ class IdenaListener:
                 elif state == 'PROCESS_BLOCK':
                     tfs = await self.process_block(block)
                     if len(tfs) != 0:
-                        event_chan.put_nowait(ChainTransferEvent(chain=CHAIN_IDENA, tfs=tfs))
+                        await event_chan.put(ChainTransferEvent(chain=CHAIN_IDENA, tfs=tfs))
                     last_block += 1
-                    event_chan.put_nowait(BlockEvent(chain=CHAIN_IDENA, height=int(block['height'])))
+                    self.last_block, self.last_block_time = last_block, block['timestamp']
+                    await event_chan.put(BlockEvent(chain=CHAIN_IDENA, height=int(block['height'])))
                     state = 'AFTER_BLOCK'
                     await asyncio.sleep(0.05)  # to not overload the node during catchup
                 elif state == 'AFTER_BLOCK':
                     if len(self.slow_tfs) > 0:
                         self.log.info(f"Got slow_tfs, {len(self.slow_tfs)=}")
                         for tf in self.slow_tfs:
-                            event_chan.put_nowait(ChainTransferEvent(chain=CHAIN_IDENA, tfs=[tf]))
+                            await event_chan.put(ChainTransferEvent(chain=CHAIN_IDENA, tfs=[tf]))
                         self.slow_tfs.clear()
                     if len(self.update_identities) > 0:
                         self.log.info(f"Got update_identities, {len(self.update_identities)=}")
@@ -144,15 +197,19 @@ class IdenaListener:
                 await asyncio.sleep(3)
         ident_task.cancel()
         mempool_task.cancel()
-        await self.rpc_session.close()
-        await self.api_session.close()
+
+    def lag(self) -> float:
+        "Seconds since the oldest block that wasn't processed yet was produced"
+        if self.caught_up or self.last_block_time is None:
+            return 0
+        return max(0, time.time() - self.last_block_time)
 
     async def process_block(self, block) -> list[Transfer]:
         self.block_timestamps[block['height']] = block['timestamp']
         block_txs = block['transactions'] if block['transactions'] else []
         tfs = []
         for i, tx_hash in enumerate(block_txs):
-            tx = await self.rpc_req('bcn_transaction', [tx_hash])
+            tx = await self.get_tx(tx_hash, block)
             if tx is None and self.api_url:
                 self.log.warning(f"TX missing from node: {tx_hash}")
                 tx = await self.api_req(f'transaction/{tx_hash}')
@@ -167,6 +224,16 @@ class IdenaListener:
                 tfs.append(tf)
         return tfs
 
+    async def get_tx(self, tx_hash: str, block: dict) -> dict | None:
+        "Gets a block's transaction from the mempool cache, or from the node if it wasn't seen there"
+        tx = self.tx_cache.pop(tx_hash)
+        if tx is None:
+            return await self.rpc_req('bcn_transaction', [tx_hash])
+        # Pending transactions have no block yet
+        tx['blockHash'] = block.get('hash')
+        tx['timestamp'] = block['timestamp']
+        return tx
+
     async def process_tx(self, tx, blockNumber, logIndex) -> Transfer | None:
         tf = None
         tx['to'] = tx['to'].lower() if tx.get('to') else None
@@ -196,14 +263,14 @@ class IdenaListener:
             tf = Transfer.from_idena_rpc(tx, blockNumber, logIndex, tags=[tx['type']])
             tf.meta['pool'] = pool
         elif tx['type'] == IDENA_TAG_UNDELEGATE:
-            ident = self.db.get_identity(tx['from'])
+            # The delegatee is cleared once the undelegation is done, the ledger still has it then
+            pool = self.db.pool_of(tx['from'])
             tx['to'] = None
-            if ident is not None:
+            if pool:
                 tf = Transfer.from_idena_rpc(tx, blockNumber, logIndex, tags=[tx['type']])
-                tf.meta['pool'] = ident.get('delegatee')
-                if not tf.meta['pool']:
-                    self.log.warning(f"Undelegate tx with no delegatee in cache: {tx}")
-                    tf = None
+                tf.meta['pool'] = pool
+            else:
+                self.log.warning(f"Undelegate tx with no known pool: {tx}")
             self.log.debug(f"undelegate for {tx['hash']} {tf=}")
         elif tx['type'] in [IDENA_TAG_KILL, IDENA_TAG_KILL_DELEGATOR]:
             pool = None
@@ -223,7 +290,7 @@ class IdenaListener:
                 tf.meta['killedIdentity'] = killed
                 tf.meta['age'] = ident.get('age', 0)
                 tf.meta['pool'] = pool if pool else ident.get('delegatee')
-                tf.meta['usd_value'] = float(stake) * self.db.prices['cg:idena']
+                tf.meta['usd_value'] = float(stake) * price_of(self.db.prices, 'cg:idena', tf.timeStamp)
                 self.log.debug(f"Created kill TF from cache: {tf}")
             else:
                 # otherwise fetch from indexer asynchronously
@@ -279,40 +346,42 @@ class IdenaListener:
         if not self.api_url:
             self.log.warning("No API URL set, can't fetch killtx data")
             return
-        # Sometimes indexer sends garbage data, so multiple attempts are necessary
-        attempt = 0
-        api_tx = None
-        while attempt < 20:
+        # The indexer can take a while to catch up, so the fetch is retried with a long backoff. That's
+        # done per tx and outside the API endpoint's breaker, only failed requests count against it.
+        cur_epoch = tx['epoch']
+        for attempt in range(1, KILLTX_ATTEMPTS + 1):
             try:
-                # cur_epoch = (await self.api_req('epoch/last', attempts=5))['epoch']
-                cur_epoch = tx['epoch']
-                birth_epoch = (await self.api_req(f'epoch/{cur_epoch - 1}/identity/{tf.meta["killedIdentity"]}', attempts=5))['birthEpoch']
-                age = cur_epoch - birth_epoch
-                api_tx = await self.api_req(f'transaction/{tf.hash}', attempts=50)
-                if 'transfer' in api_tx.get('data', {}):
-                    stake = Decimal(api_tx['data']['transfer'])
-                else:
-                    self.log.warning(f"No stake data for {tx['hash']=}")
-                    stake = Decimal(0)
-                tx['value'] = stake
-                tf.changes = Transfer.create_changes(tx)
-                tf.meta['age'] = age
-                tf.meta['usd_value'] = float(stake) * self.db.prices['cg:idena']
-                self.log.debug(f"Created kill TF: {tf}")
-                self.slow_tfs.append(tf)
-                break
-            except:
-                self.log.error(f"Failed to fetch killtx for hash={tf.hash}", exc_info=True)
-                self.log.debug(f"Data for the failed fetch: {api_tx}")
-                attempt += 1
-                await asyncio.sleep(2)
+                ident = await self.api_req(f'epoch/{cur_epoch - 1}/identity/{tf.meta["killedIdentity"]}')
+                api_tx = await self.api_req(f'transaction/{tf.hash}')
+                if ident is not None and api_tx is not None:
+                    break
+                self.log.debug(f"Indexer doesn't have killtx {tf.hash} yet, attempt #{attempt}/{KILLTX_ATTEMPTS}")
+            except Exception as e:
+                self.log.warning(f'Killtx {tf.hash} fetch #{attempt}/{KILLTX_ATTEMPTS} failed: "{e}"')
+            if attempt < KILLTX_ATTEMPTS:
+                await asyncio.sleep(KILLTX_BACKOFF.delay(attempt))
+        else:
+            self.log.error(f"Failed to fetch killtx for hash={tf.hash}")
+            return
+        age = cur_epoch - ident['birthEpoch']
+        if 'transfer' in (api_tx.get('data') or {}):
+            stake = Decimal(api_tx['data']['transfer'])
+        else:
+            self.log.warning(f"No stake data for {tx['hash']=}")
+            stake = Decimal(0)
+        tx['value'] = stake
+        tf.changes = Transfer.create_changes(tx)
+        tf.meta['age'] = age
+        tf.meta['usd_value'] = float(stake) * price_of(self.db.prices, 'cg:idena', tf.timeStamp)
+        self.log.debug(f"Created kill TF: {tf}")
+        self.slow_tfs.append(tf)
 
     async def rpc_req(self, method=None, params = [], data=None, id=0, error_ok=False):
         if data is None:
             data = json.dumps({"method": method,"params": params,"id": id, "key": self.rpc_key})
-        resp = await self.rpc_session.post(self.rpc_url, data=data)
-        # self.log.debug(f"{await resp.text()=}")
-        j = await resp.json()
+        start = time.perf_counter()
+        j = await self.http.post_json(self.rpc_url, data=data, endpoint='idena_rpc', profile='fast')
+        RPC_LATENCY.observe(time.perf_counter() - start, method or 'raw', 'idena_rpc')
         if error_ok:
             return j
         if 'result' not in j:
@@ -323,23 +392,19 @@ class IdenaListener:
                 raise Exception("RPC error")
         return j['result']
 
-    async def api_req(self, path, attempts=1):
+    async def api_req(self, path, attempts=1, allow_none=True):
+        "Retries are handled by the shared HTTP client, `allow_none=False` also retries empty results"
         self.log.debug(f"api_req {path=}")
-        attempt = 0
-        while attempt < attempts:
-            try:
-                resp = await self.rpc_session.get(urljoin(self.api_url, path))
-                j = await resp.json()
-                if 'result' not in j:
-                    self.log.error(f"Bad API response: {j}")
-                    raise Exception(f"API error")
-                return j['result']
-            except Exception as e:
-                attempt += 1
-                self.log.warn(f'API fetch #{attempt}/{attempts} error: "{e}"')
-                if attempt == attempts:
-                    raise e
-                await asyncio.sleep(10)
+
+        def result(j: dict):
+            if 'result' not in j:
+                self.log.error(f"Bad API response: {j}")
+                raise Exception(f"API error")
+            if j['result'] is None and not allow_none:
+                raise Exception(f"Empty API result for {path}")
+            return j['result']
+
+        return await self.http.get_json(urljoin(self.api_url, path), endpoint='idena_api', attempts=attempts, check=result)
 
     async def mempool_watcher(self):
         mempool_req = json.dumps({"method": "bcn_mempool","params": [], "id": 123, "key": self.rpc_key})
@@ -352,40 +417,57 @@ class IdenaListener:
                 self.log.warning(f'Mempool error: "{e}"', exc_info=True)
                 await asyncio.sleep(3)
                 continue
+            self.tx_cache.expire()
             if mempool is None or len(mempool) == 0:
                 seen.clear() # no reason to keep old hashes
                 continue
 
-            for tx_hash in mempool:
-                if tx_hash in seen:
-                    continue
-                seen.add(tx_hash)
+            new_hashes = [tx_hash for tx_hash in mempool if tx_hash not in seen]
+            seen.update(new_hashes)
+            for tx_hash in new_hashes:
                 self.log.debug(F"Mempool tx: {tx_hash}")
-                try:
-                    tx = await self.rpc_req("bcn_transaction", [tx_hash])
-                except Exception as e:
-                    self.log.warning(f'Mempool TX error: "{e}"', exc_info=True)
+            txs = await self.fetch_mempool_txs(new_hashes)
+            prewarm = set()
+            for tx in txs:
+                if isinstance(tx, Exception):
+                    self.log.warning(f'Mempool TX error: "{tx}"', exc_info=tx)
                     continue
-                if tx['type'] in ['kill', 'killDelegator']:
-                    try:
-                        addr = tx['from'] if tx['type'] == 'kill' else tx['to']
-                        ident = await self.fetch_identity(addr)
-                        if ident['state'].lower() != 'undefined':
-                            await self.db.insert_identity(ident)
-                    except Exception as e:
-                        self.log.warning(f'Mempool KillTX error: "{e}"', exc_info=True)
-                        continue
+                if tx is None:
+                    continue
+                self.tx_cache.put(tx)
+                if tx['type'] in PREWARMED_TX_TYPES:
+                    # The identity that will be read when the transaction is processed
+                    addr = tx['to'] if tx['type'] == IDENA_TAG_KILL_DELEGATOR else tx['from']
+                    prewarm.add(addr.lower())
+            if prewarm:
+                await asyncio.gather(*[self.prewarm_identity(addr) for addr in prewarm])
+
+    async def fetch_mempool_txs(self, tx_hashes: list[str]) -> list[dict | Exception]:
+        "Fetches transactions concurrently, but few enough at a time to not trip the RPC breaker block processing uses"
+        limit = asyncio.Semaphore(MEMPOOL_FETCH_CONCURRENCY)
+
+        async def fetch(tx_hash: str) -> dict:
+            async with limit:
+                return await self.rpc_req("bcn_transaction", [tx_hash])
+
+        return await asyncio.gather(*[fetch(tx_hash) for tx_hash in tx_hashes], return_exceptions=True)
+
+    async def prewarm_identity(self, addr: str):
+        try:
+            ident = await self.fetch_identity(addr)
+            if ident['state'].lower() != 'undefined':
+                await self.db.insert_identity(ident)
+        except Exception as e:
+            self.log.warning(f'Mempool identity error for {addr}: "{e}"', exc_info=True)
 
     async def identities_cacher(self):
         "Gets all identities from the node and inserts them into DB. Takes 5-10 seconds per fetch, so it's done rarely."
         idents_req = json.dumps({"method": "dna_identities","params": [], "id": 123, "key": self.rpc_key})
-        session = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=60))
         await asyncio.sleep(5)
         while True:
             try:
                 self.log.info("Fetching identities...")
-                resp = await session.post(self.rpc_url, data=idents_req)
-                identities = (await resp.json())['result']
+                identities = (await self.http.post_json(self.rpc_url, data=idents_req, endpoint='idena_rpc_bulk', profile='slow'))['result']
             except asyncio.CancelledError:
                 self.log.debug("Cancelled")
                 break
@@ -414,7 +496,6 @@ class IdenaListener:
             except asyncio.CancelledError:
                 self.log.debug("Cancelled")
                 break
-        await session.close()
 
     async def fetch_identity(self, addr: str) -> dict:
         self.log.debug(f"Fetching identity {addr=}")
@@ -433,26 +514,21 @@ class IdenaListener:
         await self.process_identity_changes([ident])
 
     async def process_identity_changes(self, changes: list[dict], full=False):
+        diff = diff_identities(self.db.cache['identities'], changes, full=full)
+        self.log.debug(f"Identity changes: {diff.summary()}")
         evs = []
-        for new_ident in changes:
-            try:
-                cur_ident = self.db.cache['identities'].get(new_ident['address'])
-                if cur_ident is None:
-                    continue
-                new_club = self.check_new_club(Decimal(cur_ident['stake']), Decimal(new_ident['stake']))
-                if new_club:
-                    self.log.info(f"Club change: {new_ident['address']}, stake={new_ident['stake']}, {new_club=}")
-                    evs.append(ClubEvent(addr=new_ident['address'], stake=Decimal(new_ident['stake']), club=new_club))
-            except Exception as e:
-                self.log.error(f"Error processing identity change for {new_ident=}: {e}", exc_info=True)
+        for change in diff.of('stake'):
+            old, new = change.stake
+            new_club = self.check_new_club(old, new)
+            if new_club:
+                self.log.info(f"Club change: {change.addr}, stake={new}, {new_club=}")
+                evs.append(ClubEvent(addr=change.addr, stake=new, club=new_club))
 
-        self.log.debug(f"Inserting {len(changes)} identities")
-        await self.db.insert_identities(changes, full=full)
-        self.log.debug(f"Inserted")
+        await self.db.insert_identity_changes(diff)
 
         for ev in evs:
             ev.rank = self.db.count_identities_with_stake(ev.stake)
-            self.event_chan.put_nowait(ev)
+            await self.event_chan.put(ev)
             self.log.debug(f"{ev=}")
 
     def check_new_club(self, cur_stake: Decimal, new_stake: Decimal) -> Decimal | None:
@@ -472,94 +548,51 @@ class IdenaListener:
         else:
             return None
 
-    async def get_rewards_for_identity(self, addr):
-        pow = 0.9
-        ad = self.apy_data
-        # if datetime.now(tz=timezone.utc) - ad['updated'] > timedelta(hours=2):
-        await self.fetch_apy_data()
-
-        ident = self.db.cache['identities'][addr]
-        stake = float(ident['stake'])
-        stake_weight = stake ** pow
-        average_miner_weight = ad['average_miner_weight']
-        online_miners_count = ad['online_miners']
-        epoch_days = ad['epoch_days']
-        self.log.debug(f"{stake=}, {stake_weight=}, {average_miner_weight=}, {online_miners_count=}, {epoch_days=}")
-
-        proposer_only_reward = (6 * stake_weight * 20) / (stake_weight * 20 + average_miner_weight * 100)
-        committee_only_reward = (6 * stake_weight) / (stake_weight + average_miner_weight * 119)
-        proposer_and_committee_reward = (6 * stake_weight * 21) / (stake_weight * 21 + average_miner_weight * 99)
-        proposer_probability = 1 / online_miners_count
-        committee_probability = min(100, online_miners_count) / online_miners_count
-        proposer_only_probability = proposer_probability * (1 - committee_probability)
-        committee_only_probability = committee_probability * (1 - proposer_probability)
-        proposer_and_committee_probability = proposer_only_probability * committee_only_probability
-        mining_rewards = ((85000 * epoch_days) / 21.0) * (proposer_only_probability * proposer_only_reward + committee_only_probability * committee_only_reward + proposer_and_committee_probability * proposer_and_committee_reward)
-        validation_rewards = (stake_weight / (stake_weight + ad['total_weight'])) * float(ad['epoch_rewards']['staking'])
-        self.log.debug(f"{mining_rewards=}, {validation_rewards=}")
-        rewards = mining_rewards + validation_rewards
-        apy = rewards * 100 / stake * 366 / epoch_days
-        return rewards, apy
-
-    async def fetch_apy_data(self):
-        ad = self.apy_data
-        # These won't exactly match the true values from the node/indexer, but
-        # it's a lot better to not have to reach out to API for them.
-        ad['online_miners'] = self.get_online_miners()
-        weight, average = self.get_staking_weights()
-        # ad['online_miners'] = await self.api_req('onlineminers/count')
-        # ad['staking'] = await self.api_req('staking')
-        ad['total_weight'] = weight
-        ad['average_miner_weight'] = average
+    async def fetch_epoch_data(self) -> EpochData:
         cur_epoch = await self.rpc_req('dna_epoch')
-        if 'cur_epoch' not in ad or cur_epoch['epoch'] != ad['cur_epoch']['epoch']:
-            ad['cur_epoch'] = cur_epoch
-            if cur_epoch['nextValidation'].endswith('Z'):
-                ad['cur_epoch']['validationTime'] = datetime.strptime(cur_epoch['nextValidation'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-            else:
-                ad['cur_epoch']['validationTime'] = datetime.fromisoformat(cur_epoch['nextValidation'])
-            ad['prev_epoch'] = await self.api_req(f'epoch/{ad["cur_epoch"]["epoch"] - 1}')
-            ad['prev_epoch']['validationTime'] = datetime.strptime(ad['prev_epoch']['validationTime'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-            ad['epoch_rewards'] = await self.api_req(f'epoch/{ad["cur_epoch"]["epoch"] - 1}/rewardssummary')
-            ad['epoch_days'] = (ad['cur_epoch']['validationTime'] - ad['prev_epoch']['validationTime']).days
-        ad['updated'] = datetime.now(tz=timezone.utc)
-        self.log.debug(f"Updated APY data: {ad=}")
+        if cur_epoch['nextValidation'].endswith('Z'):
+            validation_time = datetime.strptime(cur_epoch['nextValidation'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        else:
+            validation_time = datetime.fromisoformat(cur_epoch['nextValidation'])
+        prev_epoch = await self.api_req(f'epoch/{cur_epoch["epoch"] - 1}')
+        prev_validation = datetime.strptime(prev_epoch['validationTime'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        epoch_rewards = await self.api_req(f'epoch/{cur_epoch["epoch"] - 1}/rewardssummary')
+        epoch = EpochData(epoch=cur_epoch['epoch'], validation_time=validation_time,
+                          epoch_days=(validation_time - prev_validation).days, staking_rewards=float(epoch_rewards['staking']))
+        self.log.debug(f"Fetched epoch data: {epoch}")
+        return epoch
+
+    async def get_reward_model(self) -> RewardModel:
+        "The reward model for the current epoch and the last identity refresh, rebuilt only when one of them changes"
+        now = datetime.now(tz=timezone.utc)
+        if self.epoch is None or (now >= self.epoch.validation_time and now - self.epoch_checked_at > EPOCH_CHECK_INTERVAL):
+            # The epoch only changes after the validation, until then it's checked every few minutes
+            self.epoch_checked_at = now
+            epoch = await self.fetch_epoch_data()
+            if self.epoch is None or epoch.epoch != self.epoch.epoch:
+                self.reward_model = None
+            self.epoch = epoch
+        if self.reward_model is None or self.reward_model.version != self.db.identities_version:
+            # These won't exactly match the true values from the node/indexer, but
+            # it's a lot better to not have to reach out to API for them.
+            self.reward_model = RewardModel(self.db.cache['identities'], self.epoch, self.get_online_miners(),
+                                            self.db.identities_version)
+            self.log.debug(f"Built reward model: {self.reward_model.online_miners=} {self.reward_model.average_miner_weight=} "
+                           f"{self.reward_model.total_weight=}")
+        return self.reward_model
+
+    async def get_rewards_for_identity(self, addr: str) -> tuple[float, float]:
+        model = await self.get_reward_model()
+        return model.rewards(float(self.db.cache['identities'][addr]['stake']))
+
+    async def rank_identities(self, addrs: list[str]) -> list[IdentityRank]:
+        "Ranks and rewards of cached identities, in the same order as `addrs` with unknown ones left out"
+        model = await self.get_reward_model()
+        idents = [self.db.get_identity(addr) for addr in addrs]
+        return model.rank([ident for ident in idents if ident is not None])
 
     def get_online_miners(self) -> int:
-        solo = 0
-        pools = defaultdict(lambda: {'delegators': 0, 'online': False})
-        for ident in self.db.cache['identities'].values():
-            if ident['online']:
-                if not ident['isPool']:
-                    solo += 1
-                else:
-                    pools[ident['address']]['online'] = True
-                    if ident['state'] in MINING_STATES:
-                        solo += 1
-            elif ident['delegatee'] and ident['state'] in MINING_STATES:
-                pools[ident['delegatee']]['delegators'] += 1
-
-        online = solo + sum([p['delegators'] for p in pools.values() if p['online']])
-        return online
-
-    def get_staking_weights(self):
-        total_weight = 0
-        miner_weight = 0
-        miner_weights = []
-        for ident in self.db.cache['identities'].values():
-            if ident['state'] in MINING_STATES:
-                weight = float(ident['stake']) ** 0.9
-                total_weight += weight
-                if ident['online'] or self.db.cache['identities'].get(ident.get('delegatee'), {}).get('online', False):
-                    miner_weight += float(ident['stake']) ** 0.9
-                    miner_weights.append(float(ident['stake']) ** 0.9)
-
-        av1 = miner_weight / len(miner_weights)
-        miner_weights.sort()
-        av2 = calculate_average(miner_weights, 101)
-        average = (av1 + av2) / 2
-        self.log.debug(f"{average=} {miner_weight=} {total_weight=}")
-        return total_weight, average
+        return self.db.pools.online_miners()
 
     async def _fetch_txs(self, tx_hashes: list[str]) -> list[Transfer]:
         tfs = []
@@ -632,21 +665,6 @@ class IdenaListener:
         time = datetime.strptime(resp['nextValidation'], "%Y-%m-%dT%H:%M:%S%z")
         return int(time.timestamp())
 
-def calculate_average(values: list[float], n: float):
-    if len(values) == 0:
-        return 0
-
-    step = len(values) / float(n)
-    total, cnt = 0.0, 0
-    for i in range(n):
-        index = int(round(step * i))
-        if index >= len(values):
-            index = len(values) - 1
-        total += values[index]
-        cnt += 1
-
-    return total / cnt
-
 def addr_to_bytes(addr: str) -> bytes:
     return bytes.fromhex(addr[2:])
 
@@ -0,0 +1,83 @@
+from decimal import Decimal
+from dataclasses import dataclass, field
+
+# Changes only in these fields don't need the identity written again
+IGNORED_FIELDS = ('_fetchTime',)
+
+
+@dataclass
+class IdentityChange:
+    "What changed in one identity since the cached copy, fields that didn't change are None"
+    addr: str
+    ident: dict
+    prev: dict = None  # None for identities that weren't cached
+    stake: tuple[Decimal, Decimal] = None
+    state: tuple[str, str] = None
+    delegatee: tuple[str | None, str | None] = None
+    online: tuple[bool, bool] = None
+
+    @property
+    def added(self) -> bool:
+        return self.prev is None
+
+    @property
+    def stake_delta(self) -> Decimal:
+        return self.stake[1] - self.stake[0] if self.stake else Decimal(0)
+
+
+@dataclass
+class IdentityChangeSet:
+    "Identities that changed in a refresh, and the ones that disappeared from a full refresh"
+    idents: list[dict]
+    full: bool = False
+    changes: list[IdentityChange] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    unchanged: int = 0
+
+    def of(self, kind: str) -> list[IdentityChange]:
+        "Changes of one kind: `stake`, `state`, `delegatee`, `online`, or `added`"
+        return [ch for ch in self.changes if getattr(ch, kind)]
+
+    def summary(self) -> str:
+        counts = ', '.join(f"{kind}={len(self.of(kind))}" for kind in ('added', 'stake', 'state', 'delegatee', 'online'))
+        return f"{len(self.changes)} changed ({counts}), {len(self.removed)} removed, {self.unchanged} unchanged"
+
+
+def diff_identity(addr: str, prev: dict, ident: dict) -> IdentityChange | None:
+    "Compares the fields of two copies of an identity, returns None if only ignored fields differ"
+    if len(prev) == len(ident) and all(prev.get(k) == v for k, v in ident.items() if k not in IGNORED_FIELDS):
+        return None
+    change = IdentityChange(addr, ident, prev)
+    # Stakes are strings, so they're only parsed when they differ
+    if prev.get('stake') != ident.get('stake'):
+        old, new = Decimal(prev.get('stake') or 0), Decimal(ident.get('stake') or 0)
+        if old != new:
+            change.stake = (old, new)
+    if prev.get('state') != ident.get('state'):
+        change.state = (prev.get('state'), ident.get('state'))
+    if prev.get('delegatee') != ident.get('delegatee'):
+        change.delegatee = (prev.get('delegatee'), ident.get('delegatee'))
+    if bool(prev.get('online')) != bool(ident.get('online')):
+        change.online = (bool(prev.get('online')), bool(ident.get('online')))
+    return change
+
+
+def diff_identities(cached: dict[str, dict], idents: list[dict], full: bool = False) -> IdentityChangeSet:
+    "Compares fetched identities against the cache, a `full` refresh also finds the ones that are gone"
+    changes = IdentityChangeSet(idents, full)
+    seen = set()
+    for ident in idents:
+        addr = ident['address'].lower()
+        seen.add(addr)
+        prev = cached.get(addr)
+        if prev is None:
+            changes.changes.append(IdentityChange(addr, ident))
+            continue
+        change = diff_identity(addr, prev, ident)
+        if change is None:
+            changes.unchanged += 1
+        else:
+            changes.changes.append(change)
+    if full:
+        changes.removed = [addr for addr in cached if addr not in seen]
+    return changes
@@ -0,0 +1,148 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+from logging import Logger
+from typing import Callable
+
+from aiohttp import web
+
+# Seconds, from a fast RPC call to a slow Discord command
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_HOST = '127.0.0.1'
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: tuple[str, ...], values: tuple, le: str = None) -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    "Counts observations in fixed buckets, which is cheap enough to do on every call"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # label values -> [bucket counts..., over the last bucket, sum, count]
+
+    def observe(self, value: float, *label_values):
+        s = self.series.get(label_values)
+        if s is None:
+            s = self.series[label_values] = [0] * (len(self.buckets) + 3)
+        s[bisect_left(self.buckets, value)] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, s in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, s):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, values, bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, values, '+Inf')} {s[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {s[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {s[-1]}")
+        return lines
+
+
+class Collected:
+    "Gauge or counter whose values are read from the components only when metrics are scraped"
+    def __init__(self, name: str, help: str, kind: str, labels: tuple[str, ...], collect: Callable[[], dict]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is None:
+                continue
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {float(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Histogram | Collected] = {}
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, help, labels, buckets)
+        return self.metrics[name]
+
+    def gauge(self, name: str, help: str, collect: Callable[[], dict], labels: tuple[str, ...] = ()):
+        "`collect` returns a value, or a dict of label values to values"
+        self.metrics[name] = Collected(name, help, 'gauge', labels, collect)
+
+    def counter(self, name: str, help: str, collect: Callable[[], dict], labels: tuple[str, ...] = ()):
+        self.metrics[name] = Collected(name, help, 'counter', labels, collect)
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics.values():
+            try:
+                lines += m.render()
+            except Exception as e:
+                lines.append(f"# {m.name} failed: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+HOT_PATH_LATENCY = REGISTRY.histogram('bna_hot_path_seconds', "Duration of tracker and publisher steps", ('step',))
+RPC_LATENCY = REGISTRY.histogram('bna_rpc_seconds', "Duration of node RPC calls", ('method', 'endpoint'))
+DB_LATENCY = REGISTRY.histogram('bna_db_query_seconds', "Duration of backing store queries", ('query',))
+COMMAND_LATENCY = REGISTRY.histogram('bna_command_seconds', "Duration of slash commands", ('command',))
+
+
+def timed(histogram: Histogram, *label_values):
+    "Decorator for coroutines that observes how long each call took"
+    def decorator(func):
+        labels = label_values or (func.__name__,)
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    "Serves the registry in the Prometheus text format on `/metrics`"
+    def __init__(self, log: Logger, port: int, host: str = METRICS_HOST, registry: MetricsRegistry = REGISTRY):
+        self.log = log.getChild("MT")
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.runner: web.AppRunner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
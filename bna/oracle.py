@@ -1,15 +1,25 @@
-import random
-import aiohttp
 import asyncio
 import logging
 from bna.database import Database
+from bna.http_client import HttpClient
+from bna.dex_price import DexPriceEngine
+from bna.poll_scheduler import PollScheduler, POLL_GROUP_PRICES
 
-REFRESH_PERIOD = 60
+REFRESH_PERIOD = 60  # when prices are moving
+MAX_REFRESH_PERIOD = 5 * 60  # when they aren't
+PRICE_MOVE = 0.002  # relative change that counts as activity for the poll scheduler
 
 class Oracle:
-    def __init__(self, db: Database, log: logging.Logger):
+    def __init__(self, db: Database, log: logging.Logger, http: HttpClient = None, dex_price: DexPriceEngine = None,
+                 scheduler: PollScheduler = None):
         self.db = db
         self.log = log.getChild("OR")
+        self.http = http if http else HttpClient(log)
+        self.dex_price = dex_price
+        self.scheduler = scheduler if scheduler else PollScheduler(log)
+        for source in ('coingecko', 'dexscreener'):
+            self.scheduler.register(source, REFRESH_PERIOD, MAX_REFRESH_PERIOD, groups=(POLL_GROUP_PRICES,))
+        self.db.prices.subscribe(self.price_moved)
 
     async def run(self, watch: list[dict]):
         self.log.info(f"Oracle started for coins {watch=}")
@@ -26,39 +36,57 @@ class Oracle:
         asyncio.create_task(self.run_cg(self.db, cg_watch), name="oracle_cg")
         asyncio.create_task(self.run_dexscreener(self.db, dexscreener_watch), name="oracle_dexscreener")
 
+    def set_price(self, price_id: str, price: float, when=None) -> bool:
+        "Returns whether the price moved enough to count as activity"
+        old = self.db.prices.get(price_id)
+        self.db.prices.update(price_id, price, when)
+        return not old or abs(price / old - 1) >= PRICE_MOVE
+
     async def run_cg(self, db: Database, watch: str):
-        s = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
+        failures = 0
         while True:
             try:
-                r = await s.get(f'https://api.coingecko.com/api/v3/simple/price?ids={watch}&vs_currencies=usd')
-                prices = await r.json()
+                async with self.scheduler.turn('coingecko'):
+                    prices = await self.http.get_json(f'https://api.coingecko.com/api/v3/simple/price?ids={watch}&vs_currencies=usd&include_last_updated_at=true', endpoint='coingecko')
                 # self.log.debug(f"CG {prices=}")
+                moved = False
                 for coin, price in prices.items():
-                    self.db.prices[f"cg:{coin}"] = price['usd']
-                await asyncio.sleep(REFRESH_PERIOD + random.random() * 2)
+                    # CoinGecko is only a fallback for the price derived from DEX pools
+                    if self.dex_price and f"cg:{coin}" == self.dex_price.price_id and self.dex_price.is_live():
+                        continue
+                    moved |= self.set_price(f"cg:{coin}", price['usd'], price.get('last_updated_at'))
+                await self.db.prices.flush()
+                self.scheduler.done('coingecko', moved)
+                failures = 0
             except asyncio.CancelledError:
                 self.log.debug("Cancelled")
                 break
             except Exception as e:
-                self.log.error(f'Oracle refresh exception: "{e}"', exc_info=True)
-                await asyncio.sleep(REFRESH_PERIOD / 2)
-        await s.close()
+                failures += 1
+                self.log.error(f'Oracle refresh exception #{failures}: "{e}"', exc_info=failures == 1)
+                self.scheduler.failed('coingecko')
 
     async def run_dexscreener(self, db: Database, watch: str):
-        s = aiohttp.ClientSession(headers={"Content-Type": "application/json"}, timeout=aiohttp.ClientTimeout(total=10))
+        failures = 0
         while True:
             try:
-                r = await s.get(f'https://api.dexscreener.com/latest/dex/pairs/bsc/{watch}')
-                info = await r.json()
+                async with self.scheduler.turn('dexscreener'):
+                    info = await self.http.get_json(f'https://api.dexscreener.com/latest/dex/pairs/bsc/{watch}', endpoint='dexscreener')
                 # self.log.debug(f"DS {info=}")
+                moved = False
                 for pair in info['pairs']:
                     pair_addr = pair['pairAddress'].lower()
-                    self.db.prices[f"ds:{pair_addr}"] = float(pair['priceUsd'])
-                await asyncio.sleep(REFRESH_PERIOD + random.random() * 2)
+                    moved |= self.set_price(f"ds:{pair_addr}", float(pair['priceUsd']))
+                await self.db.prices.flush()
+                self.scheduler.done('dexscreener', moved)
+                failures = 0
             except asyncio.CancelledError:
                 self.log.debug("Cancelled")
                 break
             except Exception as e:
-                self.log.error(f'Oracle refresh exception: "{e}"', exc_info=True)
-                await asyncio.sleep(REFRESH_PERIOD / 2)
-        await s.close()
+                failures += 1
+                self.log.error(f'Oracle refresh exception #{failures}: "{e}"', exc_info=failures == 1)
+                self.scheduler.failed('dexscreener')
+
+    def price_moved(self, price_id: str, old: float, new: float):
+        self.log.info(f"Price of {price_id} moved {(new / old - 1) * 100:+.1f}%: {old} -> {new}")
@@ -4,6 +4,8 @@ import psycopg
 import datetime
 from bna.transfer import Transfer
 from bna.cex_listeners import Trade
+from bna.tags import IDENA_TAG_DELEGATE, IDENA_TAG_UNDELEGATE
+from bna.metrics import DB_LATENCY, timed
 
 
 class PgStore:
@@ -45,10 +47,19 @@ class PgStore:
         await self.conn.execute(open("bna/sql/create_tables.sql", 'r').read())
         await self.conn.commit()
 
+    @timed(DB_LATENCY)
     async def get_transfers(self, after: datetime.datetime, until=datetime.datetime.max) -> dict[(int, int), Transfer]:
         rows = await (await self.conn.execute('SELECT * from public."Transfers" WHERE time > (%s) AND time < (%s)', (after, until))).fetchall()
         return dict(map(lambda r: ((r[0], r[1]), Transfer.from_dict(r[3])), rows))
 
+    @timed(DB_LATENCY)
+    async def get_pool_transfers(self) -> list[Transfer]:
+        "All delegate and undelegate transfers, oldest first, found through transfer_tags_index"
+        rows = await (await self.conn.execute('SELECT data from public."Transfers" WHERE data->\'tags\' ?| %s ORDER BY time',
+                                              ([IDENA_TAG_DELEGATE, IDENA_TAG_UNDELEGATE],))).fetchall()
+        return [Transfer.from_dict(r[0]) for r in rows]
+
+    @timed(DB_LATENCY)
     async def get_transfers_by_hash(self, hashes: list[str]) -> list[Transfer]:
         if len(hashes) == 0:
             return []
@@ -61,24 +72,34 @@ class PgStore:
             hashes[tf.hash] = tf
         return list(hashes.values())
 
+    @timed(DB_LATENCY)
     async def get_trades(self, after: datetime.datetime, until=datetime.datetime.max) -> dict[(int, str), Trade]:
         rows = await (await self.conn.execute('SELECT * from public."Trades" WHERE time > (%s) AND time < (%s)', (after, until))).fetchall()
         return dict(map(lambda r: ((r[0], r[1]), Trade.from_dict(r[3])), rows))
 
+    @timed(DB_LATENCY)
+    async def get_prices(self, after: datetime.datetime) -> list[tuple[str, datetime.datetime, float]]:
+        rows = await (await self.conn.execute('SELECT price_id, time, price from public."Prices" WHERE time > (%s) ORDER BY time', (after,))).fetchall()
+        return [tuple(r) for r in rows]
+
+    @timed(DB_LATENCY)
     async def get_identity(self, addr: str) -> dict:
         row = await (await self.conn.execute('SELECT * from public."Identities" WHERE address = (%s)', (addr.lower(),))).fetchone()
         return row[2]
 
+    @timed(DB_LATENCY)
     async def get_identities(self) -> dict[str, dict]:
         rows = await (await self.conn.execute('SELECT * from public."Identities"')).fetchall()
         return dict(map(lambda r: (r[0], r[2]), rows))
 
+    @timed(DB_LATENCY)
     async def get_latest_block(self, chain: str) -> int:
         tf = await (await self.conn.execute(f'select (data) from public."Transfers" where data ->> \'chain\' = %s order by "time" desc limit 1', (chain,))).fetchone()
         if tf is None:
             return None
         return tf[0]['blockNumber']
 
+    @timed(DB_LATENCY)
     async def get_event(self, ev_id):
         row = await (await self.conn.execute('SELECT (channel, message, event) from public."Events" WHERE id = (%s)', (ev_id,))).fetchone()
         if not row:
@@ -88,7 +109,37 @@ class PgStore:
         ev = ev if type(row[2]) == dict else json.loads(row[2])  # why not done automatically?
         return row[0], row[1], ev
 
+    @timed(DB_LATENCY)
     async def insert_transfers(self, tfs: list[Transfer]):
+        await self._insert_transfers(tfs)
+        await self.conn.commit()
+
+    @timed(DB_LATENCY)
+    async def insert_trades(self, trs: list[Trade]):
+        await self._insert_trades(trs)
+        await self.conn.commit()
+
+    @timed(DB_LATENCY)
+    async def insert_batch(self, transfers: list[Transfer], trades: list[Trade]):
+        "Inserts transfers and trades in one transaction"
+        try:
+            if transfers:
+                await self._insert_transfers(transfers)
+            if trades:
+                await self._insert_trades(trades)
+            await self.conn.commit()
+        except Exception:
+            await self.conn.rollback()
+            raise
+
+    @timed(DB_LATENCY)
+    async def remove_transfers(self, tfs: list[Transfer]):
+        cur = self.conn.cursor()
+        await cur.executemany('DELETE FROM public."Transfers" WHERE blocknum=%s AND logindex=%s',
+                              [(tf.blockNumber, tf.logIndex) for tf in tfs])
+        await self.conn.commit()
+
+    async def _insert_transfers(self, tfs: list[Transfer]):
         cur = self.conn.cursor()
         seq = map(lambda tf: (tf.blockNumber, tf.logIndex, tf.timeStamp,
                               json.dumps(tf.to_dict())), tfs)
@@ -100,9 +151,8 @@ ON CONFLICT (blocknum, logindex) DO UPDATE
   SET time = excluded.time,
       data = excluded.data;
             """, seq)
-        await self.conn.commit()
 
-    async def insert_trades(self, trs: list[Trade]):
+    async def _insert_trades(self, trs: list[Trade]):
         cur = self.conn.cursor()
         seq = map(lambda tr: (tr.id, tr.market, tr.timeStamp,
                               json.dumps(tr.to_dict())), trs)
@@ -114,8 +164,25 @@ ON CONFLICT (id, market) DO UPDATE
   SET time = excluded.time,
       data = excluded.data;
             """, seq)
+
+    @timed(DB_LATENCY)
+    async def insert_prices(self, prices: list[tuple[str, datetime.datetime, float]]):
+        cur = self.conn.cursor()
+        await cur.executemany(\
+            """
+INSERT INTO public."Prices" (price_id, time, price)
+VALUES (%s, %s, %s)
+ON CONFLICT (price_id, time) DO UPDATE
+  SET price = excluded.price;
+            """, prices)
         await self.conn.commit()
 
+    @timed(DB_LATENCY)
+    async def remove_prices(self, before: datetime.datetime):
+        await self.conn.execute('DELETE FROM public."Prices" WHERE time < (%s)', (before,))
+        await self.conn.commit()
+
+    @timed(DB_LATENCY)
     async def insert_identities(self, idents: list[dict], full=False):
         cur = self.conn.cursor()
         seq = map(lambda ident: (ident['address'].lower(), datetime.datetime.fromtimestamp(ident['_fetchTime'], tz=datetime.timezone.utc),
@@ -134,6 +201,13 @@ ON CONFLICT (address) DO UPDATE
         """, seq)
         await self.conn.commit()
 
+    @timed(DB_LATENCY)
+    async def remove_identities(self, addrs: list[str]):
+        cur = self.conn.cursor()
+        await cur.execute('DELETE FROM public."Identities" WHERE address = ANY(%s)', (addrs,))
+        await self.conn.commit()
+
+    @timed(DB_LATENCY)
     async def insert_event(self, ev_dict: dict, chan_id: int, msg_id: int):
         cur = self.conn.cursor()
 
@@ -0,0 +1,103 @@
+import time
+import random
+import asyncio
+from logging import Logger
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Callable
+
+from bna.resilience import Backoff
+
+MAX_CONCURRENT_POLLS = 4
+IDLE_FACTOR = 1.5  # interval multiplier for every poll that found nothing new
+
+POLL_GROUP_CEX = 'cex'
+POLL_GROUP_PRICES = 'prices'
+
+
+@dataclass
+class PollSource:
+    name: str
+    min_interval: float
+    max_interval: float
+    groups: tuple[str, ...]
+    interval: float = 0
+    next_at: float = 0
+    polls: int = 0
+    active_polls: int = 0
+    failures: int = 0
+    refreshes: int = 0
+    wake: asyncio.Event = field(default_factory=asyncio.Event)
+    backoff: Backoff = None
+
+
+class PollScheduler:
+    """
+    Decides when each poller polls next. A source's interval grows by `IDLE_FACTOR` for every poll
+    that found nothing new, up to its maximum, and drops to the minimum after activity. Sources can
+    be told to poll right away with `refresh`, and at most `max_concurrent` polls run at once.
+    """
+    def __init__(self, log: Logger, max_concurrent: int = MAX_CONCURRENT_POLLS, idle_factor: float = IDLE_FACTOR,
+                 clock: Callable[[], float] = time.monotonic):
+        self.log = log.getChild("PL")
+        self.idle_factor = idle_factor
+        self.clock = clock
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.sources: dict[str, PollSource] = {}
+
+    def register(self, name: str, min_interval: float, max_interval: float, groups: tuple[str, ...] = ()) -> PollSource:
+        if name not in self.sources:
+            self.sources[name] = PollSource(name, min_interval, max_interval, groups, interval=min_interval,
+                                            next_at=self.clock(), backoff=Backoff(base=min_interval, cap=max_interval))
+        return self.sources[name]
+
+    async def wait(self, name: str):
+        "Sleeps until the source is due or refreshed"
+        s = self.sources[name]
+        while True:
+            delay = s.next_at - self.clock()
+            if delay <= 0:
+                return
+            s.wake.clear()
+            try:
+                await asyncio.wait_for(s.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    @asynccontextmanager
+    async def turn(self, name: str):
+        "Waits for the source's turn and holds one of the concurrent poll slots"
+        await self.wait(name)
+        async with self.semaphore:
+            yield
+
+    def done(self, name: str, activity: bool | int):
+        s = self.sources[name]
+        s.polls += 1
+        s.failures = 0
+        if activity:
+            s.active_polls += 1
+            s.interval = s.min_interval
+        else:
+            s.interval = min(s.max_interval, s.interval * self.idle_factor)
+        s.next_at = self.clock() + s.interval + random.random()
+
+    def failed(self, name: str):
+        s = self.sources[name]
+        s.failures += 1
+        s.next_at = self.clock() + s.backoff.delay(s.failures)
+
+    def refresh(self, name_or_group: str):
+        "Makes sources poll now, and keeps them at their minimum interval until they go idle again"
+        for s in self.sources.values():
+            if s.name == name_or_group or name_or_group in s.groups:
+                s.refreshes += 1
+                s.interval = s.min_interval
+                s.next_at = self.clock()
+                s.wake.set()
+
+    def metrics(self) -> dict[str, dict]:
+        now = self.clock()
+        return {s.name: {'interval': s.interval, 'next_in': max(0, s.next_at - now), 'polls': s.polls,
+                         'active_polls': s.active_polls, 'failures': s.failures, 'refreshes': s.refreshes}
+                for s in self.sources.values()}
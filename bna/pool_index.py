@@ -0,0 +1,132 @@
+from decimal import Decimal
+from datetime import datetime
+from dataclasses import dataclass, field
+
+from bna.tags import IDENA_TAG_DELEGATE, IDENA_TAG_UNDELEGATE, IDENA_TAG_KILL, IDENA_TAG_KILL_DELEGATOR
+from bna.transfer import Transfer
+
+MINING_STATES = {'Newbie', 'Verified', 'Human'}
+POOL_TAGS = [IDENA_TAG_DELEGATE, IDENA_TAG_UNDELEGATE, IDENA_TAG_KILL, IDENA_TAG_KILL_DELEGATOR]
+
+
+@dataclass
+class Pool:
+    addr: str
+    delegators: set[str] = field(default_factory=set)
+    stake: Decimal = Decimal(0)
+    age: int = 0
+    mining: int = 0  # delegators that mine through the pool while it's online
+    online: bool = False
+    is_pool: bool = False  # the pool's own identity is cached
+
+
+@dataclass
+class Delegation:
+    "The last delegate or undelegate transaction of an identity"
+    pool: str
+    tag: str
+    time: datetime
+    hash: str
+
+
+class PoolIndex:
+    """
+    Delegators of every pool with their stake and age totals, and the number of online miners,
+    updated one identity at a time as identities change. The delegation ledger remembers which
+    pool each identity last delegated to or undelegated from, even after the identity's
+    `delegatee` is cleared, and `pool_tfs` keeps the recent pool transfers for pool stats.
+    """
+    def __init__(self):
+        self.pools: dict[str, Pool] = {}
+        self.ledger: dict[str, Delegation] = {}
+        self.pool_tfs: dict[tuple[int, int], Transfer] = {}
+        self.solo_miners = 0  # online identities that mine on their own
+        self.pool_miners = 0  # mining delegators of online pools
+
+    def pool(self, addr: str) -> Pool:
+        if addr not in self.pools:
+            self.pools[addr] = Pool(addr)
+        return self.pools[addr]
+
+    def prune(self, pool: Pool):
+        if not pool.delegators and not pool.is_pool:
+            del self.pools[pool.addr]
+
+    def set_online(self, pool: Pool, online: bool):
+        if online != pool.online:
+            self.pool_miners += pool.mining if online else -pool.mining
+            pool.online = online
+
+    def add_mining(self, pool: Pool, n: int):
+        pool.mining += n
+        if pool.online:
+            self.pool_miners += n
+
+    def add(self, ident: dict, sign: int = 1):
+        "Counts an identity in, or out with `sign=-1`, the same way `online_miners` used to count them"
+        addr = ident['address'].lower()
+        mining = ident.get('state') in MINING_STATES
+        if ident.get('online'):
+            if not ident.get('isPool') or mining:
+                self.solo_miners += sign
+        if ident.get('isPool'):
+            pool = self.pool(addr)
+            pool.is_pool = sign > 0
+            self.set_online(pool, bool(ident.get('online')) and sign > 0)
+            self.prune(pool)
+        delegatee = ident.get('delegatee')
+        if delegatee:
+            pool = self.pool(delegatee.lower())
+            if sign > 0:
+                pool.delegators.add(addr)
+            else:
+                pool.delegators.discard(addr)
+            pool.stake += sign * Decimal(ident.get('stake') or 0)
+            pool.age += sign * int(ident.get('age') or 0)
+            if mining and not ident.get('online'):
+                self.add_mining(pool, sign)
+            self.prune(pool)
+
+    def remove(self, ident: dict):
+        self.add(ident, sign=-1)
+
+    def update(self, prev: dict | None, ident: dict | None):
+        if prev is not None:
+            self.remove(prev)
+        if ident is not None:
+            self.add(ident)
+
+    def rebuild(self, identities: dict[str, dict]):
+        self.pools.clear()
+        self.solo_miners = self.pool_miners = 0
+        for ident in identities.values():
+            self.add(ident)
+
+    def record(self, tf: Transfer):
+        "Adds a transfer to the ledger and the recent pool transfers if it's a pool transaction"
+        pool = tf.meta.get('pool')
+        tag = next((t for t in tf.tags if t in POOL_TAGS), None)
+        if not pool or not tag:
+            return
+        self.pool_tfs[(tf.blockNumber, tf.logIndex)] = tf
+        if tag in (IDENA_TAG_DELEGATE, IDENA_TAG_UNDELEGATE):
+            prev = self.ledger.get(tf.signer)
+            if prev is None or prev.time <= tf.timeStamp:
+                self.ledger[tf.signer] = Delegation(pool, tag, tf.timeStamp, tf.hash)
+
+    def recent(self, after: datetime) -> list[Transfer]:
+        return [tf for tf in self.pool_tfs.values() if tf.timeStamp > after]
+
+    def forget_before(self, before: datetime):
+        self.pool_tfs = {k: tf for k, tf in self.pool_tfs.items() if tf.timeStamp >= before}
+
+    def pool_of(self, addr: str, identities: dict[str, dict]) -> str | None:
+        "Pool of an identity, or the one it last delegated to or undelegated from"
+        delegatee = identities.get(addr, {}).get('delegatee')
+        if delegatee:
+            return delegatee.lower()
+        delegation = self.ledger.get(addr)
+        return delegation.pool if delegation else None
+
+    def online_miners(self) -> int:
+        return self.solo_miners + self.pool_miners
@@ -0,0 +1,190 @@
+import time
+from bisect import bisect_left
+from logging import Logger
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from collections.abc import MutableMapping
+from typing import Callable
+
+HISTORY_PERIOD = 7 * 24 * 3600  # kept in memory and in the store, older prices are removed from both
+STALE_AFTER = 600  # seconds without an update before a price is considered stale
+MOVE_THRESHOLD = 0.05  # relative change that subscribers are notified about by default
+MAX_PENDING = 10000  # prices kept for the store while it's down, the oldest ones are dropped first
+
+
+def to_timestamp(when: datetime | float) -> float:
+    return when.timestamp() if isinstance(when, datetime) else float(when)
+
+
+class PriceSeries:
+    "Time-ordered prices of one asset"
+    def __init__(self):
+        self.times: list[float] = []
+        self.prices: list[float] = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, ts: float, price: float):
+        if not self.times or ts > self.times[-1]:
+            self.times.append(ts)
+            self.prices.append(price)
+            return
+        i = bisect_left(self.times, ts)
+        if self.times[i] == ts:
+            self.prices[i] = price
+        else:
+            self.times.insert(i, ts)
+            self.prices.insert(i, price)
+
+    def trim(self, before: float):
+        i = bisect_left(self.times, before)
+        if i:
+            del self.times[:i]
+            del self.prices[:i]
+
+    def at(self, ts: float) -> float | None:
+        "Linearly interpolated price, the first or last known price outside of the series"
+        if not self.times:
+            return None
+        i = bisect_left(self.times, ts)
+        if i == len(self.times):
+            return self.prices[-1]
+        if i == 0 or self.times[i] == ts:
+            return self.prices[i]
+        t0, t1 = self.times[i - 1], self.times[i]
+        p0, p1 = self.prices[i - 1], self.prices[i]
+        return p0 + (p1 - p0) * (ts - t0) / (t1 - t0)
+
+
+@dataclass
+class PriceSubscription:
+    callback: Callable[[str, float, float], None]  # (price_id, old_price, new_price)
+    threshold: float
+    reference: dict[str, float] = field(default_factory=dict)
+
+
+class PriceService(MutableMapping):
+    """
+    Latest prices plus their recent history, keyed by price ID like "cg:idena". Works as a dict
+    of latest prices, and `price_at` gives the price at any point in time, so old transfers can
+    be valued at the price they happened at. Updates are written to the store on `flush`.
+    """
+    def __init__(self, log: Logger, initial: dict[str, float] = None, store=None,
+                 history_period: float = HISTORY_PERIOD, stale_after: float = STALE_AFTER,
+                 clock: Callable[[], float] = time.time):
+        self.log = log.getChild("PS")
+        self.store = store
+        self.history_period = history_period
+        self.stale_after = stale_after
+        self.clock = clock
+        # Initial prices are placeholders until the oracle updates them, so they have no history
+        self.latest: dict[str, float] = dict(initial) if initial else {}
+        self.updated_at: dict[str, float] = {}
+        self.series: dict[str, PriceSeries] = {}
+        self.pending: list[tuple[str, datetime, float]] = []
+        self.subscriptions: list[PriceSubscription] = []
+
+    def __getitem__(self, price_id: str) -> float:
+        return self.latest[price_id]
+
+    def __setitem__(self, price_id: str, price: float):
+        self.update(price_id, price)
+
+    def __delitem__(self, price_id: str):
+        del self.latest[price_id]
+        self.updated_at.pop(price_id, None)
+        self.series.pop(price_id, None)
+
+    def __iter__(self):
+        return iter(self.latest)
+
+    def __len__(self):
+        return len(self.latest)
+
+    def _add(self, price_id: str, price: float, ts: float):
+        series = self.series.get(price_id)
+        if series is None:
+            series = self.series[price_id] = PriceSeries()
+        series.add(ts, price)
+        series.trim(self.clock() - self.history_period)
+        if ts >= self.updated_at.get(price_id, 0):
+            self.latest[price_id] = price
+            self.updated_at[price_id] = ts
+
+    def update(self, price_id: str, price: float, when: datetime | float = None):
+        ts = to_timestamp(when) if when is not None else self.clock()
+        self._add(price_id, price, ts)
+        self.pending.append((price_id, datetime.fromtimestamp(ts, tz=timezone.utc), price))
+        self._notify(price_id, price)
+
+    def price_at(self, price_id: str, when: datetime | float) -> float:
+        "Raises KeyError for unknown prices, like the latest price lookup"
+        series = self.series.get(price_id)
+        price = series.at(to_timestamp(when)) if series else None
+        return price if price is not None else self.latest[price_id]
+
+    def age(self, price_id: str) -> float | None:
+        updated_at = self.updated_at.get(price_id)
+        return self.clock() - updated_at if updated_at is not None else None
+
+    def is_stale(self, price_id: str) -> bool:
+        age = self.age(price_id)
+        return age is None or age > self.stale_after
+
+    def stale(self) -> list[str]:
+        return [price_id for price_id in self.latest if self.is_stale(price_id)]
+
+    def subscribe(self, callback: Callable[[str, float, float], None], threshold: float = MOVE_THRESHOLD) -> PriceSubscription:
+        "`callback` is called when a price moves by more than `threshold` since the last notification"
+        sub = PriceSubscription(callback, threshold, reference=dict(self.latest))
+        self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: PriceSubscription):
+        self.subscriptions.remove(sub)
+
+    def _notify(self, price_id: str, price: float):
+        for sub in self.subscriptions:
+            ref = sub.reference.get(price_id)
+            if not ref:
+                sub.reference[price_id] = price
+                continue
+            if abs(price / ref - 1) < sub.threshold:
+                continue
+            sub.reference[price_id] = price
+            try:
+                sub.callback(price_id, ref, price)
+            except Exception as e:
+                self.log.error(f"Price subscriber failed for {price_id}: {e}", exc_info=True)
+
+    async def load(self):
+        "Loads the history period from the store"
+        after = datetime.fromtimestamp(self.clock() - self.history_period, tz=timezone.utc)
+        rows = await self.store.get_prices(after)
+        for price_id, when, price in rows:
+            self._add(price_id, price, to_timestamp(when))
+        self.log.debug(f"Loaded {len(rows)} prices for {len(self.series)} IDs")
+
+    async def flush(self):
+        if not self.pending or self.store is None:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            await self.store.insert_prices(rows)
+        except Exception as e:
+            self.log.error(f"Failed to store {len(rows)} prices: {e}", exc_info=True)
+            self.pending = rows + self.pending
+            if len(self.pending) > MAX_PENDING:
+                self.log.warning(f"Dropping {len(self.pending) - MAX_PENDING} oldest prices that weren't stored")
+                del self.pending[:-MAX_PENDING]
+            return
+        try:
+            await self.store.remove_prices(datetime.fromtimestamp(self.clock() - self.history_period, tz=timezone.utc))
+        except Exception as e:
+            self.log.error(f"Failed to remove old prices: {e}", exc_info=True)
+
+    def metrics(self) -> dict[str, dict]:
+        return {price_id: {'price': price, 'age': self.age(price_id), 'stale': self.is_stale(price_id),
+                           'points': len(self.series.get(price_id, ()))}
+                for price_id, price in self.latest.items()}
@@ -0,0 +1,132 @@
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+HEARTBEAT_INTERVAL = 0.01  # seconds between loop heartbeats
+SLOW_CALLBACK = 0.1  # seconds the loop has to be blocked for it to be reported
+MAX_STACK_DEPTH = 200
+# Frames below this are the event loop itself, which is in every sample
+LOOP_FRAME = asyncio.events.Handle._run.__code__
+
+
+@dataclass
+class LoopBlock:
+    "A stretch of time when the event loop didn't run anything else"
+    started: float
+    duration: float = 0
+    task: str = None
+    stacks: Counter = field(default_factory=Counter)
+
+
+def func_name(code) -> str:
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the thread running the event loop. A background thread samples
+    the loop thread's stack every `interval` seconds, so the profiled code isn't slowed down
+    by tracing. A heartbeat coroutine shows when the loop is blocked, and the blocking task
+    and its stacks are recorded as a `LoopBlock` when that lasts longer than `slow_callback`.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, interval: float = SAMPLE_INTERVAL,
+                 slow_callback: float = SLOW_CALLBACK):
+        self.loop = loop or asyncio.get_running_loop()
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.thread_id = threading.get_ident()
+        self.self_time: Counter = Counter()
+        self.cumulative: Counter = Counter()
+        self.tasks: Counter = Counter()
+        self.blocks: list[LoopBlock] = []
+        self.samples = 0
+        self.idle_samples = 0
+        self.beat = time.perf_counter()
+        self.block: LoopBlock = None
+        self.running = False
+        self.started = self.stopped = 0
+
+    async def heartbeat(self):
+        while self.running:
+            self.beat = time.perf_counter()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None and frame.f_code is not LOOP_FRAME and len(stack) < MAX_STACK_DEPTH:
+            stack.append(func_name(frame.f_code))
+            frame = frame.f_back
+        self.samples += 1
+        # Outside of a callback the loop is waiting in select() or scheduling, which isn't worth showing
+        if frame is None or not stack:
+            self.idle_samples += 1
+            return
+        task = asyncio.tasks._current_tasks.get(self.loop)
+        task_name = task.get_name() if task else 'callback'
+        self.tasks[task_name] += 1
+        self.self_time[stack[0]] += 1
+        for name in set(stack):
+            self.cumulative[name] += 1
+
+        blocked = time.perf_counter() - self.beat - HEARTBEAT_INTERVAL
+        if blocked > self.slow_callback:
+            if self.block is None or self.block.started != self.beat:
+                self.block = LoopBlock(started=self.beat, task=task_name)
+                self.blocks.append(self.block)
+            self.block.duration = blocked
+            self.block.stacks[' <- '.join(stack[:6])] += 1
+
+    def sampler(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    async def run(self, seconds: float):
+        "Profiles the loop for `seconds`, while it keeps running everything else"
+        self.running = True
+        self.started = time.perf_counter()
+        beat_task = asyncio.create_task(self.heartbeat(), name="profiler_heartbeat")
+        thread = threading.Thread(target=self.sampler, name="profiler_sampler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.running = False
+            self.stopped = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            await beat_task
+
+    def report(self, top: int = 25) -> str:
+        busy = self.samples - self.idle_samples
+        lines = [f"{self.samples} samples over {self.stopped - self.started:.1f}s, "
+                 f"loop busy in {busy} ({busy / max(self.samples, 1):.0%})", ""]
+        def table(title: str, counter: Counter):
+            lines.append(f"{title:<100}{'samples':>10}{'% busy':>10}")
+            for name, count in counter.most_common(top):
+                lines.append(f"{name[:99]:<100}{count:>10}{count / max(busy, 1):>10.1%}")
+            lines.append("")
+        table("Self time", self.self_time)
+        table("Cumulative time", self.cumulative)
+        table("Tasks", self.tasks)
+
+        blocks = sorted(self.blocks, key=lambda b: b.duration, reverse=True)
+        lines.append(f"Loop blocked for more than {self.slow_callback * 1000:.0f}ms {len(blocks)} times")
+        for b in blocks[:top]:
+            lines.append(f"{b.duration * 1000:8.0f}ms  task {b.task}")
+            for stack, _ in b.stacks.most_common(3):
+                lines.append(f"          {stack}")
+        return '\n'.join(lines)
+
+    def summary(self) -> str:
+        worst = max(self.blocks, key=lambda b: b.duration, default=None)
+        top_self = ', '.join(f"`{name.split(' ')[0]}`" for name, _ in self.self_time.most_common(3))
+        return (f"{self.samples} samples, {len(self.blocks)} slow callbacks"
+                + (f", worst {worst.duration * 1000:.0f}ms in task `{worst.task}`" if worst else "")
+                + (f". Most self time: {top_self}" if top_self else ""))
@@ -0,0 +1,184 @@
+import time
+import asyncio
+from logging import Logger
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+JOB_SEND = 'send'
+JOB_EDIT = 'edit'
+JOB_PRESENCE = 'presence'
+# Lower is more important: new notifications go out before cosmetic edits and status updates
+JOB_PRIORITIES = {JOB_SEND: 0, JOB_EDIT: 1, JOB_PRESENCE: 2}
+
+# Conservative (requests, seconds) limits per route, a bit below what Discord actually allows
+ROUTE_LIMITS = {
+    JOB_SEND: (5, 5),
+    JOB_EDIT: (5, 5),
+    JOB_PRESENCE: (1, 10),
+}
+
+
+class RateLimitBucket:
+    "Sliding window limiter for a single route"
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.times = deque()
+        self.blocked_until = 0
+
+    def delay(self, now: float) -> float:
+        "Returns how many seconds to wait before the next request on this route"
+        while self.times and now - self.times[0] >= self.period:
+            self.times.popleft()
+        wait = self.blocked_until - now
+        if len(self.times) >= self.limit:
+            wait = max(wait, self.times[0] + self.period - now)
+        return max(wait, 0)
+
+    def consume(self, now: float):
+        self.times.append(now)
+
+    def block(self, now: float, retry_after: float):
+        "Called when the server tells us to back off"
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+
+
+@dataclass
+class PublishJob:
+    kind: str
+    key: object
+    route: str
+    factory: Callable[[], Awaitable]
+    seq: int
+    attempts: int = 0
+    not_before: float = 0
+
+    @property
+    def priority(self) -> int:
+        return JOB_PRIORITIES[self.kind]
+
+
+class PublishScheduler:
+    """
+    Queues Discord requests and sends them respecting per-route rate limits.
+    Pending edits of the same message are coalesced (only the latest one is sent) and
+    pending presence updates are replaced by newer ones. Job factories are called only
+    when the job runs, so they should render the message from the current event state.
+    """
+    def __init__(self, log: Logger, limits: dict = None, max_attempts: int = 3,
+                 retry_delay: float = 5, clock: Callable[[], float] = time.monotonic):
+        self.log = log.getChild("PS")
+        self.limits = limits if limits is not None else ROUTE_LIMITS
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.buckets: dict[str, RateLimitBucket] = {}
+        self.pending: dict[tuple, PublishJob] = {}
+        self.stats = {'sent': 0, 'coalesced': 0, 'failed': 0, 'retried': 0}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+
+    def send(self, route: str, factory: Callable[[], Awaitable]):
+        "Schedule a new message. Sends are never coalesced."
+        self._seq += 1
+        self._add(PublishJob(JOB_SEND, self._seq, route, factory, self._seq))
+
+    def edit(self, route: str, msg_id: int, factory: Callable[[], Awaitable]) -> bool:
+        "Schedule an edit of message `msg_id`. Returns True if it replaced a pending edit."
+        return self._add_replacing(JOB_EDIT, msg_id, route, factory)
+
+    def presence(self, factory: Callable[[], Awaitable]) -> bool:
+        "Schedule a presence change. Returns True if it replaced a pending one."
+        return self._add_replacing(JOB_PRESENCE, None, JOB_PRESENCE, factory)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _add_replacing(self, kind: str, key, route: str, factory) -> bool:
+        job = self.pending.get((kind, key))
+        if job is not None:
+            job.factory = factory
+            self.stats['coalesced'] += 1
+            return True
+        self._seq += 1
+        self._add(PublishJob(kind, key, route, factory, self._seq))
+        return False
+
+    def _add(self, job: PublishJob):
+        self.pending[(job.kind, job.key)] = job
+        self._wakeup.set()
+
+    def _bucket(self, route: str) -> RateLimitBucket:
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            limit, period = self.limits.get(route.split(':')[0], self.limits[JOB_SEND])
+            bucket = self.buckets[route] = RateLimitBucket(limit, period)
+        return bucket
+
+    def _next_job(self) -> tuple[PublishJob | None, float | None]:
+        "Returns the most important job that can run now, or how long to wait for one"
+        now = self.clock()
+        best, wait = None, None
+        for job in self.pending.values():
+            delay = max(self._bucket(job.route).delay(now), job.not_before - now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                best = job
+        return best, wait
+
+    async def _run_job(self, job: PublishJob):
+        del self.pending[(job.kind, job.key)]
+        bucket = self._bucket(job.route)
+        bucket.consume(self.clock())
+        try:
+            await job.factory()
+            self.stats['sent'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.attempts += 1
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after:
+                bucket.block(self.clock(), retry_after)
+            if job.attempts >= self.max_attempts:
+                self.log.error(f"Giving up on {job.kind} job {job.key} after {job.attempts} attempts: {e}", exc_info=True)
+                self.stats['failed'] += 1
+                return
+            self.log.warning(f"Publish {job.kind} job {job.key} failed (attempt {job.attempts}): {e}")
+            self.stats['retried'] += 1
+            job.not_before = self.clock() + (retry_after or self.retry_delay)
+            # A newer edit or presence update could have been scheduled while this one was running
+            self.pending.setdefault((job.kind, job.key), job)
+
+    async def _step(self, block: bool) -> bool:
+        "Runs one job, waiting for it if needed. Returns False if there's nothing to wait for."
+        job, wait = self._next_job()
+        if job is not None:
+            await self._run_job(job)
+            return True
+        if wait is None and not block:
+            return False
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+    async def run(self):
+        self.log.info("Publish scheduler started")
+        while True:
+            try:
+                await self._step(block=True)
+            except asyncio.CancelledError:
+                self.log.debug("Cancelled")
+                break
+            except Exception as e:
+                self.log.error(f"Publish scheduler exception: {e}", exc_info=True)
+
+    async def drain(self):
+        "Runs jobs until none are pending"
+        while await self._step(block=False):
+            pass
@@ -0,0 +1,145 @@
+import json
+import time
+import base64
+import itertools
+from logging import Logger
+from urllib.parse import urlsplit
+
+RECORD_MAX_BYTES = 2 * 2**30  # recording stops when the file gets this big
+RECORDED_HEADERS = ('content-type', 'etag', 'last-modified')
+# Request fields that don't change what the response is, `key` is also a secret
+IGNORED_RPC_FIELDS = ('id', 'key')
+
+
+def encode_body(data: bytes | str | None) -> tuple[str | None, bool]:
+    "Text is stored as is, anything else as base64"
+    if data is None or isinstance(data, str):
+        return data, False
+    try:
+        return data.decode(), False
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode(), True
+
+def decode_body(data: str | None, b64: bool) -> bytes | str | None:
+    if data is None:
+        return None
+    return base64.b64decode(data) if b64 else data
+
+def redact(body: str | None) -> str | None:
+    "Removes the node API key from JSON-RPC requests"
+    if not body:
+        return body
+    try:
+        j = json.loads(body)
+    except ValueError:
+        return body
+    calls = j if isinstance(j, list) else [j]
+    if not any(isinstance(c, dict) and 'key' in c for c in calls):
+        return body
+    for c in calls:
+        if isinstance(c, dict) and 'key' in c:
+            c['key'] = ''
+    return json.dumps(j)
+
+def normalize_body(body: str | None) -> str | None:
+    "JSON-RPC ids and keys don't change the response, so requests are matched without them"
+    if not body:
+        return None
+    try:
+        j = json.loads(body)
+    except ValueError:
+        return body
+    calls = j if isinstance(j, list) else [j]
+    return json.dumps([{k: v for k, v in c.items() if k not in IGNORED_RPC_FIELDS} if isinstance(c, dict) else c
+                       for c in calls], sort_keys=True)
+
+def request_key(method: str, url: str, body: str | None) -> tuple:
+    "What requests are matched on during playback"
+    parts = urlsplit(url)
+    return (method.upper(), parts.netloc, parts.path or '/', parts.query, normalize_body(body))
+
+
+class RecordingWebSocket:
+    "Passes everything through to the websocket, recording the frames on the way"
+    def __init__(self, ws, recorder: 'Recorder', url: str):
+        self.ws = ws
+        self.recorder = recorder
+        self.conn = recorder.ws_open(url)
+
+    async def send(self, message):
+        self.recorder.ws_frame(self.conn, 'ws_send', message)
+        await self.ws.send(message)
+
+    async def recv(self):
+        message = await self.ws.recv()
+        self.recorder.ws_frame(self.conn, 'ws_recv', message)
+        return message
+
+    async def __aiter__(self):
+        async for message in self.ws:
+            self.recorder.ws_frame(self.conn, 'ws_recv', message)
+            yield message
+
+    async def close(self):
+        self.recorder.write({'type': 'ws_close', 'conn': self.conn})
+        await self.ws.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+
+class Recorder:
+    """
+    Appends raw HTTP requests and responses and websocket frames to a JSON lines file, so that
+    they can be served again by `bench.playback` without the nodes and exchanges. The node API key
+    is removed from requests, but URLs are recorded as they are, so recordings should be kept private.
+    """
+    def __init__(self, log: Logger, path: str, max_bytes: int = RECORD_MAX_BYTES):
+        self.log = log.getChild("RC")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = open(path, 'a', buffering=1)
+        self.size = self.file.tell()
+        self.conn_ids = itertools.count(int(time.time() * 1000))
+        self.stopped = False
+        self.log.info(f"Recording traffic to {path}")
+
+    def write(self, record: dict):
+        if self.stopped:
+            return
+        record['t'] = time.time()
+        line = json.dumps(record) + '\n'
+        self.file.write(line)
+        self.size += len(line)
+        if self.size > self.max_bytes:
+            self.log.warning(f"Recording reached {self.size / 2**20:.0f} MB, stopping")
+            self.close()
+
+    def http(self, method: str, url: str, endpoint: str, request: str | bytes | None, status: int,
+             headers: dict, body: bytes, latency: float):
+        request, _ = encode_body(request)
+        body, b64 = encode_body(body)
+        headers = {k: v for k, v in headers.items() if k.lower() in RECORDED_HEADERS}
+        self.write({'type': 'http', 'method': method, 'url': url, 'endpoint': endpoint, 'request': redact(request),
+                    'status': status, 'headers': headers, 'body': body, 'b64': b64, 'latency': latency})
+
+    def ws_open(self, url: str) -> int:
+        conn = next(self.conn_ids)
+        self.write({'type': 'ws_open', 'conn': conn, 'url': url})
+        return conn
+
+    def ws_frame(self, conn: int, kind: str, message: str | bytes):
+        # Binary frames stay binary even if they happen to be valid text
+        if isinstance(message, bytes):
+            data, b64 = base64.b64encode(message).decode(), True
+        else:
+            data, b64 = redact(message) if kind == 'ws_send' else message, False
+        self.write({'type': kind, 'conn': conn, 'data': data, 'b64': b64})
+
+    def wrap_ws(self, ws, url: str) -> RecordingWebSocket:
+        return RecordingWebSocket(ws, self, url)
+
+    def close(self):
+        if not self.stopped:
+            self.stopped = True
+            self.file.close()
@@ -0,0 +1,191 @@
+import time
+import random
+import asyncio
+from logging import Logger
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+FAILURE_THRESHOLD = 5  # consecutive failures before the breaker opens
+RESET_TIMEOUT = 30  # seconds before an open breaker lets a trial request through
+BUDGET_RATIO = 0.2  # retries can be at most this fraction of requests...
+BUDGET_MIN_RETRIES = 10  # ...but a few are always allowed
+BUDGET_WINDOW = 60
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Circuit for {endpoint} is open, retry in {retry_in:.0f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+@dataclass
+class Backoff:
+    "Exponential backoff with jitter, `delay(1)` is the delay after the first failure"
+    base: float = 0.5
+    cap: float = 30
+
+    def delay(self, attempt: int) -> float:
+        d = min(self.cap, self.base * 2 ** max(attempt - 1, 0))
+        return d / 2 + random.uniform(0, d / 2)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an endpoint after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds a single trial request is let through, if it succeeds the
+    breaker closes again, otherwise it stays open for another `reset_timeout`.
+    """
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def retry_in(self) -> float:
+        return max(0, self.opened_at + self.reset_timeout - self.clock())
+
+    def allow(self) -> bool:
+        if self.state == BREAKER_OPEN and self.retry_in() == 0:
+            self.state = BREAKER_HALF_OPEN
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_HALF_OPEN and not self.trial_running:
+            self.trial_running = True
+            return True
+        self.stats['rejected'] += 1
+        return False
+
+    def record_success(self):
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != BREAKER_OPEN:
+                self.stats['opened'] += 1
+            self.state = BREAKER_OPEN
+            self.opened_at = self.clock()
+
+
+class RetryBudget:
+    "Limits retries to a fraction of requests over a sliding window, so retries can't multiply load"
+    def __init__(self, ratio: float = BUDGET_RATIO, min_retries: int = BUDGET_MIN_RETRIES,
+                 window: float = BUDGET_WINDOW, clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.clock = clock
+        self.requests = deque()
+        self.retries = deque()
+        self.exhausted = 0
+
+    def _trim(self, now: float):
+        for times in (self.requests, self.retries):
+            while times and now - times[0] > self.window:
+                times.popleft()
+
+    def record_request(self):
+        self.requests.append(self.clock())
+
+    def try_retry(self) -> bool:
+        now = self.clock()
+        self._trim(now)
+        if len(self.retries) >= max(self.min_retries, self.ratio * len(self.requests)):
+            self.exhausted += 1
+            return False
+        self.retries.append(now)
+        return True
+
+
+class Resilience:
+    "Per-endpoint circuit breakers and retry budgets with a shared backoff policy"
+    def __init__(self, log: Logger, backoff: Backoff = None, failure_threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout: float = RESET_TIMEOUT, budget_ratio: float = BUDGET_RATIO,
+                 clock: Callable[[], float] = time.monotonic):
+        self.log = log.getChild("RS")
+        self.backoff = backoff if backoff else Backoff()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.budget_ratio = budget_ratio
+        self.clock = clock
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.budgets: dict[str, RetryBudget] = {}
+        self.retried: dict[str, int] = {}
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout, self.clock)
+        return self.breakers[endpoint]
+
+    def budget(self, endpoint: str) -> RetryBudget:
+        if endpoint not in self.budgets:
+            self.budgets[endpoint] = RetryBudget(self.budget_ratio, clock=self.clock)
+        return self.budgets[endpoint]
+
+    async def call(self, endpoint: str, fn: Callable[[], Awaitable], attempts: int = 1,
+                   retry_on: Callable[[Exception], bool] = None, backoff: Backoff = None):
+        """
+        Calls `fn` until it succeeds or `attempts` run out. Exceptions for which `retry_on` returns
+        False are raised right away and don't count against the endpoint's health.
+        Raises `CircuitOpenError` without calling `fn` if the endpoint's breaker is open.
+        """
+        breaker = self.breaker(endpoint)
+        budget = self.budget(endpoint)
+        backoff = backoff if backoff else self.backoff
+        budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                raise CircuitOpenError(endpoint, breaker.retry_in())
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                breaker.trial_running = False
+                raise
+            except Exception as e:
+                if retry_on is not None and not retry_on(e):
+                    breaker.trial_running = False
+                    raise
+                was_open = breaker.state == BREAKER_OPEN
+                breaker.record_failure()
+                if breaker.state == BREAKER_OPEN and not was_open:
+                    self.log.warning(f"Circuit for {endpoint} opened after {breaker.failures} failures: {e}")
+                if attempt >= attempts or breaker.state == BREAKER_OPEN or not budget.try_retry():
+                    raise
+                self.retried[endpoint] = self.retried.get(endpoint, 0) + 1
+                delay = backoff.delay(attempt)
+                self.log.debug(f'{endpoint} attempt #{attempt}/{attempts} failed: "{e}", retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            if breaker.state != BREAKER_CLOSED:
+                self.log.info(f"Circuit for {endpoint} closed")
+            breaker.record_success()
+            return result
+
+    def metrics(self) -> dict[str, dict]:
+        m = {}
+        for endpoint, breaker in self.breakers.items():
+            m[endpoint] = {
+                'state': breaker.state,
+                'failures': breaker.failures,
+                'opened': breaker.stats['opened'],
+                'rejected': breaker.stats['rejected'],
+                'retries': self.retried.get(endpoint, 0),
+                'budget_exhausted': self.budget(endpoint).exhausted,
+            }
+        return m
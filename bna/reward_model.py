@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from decimal import Decimal
+from datetime import datetime
+from dataclasses import dataclass
+
+from bna.pool_index import MINING_STATES
+
+STAKE_WEIGHT_POW = 0.9
+ALIVE_STATES = {'Newbie', 'Verified', 'Human', 'Suspended', 'Zombie'}
+
+
+@dataclass
+class EpochData:
+    "Reward inputs that only change once per epoch"
+    epoch: int
+    validation_time: datetime  # of the next validation
+    epoch_days: int
+    staking_rewards: float  # staking rewards paid in the previous validation
+
+
+@dataclass
+class IdentityRank:
+    addr: str
+    state: str
+    stake: Decimal
+    stake_rank: int
+    age: int
+    age_rank: int
+    network_size: int
+    rewards: float
+    apy: float
+
+
+def calculate_average(values: list[float], n: int) -> float:
+    if len(values) == 0:
+        return 0
+
+    step = len(values) / float(n)
+    total, cnt = 0.0, 0
+    for i in range(n):
+        index = int(round(step * i))
+        if index >= len(values):
+            index = len(values) - 1
+        total += values[index]
+        cnt += 1
+
+    return total / cnt
+
+
+class RewardModel:
+    """
+    Everything epoch rewards depend on besides an identity's own stake, computed once from an
+    identity refresh and the current epoch. Rewards and ranks of any identity then take a couple
+    of multiplications and a binary search, instead of scanning every identity.
+    """
+    def __init__(self, identities: dict[str, dict], epoch: EpochData, online_miners: int, version: int = 0):
+        self.epoch = epoch
+        self.online_miners = online_miners
+        self.version = version
+        self.total_weight = 0.0
+        miner_weights = []
+        stakes, ages = [], []
+        self.stakes: dict[str, Decimal] = {}
+        self.ages: dict[str, int] = {}
+        self.network_size = 0
+        for addr, ident in identities.items():
+            stake = Decimal(ident.get('stake', '0'))
+            age = int(ident.get('age', 0))
+            self.stakes[addr] = stake
+            self.ages[addr] = age
+            stakes.append(stake)
+            ages.append(age)
+            if ident.get('state') in ALIVE_STATES:
+                self.network_size += 1
+            if ident.get('state') in MINING_STATES:
+                weight = float(stake) ** STAKE_WEIGHT_POW
+                self.total_weight += weight
+                if ident.get('online') or identities.get(ident.get('delegatee'), {}).get('online', False):
+                    miner_weights.append(weight)
+        miner_weights.sort()
+        av1 = sum(miner_weights) / len(miner_weights) if miner_weights else 0
+        av2 = calculate_average(miner_weights, 101)
+        self.average_miner_weight = (av1 + av2) / 2
+        self.sorted_stakes = sorted(stakes)
+        self.sorted_ages = sorted(ages)
+
+    def rewards(self, stake: float) -> tuple[float, float]:
+        "Expected rewards for the epoch and the APY they make"
+        if stake <= 0 or self.online_miners == 0:
+            return 0.0, 0.0
+        stake_weight = stake ** STAKE_WEIGHT_POW
+        average_miner_weight = self.average_miner_weight
+        online_miners_count = self.online_miners
+        epoch_days = self.epoch.epoch_days
+
+        proposer_only_reward = (6 * stake_weight * 20) / (stake_weight * 20 + average_miner_weight * 100)
+        committee_only_reward = (6 * stake_weight) / (stake_weight + average_miner_weight * 119)
+        proposer_and_committee_reward = (6 * stake_weight * 21) / (stake_weight * 21 + average_miner_weight * 99)
+        proposer_probability = 1 / online_miners_count
+        committee_probability = min(100, online_miners_count) / online_miners_count
+        proposer_only_probability = proposer_probability * (1 - committee_probability)
+        committee_only_probability = committee_probability * (1 - proposer_probability)
+        proposer_and_committee_probability = proposer_only_probability * committee_only_probability
+        mining_rewards = ((85000 * epoch_days) / 21.0) * (proposer_only_probability * proposer_only_reward + committee_only_probability * committee_only_reward + proposer_and_committee_probability * proposer_and_committee_reward)
+        validation_rewards = (stake_weight / (stake_weight + self.total_weight)) * self.epoch.staking_rewards
+        rewards = mining_rewards + validation_rewards
+        apy = rewards * 100 / stake * 366 / epoch_days if epoch_days else 0.0
+        return rewards, apy
+
+    def count_at_least(self, values: list, own: dict, addr: str, value) -> int:
+        "Identities with at least `value`, with the identity itself counted at its current value"
+        count = len(values) - bisect_left(values, value)
+        prev = own.get(addr)
+        if prev is not None and prev >= value:
+            count -= 1
+        return count + 1
+
+    def rank(self, idents: list[dict]) -> list[IdentityRank]:
+        "Ranks and rewards of many identities in one go, for identities fresher than the model"
+        ranks = []
+        for ident in idents:
+            addr = ident['address'].lower()
+            stake = Decimal(ident.get('stake', '0'))
+            age = int(ident.get('age', 0))
+            rewards, apy = self.rewards(float(stake))
+            ranks.append(IdentityRank(addr=addr, state=ident.get('state'), stake=stake,
+                                      stake_rank=self.count_at_least(self.sorted_stakes, self.stakes, addr, stake),
+                                      age=age, age_rank=self.count_at_least(self.sorted_ages, self.ages, addr, age),
+                                      network_size=self.network_size, rewards=rewards, apy=apy))
+        return ranks
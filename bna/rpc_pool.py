@@ -0,0 +1,112 @@
+import time
+import random
+import asyncio
+from logging import Logger
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from bna.http_client import HttpClient
+from bna.metrics import RPC_LATENCY
+from bna.resilience import Backoff, CircuitOpenError, BREAKER_OPEN
+
+EWMA_ALPHA = 0.2
+INITIAL_LATENCY = 0.5
+
+
+def parse_urls(value: str | None) -> list[str]:
+    "Endpoints are configured as a comma separated list in a single env variable"
+    if not value:
+        return []
+    return [url.strip() for url in value.split(',') if url.strip()]
+
+
+@dataclass
+class RpcEndpoint:
+    url: str
+    name: str
+    latency: float = INITIAL_LATENCY  # moving average, in seconds
+    error_rate: float = 0  # moving average of failures, 0 to 1
+    requests: int = 0
+    errors: int = 0
+
+    def record(self, ok: bool, latency: float = None):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.error_rate += EWMA_ALPHA * ((0 if ok else 1) - self.error_rate)
+        if latency is not None:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+
+    def score(self) -> float:
+        "Routing weight, fast endpoints that don't fail get most of the calls"
+        return (1 - self.error_rate) ** 2 / max(self.latency, 0.01) + 0.01
+
+
+class RpcPool:
+    """
+    Routes JSON-RPC calls over several endpoints, weighted by their health score, and fails over
+    to other endpoints when a call fails. Calls with the same `sticky` key are sent to the same
+    endpoint until it fails, for call sequences that need a consistent view of the chain.
+    """
+    def __init__(self, name: str, urls: list[str], http: HttpClient, log: Logger, backoff: Backoff = None,
+                 clock: Callable[[], float] = time.monotonic):
+        if len(urls) == 0:
+            raise ValueError(f"No endpoints for RPC pool {name}")
+        self.name = name
+        self.log = log.getChild("RP")
+        self.http = http
+        self.backoff = backoff if backoff else Backoff(base=1, cap=10)
+        self.clock = clock
+        self.endpoints = [RpcEndpoint(url, f"{name}:{i}") for i, url in enumerate(urls)]
+        self.sticky: dict[str, RpcEndpoint] = {}
+
+    def is_available(self, ep: RpcEndpoint) -> bool:
+        breaker = self.http.resilience.breaker(ep.name)
+        return breaker.state != BREAKER_OPEN or breaker.retry_in() == 0
+
+    def pick(self, sticky: str = None, exclude: list[RpcEndpoint] = ()) -> RpcEndpoint:
+        ep = self.sticky.get(sticky) if sticky else None
+        if ep is None or ep in exclude or not self.is_available(ep):
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            candidates = [ep for ep in candidates if self.is_available(ep)] or candidates or self.endpoints
+            ep = random.choices(candidates, weights=[c.score() for c in candidates])[0]
+            if sticky:
+                self.sticky[sticky] = ep
+        return ep
+
+    def release(self, sticky: str):
+        self.sticky.pop(sticky, None)
+
+    async def request(self, payload: dict, check: Callable[[Any], Any] = None, attempts: int = None,
+                      sticky: str = None):
+        "Sends the call, trying other endpoints on failure and backing off after every endpoint failed"
+        attempts = attempts if attempts else len(self.endpoints) + 1
+        tried = []
+        last_exc = None
+        for attempt in range(attempts):
+            if len(tried) == len(self.endpoints):
+                await asyncio.sleep(self.backoff.delay(attempt // len(self.endpoints)))
+                tried.clear()
+            ep = self.pick(sticky, exclude=tried)
+            tried.append(ep)
+            start = self.clock()
+            try:
+                result = await self.http.post_json(ep.url, json=payload, endpoint=ep.name, check=check)
+                latency = self.clock() - start
+                ep.record(True, latency)
+                RPC_LATENCY.observe(latency, payload.get('method'), ep.name)
+                return result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_exc = e
+                if not isinstance(e, CircuitOpenError):
+                    ep.record(False)
+                if sticky:
+                    self.release(sticky)
+                self.log.warning(f'{ep.name} call #{attempt + 1}/{attempts} failed: "{e}"')
+        raise last_exc
+
+    def metrics(self) -> dict[str, dict]:
+        return {ep.name: {'latency': ep.latency, 'error_rate': ep.error_rate, 'score': ep.score(),
+                          'requests': ep.requests, 'errors': ep.errors} for ep in self.endpoints}
@@ -0,0 +1,164 @@
+import os
+import time
+import pickle
+import asyncio
+from logging import Logger
+from datetime import timedelta
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 5 * 60  # seconds
+SNAPSHOT_MAX_AGE = 6 * 60 * 60  # older snapshots are ignored and the caches are loaded from the store
+
+
+class Snapshot:
+    """
+    Saves the identity cache, the cached transfer and trade window and the block cursors to a
+    local file, so that a restart doesn't have to wait for Postgres to load them. After loading,
+    `reconcile` merges whatever the store has that the snapshot doesn't, and queues writes for
+    records the store is missing. Snapshots saved on shutdown are trusted right away, others
+    only after reconciling. Periodic snapshots are pickled and written in a thread, the event loop
+    only copies the cache's containers.
+    """
+    def __init__(self, db, log: Logger, path: str, interval: float = SNAPSHOT_INTERVAL, max_age: float = SNAPSHOT_MAX_AGE):
+        self.db = db
+        self.log = log.getChild("SN")
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.cursors: dict[str, int] = {}
+        self.loaded: dict = None
+        self.task: asyncio.Task = None
+        self.writing: asyncio.Future = None
+
+    def collect(self, clean: bool = False) -> dict:
+        "Copies the cache's containers, the records in them are shared since they're replaced rather than changed"
+        cache = self.db.cache
+        cursors = {}
+        for tf in cache['transfers'].values():
+            if tf.blockNumber > cursors.get(tf.chain, 0):
+                cursors[tf.chain] = tf.blockNumber
+        data = {
+            'version': SNAPSHOT_VERSION, 'saved_at': time.time(), 'clean': clean,
+            'identities': dict(cache['identities']), 'transfers': list(cache['transfers'].values()),
+            'trades': list(cache['trades'].values()), 'cursors': cursors,
+            'oldest_cached_tf': self.db.oldest_cached_tf, 'oldest_cached_tr': self.db.oldest_cached_tr,
+        }
+        return data
+
+    def write(self, data: dict):
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.log.debug(f"Saved snapshot with {len(data['identities'])} identities, {len(data['transfers'])} transfers, "
+                       f"{len(data['trades'])} trades in {time.perf_counter() - start:.2f}s")
+
+    def save(self, clean: bool = False):
+        self.write(self.collect(clean))
+
+    async def save_async(self):
+        "Saves a snapshot without blocking the event loop for the pickling and writing"
+        start = time.perf_counter()
+        data = self.collect()
+        self.log.debug(f"Collected snapshot data in {time.perf_counter() - start:.3f}s")
+        self.writing = asyncio.get_running_loop().run_in_executor(None, self.write, data)
+        # Shielded, so `close` can wait for the write instead of racing it for the file
+        await asyncio.shield(self.writing)
+
+    def load(self) -> bool:
+        "Fills the caches from the snapshot, returns False if there's no usable snapshot"
+        start = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            self.log.info(f"No snapshot at {self.path}")
+            return False
+        except Exception as e:
+            self.log.warning(f"Couldn't read snapshot {self.path}: {e}")
+            return False
+        age = time.time() - data.get('saved_at', 0)
+        if data.get('version') != SNAPSHOT_VERSION or age > self.max_age:
+            self.log.info(f"Ignoring snapshot, version {data.get('version')}, {age:.0f}s old")
+            return False
+
+        cache = self.db.cache
+        cache['identities'] = data['identities']
+        cache['transfers'].update(((tf.blockNumber, tf.logIndex), tf) for tf in data['transfers'])
+        cache['trades'].update(((tr.id, tr.market), tr) for tr in data['trades'])
+        self.cursors = data['cursors']
+        if data['clean']:
+            self.db.oldest_cached_tf = data['oldest_cached_tf']
+            self.db.oldest_cached_tr = data['oldest_cached_tr']
+        self.loaded = data
+        self.log.info(f"Loaded snapshot from {age:.0f}s ago ({'clean' if data['clean'] else 'unclean'} shutdown) "
+                      f"with {len(data['identities'])} identities, {len(data['transfers'])} transfers, "
+                      f"{len(data['trades'])} trades in {time.perf_counter() - start:.2f}s")
+        return True
+
+    async def reconcile(self):
+        "Merges the store's records into the loaded caches and writes what the store is missing"
+        data = self.loaded
+        store, writes = self.db.store, self.db.writes
+        start = time.perf_counter()
+
+        idents = await store.get_identities()
+        cached = self.db.cache['identities']
+        for addr, ident in idents.items():
+            if addr not in cached or ident.get('_fetchTime', 0) >= cached[addr].get('_fetchTime', 0):
+                cached[addr] = ident
+        self.db.pools.rebuild(cached)
+
+        tf_start = min((tf.timeStamp for tf in data['transfers']), default=None)
+        if tf_start:
+            stored = await store.get_transfers(tf_start - timedelta(seconds=1))
+            missing = {(tf.blockNumber, tf.logIndex): tf for tf in data['transfers'] if (tf.blockNumber, tf.logIndex) not in stored}
+            for k, tf in stored.items():
+                self.db.cache['transfers'].setdefault(k, tf)
+                self.db.pools.record(tf)
+            await writes.put('transfers', missing)
+        tr_start = min((tr.timeStamp for tr in data['trades']), default=None)
+        if tr_start:
+            stored = await store.get_trades(tr_start - timedelta(seconds=1))
+            missing = {(tr.id, tr.market): tr for tr in data['trades'] if (tr.id, tr.market) not in stored}
+            for k, tr in stored.items():
+                self.db.cache['trades'].setdefault(k, tr)
+            await writes.put('trades', missing)
+
+        if not data['clean']:
+            if tf_start:
+                self.db.oldest_cached_tf = tf_start
+            if tr_start:
+                self.db.oldest_cached_tr = tr_start
+        self.loaded = None
+        self.log.info(f"Reconciled snapshot with the store in {time.perf_counter() - start:.2f}s, "
+                      f"{len(writes)} records queued for the store")
+
+    async def run(self):
+        "Reconciles a loaded snapshot, then saves a new one every `interval` seconds"
+        if self.loaded:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                self.log.error(f"Failed to reconcile snapshot: {e}", exc_info=True)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save_async()
+            except Exception as e:
+                self.log.error(f"Failed to save snapshot: {e}", exc_info=True)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name="snapshot")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.writing:
+            await asyncio.gather(self.writing, return_exceptions=True)
+        self.save(clean=True)
@@ -20,6 +20,20 @@ CREATE INDEX IF NOT EXISTS transfer_time_index
     ("time" ASC NULLS LAST)
     TABLESPACE pg_default;
 
+-- DROP INDEX IF EXISTS public.transfer_hash_index;
+
+CREATE INDEX IF NOT EXISTS transfer_hash_index
+    ON public."Transfers" USING btree
+    ((data ->> 'hash'))
+    TABLESPACE pg_default;
+
+-- DROP INDEX IF EXISTS public.transfer_tags_index;
+
+CREATE INDEX IF NOT EXISTS transfer_tags_index
+    ON public."Transfers" USING gin
+    ((data -> 'tags'))
+    TABLESPACE pg_default;
+
 
 -- Table: public.Trades
 
@@ -69,3 +83,24 @@ CREATE TABLE IF NOT EXISTS public."Events"
 )
 
 TABLESPACE pg_default;
+
+-- Table: public.Prices
+
+-- DROP TABLE IF EXISTS public."Prices";
+
+CREATE TABLE IF NOT EXISTS public."Prices"
+(
+    price_id character varying(64) COLLATE pg_catalog."default" NOT NULL,
+    "time" timestamp with time zone NOT NULL,
+    price double precision NOT NULL,
+    CONSTRAINT "Prices_pkey" PRIMARY KEY (price_id, "time")
+)
+
+TABLESPACE pg_default;
+
+-- DROP INDEX IF EXISTS public.price_time_index;
+
+CREATE INDEX IF NOT EXISTS price_time_index
+    ON public."Prices" USING btree
+    ("time" ASC NULLS LAST)
+    TABLESPACE pg_default;
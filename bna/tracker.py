@@ -3,24 +3,31 @@ from copy import deepcopy
 from decimal import Decimal
 from logging import Logger
 from collections import defaultdict, deque
-from asyncio.queues import Queue as AsyncQueue
 from datetime import datetime, timedelta, timezone
 
 from bna.database import Database
+from bna.event_bus import EventChannel
+from bna.metrics import HOT_PATH_LATENCY, timed
+from bna.poll_scheduler import PollScheduler, POLL_GROUP_CEX
 from bna.config import TrackerConfig
 from bna.transfer import Transfer
 from bna.bsc_listener import NULL_ADDRESS
 from bna.cex_listeners import MARKET_BSC, MARKETS
-from bna.utils import any_in, aggregate_dex_trades
+from bna.utils import any_in, aggregate_dex_trades, utc_now
 from bna.event import *
 from bna.tags import *
 
+TRADE_CHECK_INTERVAL = 120  # seconds since the last trade event before trades are checked again
+
 class Tracker:
-    def __init__(self, db: Database, conf: TrackerConfig, bot,  bsc: AsyncQueue, idna: AsyncQueue, trades: AsyncQueue, event_chan: AsyncQueue, log: Logger):
+    def __init__(self, db: Database, conf: TrackerConfig, bot, chain: EventChannel, trades: EventChannel, event_chan: EventChannel, log: Logger,
+                 clock=None):
         self.db = db
+        # Replays run the tracker on historical time, so nothing here should look at the wall clock
+        self.clock = clock or getattr(db, 'clock', utc_now)
         self.conf = conf
-        self.bsc_chan = bsc
-        self.idna_chan = idna
+        # Both chain listeners write to this channel, events from each chain arrive in order
+        self.chain_chan = chain
         self.trade_chan = trades
         self.log = log.getChild("TR")
         self.tracker_event_chan = event_chan
@@ -35,38 +42,15 @@ class Tracker:
         self.identity_pool_events = defaultdict(deque)
         # Tracks time when the last trade notification happened
         self.trades_notified_at = datetime.min.replace(tzinfo=timezone.utc)
+        self.poll_scheduler: PollScheduler = None
 
     async def run(self):
         trade_task = asyncio.create_task(self.cex_trade_worker(), name="trade_worker")
         stats_task = asyncio.create_task(self.stats_worker(), name="stats_worker")
         while True:
             try:
-                chans = [asyncio.create_task(self.idna_chan.get()),
-                         asyncio.create_task(self.bsc_chan.get())]
-                event_task, pending = await asyncio.wait(chans, return_when=asyncio.FIRST_COMPLETED)
-                event: dict = list(event_task)[0].result()
-                for f in pending:
-                    f.cancel()
-                if type(event) != BlockEvent:
-                    self.log.debug(f'Received event: {event}')
-                try:
-                    # if event['type'] == 'transfers' and len(event['tfs']) > 0:
-                    if type(event) == ChainTransferEvent and len(event.tfs) > 0:
-                        await self.db.insert_transfers(event.tfs)
-                        has_tfs = len([tf for tf in event.tfs if not any_in(tf.tags, [IDENA_TAG_SUBMIT_FLIP, IDENA_TAG_ACTIVATE, IDENA_TAG_INVITE])]) > 0
-                        is_recent = max([tf.timeStamp for tf in event.tfs]) > datetime.now(tz=timezone.utc) - timedelta(seconds=self.conf.recent_transfers_period)
-                        if has_tfs and is_recent:
-                            await self.check_events()
-                        else:
-                            self.log.debug(f"No need to check transfers: {has_tfs=}, {is_recent=}")
-                    elif type(event) in [BlockEvent, ClubEvent]:
-                        self.tracker_event_chan.put_nowait(event)
-                    else:
-                        self.log.warning(f'Unsupported event: "{event=}"')
-                except Exception as e:
-                    self.log.error(f"Insert transfers exception: {e}", exc_info=True)
-                    self.log.error(f"Event from the exception: {event}")
-                    raise e
+                event = await self.chain_chan.get()
+                await self.handle_chain_event(event)
             except asyncio.CancelledError:
                 self.log.debug("Cancelled")
                 break
@@ -75,19 +59,69 @@ class Tracker:
         trade_task.cancel()
         stats_task.cancel()
 
+    async def handle_chain_event(self, event: Event):
+        "Stores transfers from a chain listener and checks for events if they're recent"
+        if type(event) != BlockEvent:
+            self.log.debug(f'Received event: {event}')
+        try:
+            # if event['type'] == 'transfers' and len(event['tfs']) > 0:
+            if type(event) == ChainTransferEvent and len(event.tfs) > 0:
+                await self.db.insert_transfers(event.tfs)
+                has_tfs = len([tf for tf in event.tfs if not any_in(tf.tags, [IDENA_TAG_SUBMIT_FLIP, IDENA_TAG_ACTIVATE, IDENA_TAG_INVITE])]) > 0
+                is_recent = max([tf.timeStamp for tf in event.tfs]) > self.clock() - timedelta(seconds=self.conf.recent_transfers_period)
+                if has_tfs and is_recent:
+                    await self.check_events()
+                else:
+                    self.log.debug(f"No need to check transfers: {has_tfs=}, {is_recent=}")
+            elif type(event) == ChainRevertEvent and len(event.tfs) > 0:
+                await self.revert_transfers(event.tfs)
+            elif type(event) in [BlockEvent, ClubEvent]:
+                await self.tracker_event_chan.put(event)
+            else:
+                self.log.warning(f'Unsupported event: "{event=}"')
+        except Exception as e:
+            self.log.error(f"Insert transfers exception: {e}", exc_info=True)
+            self.log.error(f"Event from the exception: {event}")
+            raise e
+
+    async def revert_transfers(self, tfs: list[Transfer]):
+        "Undoes everything that was derived from transfers that were reorged out of the chain"
+        hashes = {tf.hash for tf in tfs}
+        self.log.info(f"Reverting {len(tfs)} transfers: {hashes}")
+        await self.db.remove_transfers(tfs)
+        for hash in hashes:
+            self.hashes_notified.pop(hash, None)
+            self.sents_notified.pop(hash, None)
+        for tf in tfs:
+            for addr in tf.changes:
+                if addr in self.sents:
+                    self.sents[addr]['sents'].pop(tf.hash, None)
+                    self.sents[addr]['recvs'].pop(tf.hash, None)
+        for signer, signer_tfs in self.identity_pool_events.items():
+            self.identity_pool_events[signer] = deque(tf for tf in signer_tfs if tf.hash not in hashes)
+        for pools in self.pool_events.values():
+            for p_events in pools.values():
+                for addr in [addr for addr, ev in p_events.items() if ev.tfs[0].hash in hashes]:
+                    del p_events[addr]
+        # DEX volume and stats are computed from the stored transfers, so they're already correct
+        await self.tracker_event_chan.put(RetractEvent(hashes=sorted(hashes)))
+
+    @timed(HOT_PATH_LATENCY)
     async def check_events(self):
         "Get recent transfers and generate events if needed"
         tfs = await self.db.recent_transfers(self.conf.recent_transfers_period)
         self.log.debug(f"Checking {len(tfs)} transfers")
         if len(tfs) == 0:
             return
-        self.check_interesting_events(tfs)
-        self.check_dex_events(tfs)
-        self.check_transfers(tfs)
+        # The checks only collect events, they're published here so a full channel applies backpressure
+        # instead of raising after the notification state was already updated
+        events = self.check_interesting_events(tfs) + self.check_dex_events(tfs) + self.check_transfers(tfs)
+        for event in events:
+            await self.tracker_event_chan.put(event)
 
     # I wrote this function from scratch like five times and by the end of each time I couldn't tell
     # you how it worked or if it worked correctly. I'm not sure how it works now. Good luck.
-    def check_transfers(self, tfs):
+    def check_transfers(self, tfs) -> list[Event]:
         # Collect amounts of sent and received coins per address per hash, and all tfs for that address
         cur_sents = defaultdict(lambda: {'sents': {}, 'recvs': {}, 'tfs': []})
         for tf in tfs:
@@ -151,20 +185,20 @@ class Tracker:
                 events.append(ev)
 
         if len(events) > 0:
+            self.request_refresh(f"{len(events)} transfer events")
             self.log.debug(f"Publishing transfer events: {events}")
-            for event in events:
-                self.tracker_event_chan.put_nowait(event)
         # clean up old state
         states = [self.sents_notified, self.hashes_notified]
         for state in states:
             keys = list(state.keys())
-            now = datetime.now(tz=timezone.utc)
+            now = self.clock()
             for k in keys:
                 if now - state[k]['time'] > timedelta(seconds=max(self.conf.recent_transfers_period, 4 * 60 * 60)):
                     del state[k]
+        return events
 
-    def check_interesting_events(self, tfs: list[Transfer]):
-        "Picks out interesting transfers from `tfs` and emits events for them if needed"
+    def check_interesting_events(self, tfs: list[Transfer]) -> list[Event]:
+        "Picks out interesting transfers from `tfs` and returns events for them if needed"
         evs = []
         new_pool_stats = {'kill': defaultdict(dict), 'delegate': defaultdict(dict), 'undelegate': defaultdict(dict)}
         for tf in tfs:
@@ -199,7 +233,7 @@ class Tracker:
                         continue
                     if tf.hash not in [tf.hash for tf in self.identity_pool_events[tf.signer]]:
                         self.identity_pool_events[tf.signer].append(tf)
-                    if len([tf for tf in self.identity_pool_events[tf.signer] if datetime.now(tz=timezone.utc) - tf.timeStamp < timedelta(days=2)]) >= 3:
+                    if len([tf for tf in self.identity_pool_events[tf.signer] if self.clock() - tf.timeStamp < timedelta(days=2)]) >= 3:
                         self.log.warning(f"Identity {tf.signer} is spamming pool events, ignoring")
                         self.identity_pool_events[tf.signer].popleft()
                         self.hashes_notified[tf.hash]['time'] = tf.timeStamp
@@ -217,7 +251,7 @@ class Tracker:
                 self.pool_events[subtype][pool].update(p_events)
                 p_events = self.pool_events[subtype][pool].values()
                 unnotified = filter(lambda ev: ev._notified is False, p_events)
-                unnotified = list(filter(lambda ev: datetime.now(tz=timezone.utc) - ev.time < timedelta(seconds=self.conf.pool_identities_moved_period), unnotified))
+                unnotified = list(filter(lambda ev: self.clock() - ev.time < timedelta(seconds=self.conf.pool_identities_moved_period), unnotified))
                 if len(unnotified) >= self.conf.pool_identities_moved_threshold:
                     for ev in unnotified:
                         self.log.debug(f"{ev.addr=} {ev.stake=}")
@@ -232,19 +266,18 @@ class Tracker:
                         self.hashes_notified[event.tfs[0].hash]['time'] = event.time
         if len(evs) > 0:
             self.log.debug(f"Publishing picked events: {evs}")
-            for event in evs:
-                self.tracker_event_chan.put_nowait(event)
 
         # Remove old events from self.pool_events
         for subtype, pools in self.pool_events.items():
             for pool, p_events in pools.items():
                 for addr in list(p_events.keys()):
                     ev = p_events[addr]
-                    if datetime.now(tz=timezone.utc) - ev.time > timedelta(seconds=self.conf.pool_identities_moved_period + 60 * 60 * 2):
+                    if self.clock() - ev.time > timedelta(seconds=self.conf.pool_identities_moved_period + 60 * 60 * 2):
                         del p_events[addr]
+        return evs
 
-    def check_dex_events(self, tfs: list[Transfer]):
-        "Picks out DEX transfers from `tfs` and emits events for them if needed"
+    def check_dex_events(self, tfs: list[Transfer]) -> list[Event]:
+        "Picks out DEX transfers from `tfs` and returns events for them if needed"
         dex_volume = 0
         dex_tfs = []
         to_notify = []
@@ -267,42 +300,44 @@ class Tracker:
             for tf in dex_tfs:
                 self.hashes_notified[tf.hash]['time'] = tf.timeStamp
 
-        for tfs in to_notify:
-            tfs = tfs if type(tfs) is list else [tfs]
-            ev = DexEvent.from_tfs(tfs, self.db.known)
-            self.tracker_event_chan.put_nowait(ev)
+        if to_notify:
+            self.request_refresh(f"{len(to_notify)} DEX events")
+        return [DexEvent.from_tfs(tfs if type(tfs) is list else [tfs], self.db.known) for tfs in to_notify]
+
+    def request_refresh(self, reason: str):
+        "Large on-chain moves are often followed by exchange trades, so CEX pollers poll right away"
+        if self.poll_scheduler is not None:
+            self.log.debug(f"Requesting CEX refresh: {reason}")
+            self.poll_scheduler.refresh(POLL_GROUP_CEX)
 
     async def cex_trade_worker(self):
         "Consumes trades, checks for trade events"
+        # If a large trade occurs shortly after a trade notification, it wouldn't be shown until the
+        # next trade happens, which could be never. So getting trade events will return on a timeout
+        # and a check will happen if any trades arrived after the last check.
+        have_trades = False
         while True:
-            # If a large trade occurs shortly after a trade notification, it wouldn't be shown until the
-            # next trade happens, which could be never. So getting trade events will return on a timeout
-            # and a check will happen if any trades arrived after the last check.
-            have_trades = False
-            trades = None
             try:
-                chans = [asyncio.create_task(self.trade_chan.get())]
-                event_task, pending = await asyncio.wait(chans, return_when=asyncio.FIRST_COMPLETED, timeout=10)
-                for f in pending:
-                    f.cancel()
-                if event_task:
-                    trades: list[dict] | None = list(event_task)[0].result()
+                try:
+                    trades: list[dict] | None = await self.trade_chan.get(timeout=10)
+                except asyncio.TimeoutError:
+                    trades = None
+                if trades:
                     self.log.info(f"Got trades, {len(trades)=}")
                     # self.log.debug(f"Got trades: {trades}")
                     await self.db.insert_trades(trades)
                     have_trades = True
 
-                if datetime.now(tz=timezone.utc) - self.trades_notified_at > timedelta(seconds=120) and have_trades:
+                if self.clock() - self.trades_notified_at > timedelta(seconds=TRADE_CHECK_INTERVAL) and have_trades:
                     await self.check_cex_events()
                     have_trades = False
-                elif trades:
-                    have_trades = True
             except Exception as e:
                 self.log.error(f'Trade worker exception: "{e}"', exc_info=True)
 
+    @timed(HOT_PATH_LATENCY)
     async def check_cex_events(self):
         "Get recent trades and generate events if volume is higher than `cex_trades_threshold`"
-        now = datetime.now(tz=timezone.utc)
+        now = self.clock()
         trades = await self.db.recent_trades(self.trades_notified_at, self.conf.cex_volume_period)
         self.log.debug(f"{[tr.id for tr in trades]}")
         total_usd_val = sum([t.usd_value for t in trades])
@@ -338,7 +373,7 @@ class Tracker:
         event = CexEvent(markets=final_markets, total_buy_val=total_buy_val, total_sell_val=total_sell_val)
         self.log.info(f"Created trade event: {event}")
         self.trades_notified_at = now
-        self.tracker_event_chan.put_nowait(event)
+        await self.tracker_event_chan.put(event)
 
     async def stats_worker(self):
         "Generates stats events every `stats_interval` seconds"
@@ -347,11 +382,12 @@ class Tracker:
             while True:
                 await asyncio.sleep(self.conf.stats_interval)
                 ev = await self.generate_stats_event()
-                self.tracker_event_chan.put_nowait(ev)
+                await self.tracker_event_chan.put(ev)
         except Exception as e:
             self.log.error(f'Stats exception: "{e}"', exc_info=True)
             await asyncio.sleep(self.conf.stats_interval)
 
+    @timed(HOT_PATH_LATENCY)
     async def generate_stats_event(self, period=None) -> StatsEvent:
         if not period:
             period = self.conf.stats_interval
@@ -464,7 +500,7 @@ class Tracker:
     async def generate_pool_stats(self, period=None, long: bool=False) -> PoolStatsEvent | None:
         if not period:
             period = self.conf.stats_interval
-        all_tfs = await self.db.recent_transfers(period)
+        all_tfs = await self.db.recent_pool_transfers(period)
 
         ev = PoolStatsEvent(period=period)
         for tf in all_tfs:
@@ -523,5 +559,5 @@ class Tracker:
         else:
             raise Exception(f"Unknown event type: {ev_type}")
         ev = ev_constructor(**ev)
-        self.tracker_event_chan.put_nowait(ev)
+        await self.tracker_event_chan.put(ev)
 
@@ -1,6 +1,12 @@
 from decimal import Decimal
+from datetime import datetime, timezone
 from disnake import Color
 from bna.tags import *
+from bna.price_service import PriceService
+
+def utc_now() -> datetime:
+    "Default clock, replays pass their own to make the tracker run on historical time"
+    return datetime.now(tz=timezone.utc)
 
 def shorten(addr, length=5):
     addr = addr.strip().replace('0x', '')
@@ -14,24 +20,32 @@ def any_in(check_these: list, for_these: list):
     "Check that any tag in `for_these` is present in `check_these`"
     return any([tag in for_these for tag in check_these])
 
-def calculate_usd_value(tf, prices: dict, known: dict) -> float:
+def price_of(prices: dict | PriceService, price_id: str, when=None) -> float:
+    "Price at the given time if there's price history, the latest one otherwise"
+    if when is not None and isinstance(prices, PriceService):
+        return prices.price_at(price_id, when)
+    return prices[price_id]
+
+def calculate_usd_value(tf, prices: dict | PriceService, known: dict) -> float:
+    "Values the transfer at the prices at the time it happened"
     value = 0
+    when = tf.timeStamp
     if DEX_TAG in tf.tags:
         if any_in(tf.tags, DEX_LP_TAGS):
             for pool_addr, pool_ch in tf.meta.get('lp', {}).items():
-                token_price = prices[known[known[pool_addr]['token1']]['price_id']]
-                value += abs(float(pool_ch['token'])) * token_price + abs(float(pool_ch['idna'])) * prices['cg:idena']
+                token_price = price_of(prices, known[known[pool_addr]['token1']]['price_id'], when)
+                value += abs(float(pool_ch['token'])) * token_price + abs(float(pool_ch['idna'])) * price_of(prices, 'cg:idena', when)
         elif DEX_TAG_ARB in tf.tags:
             # This will usually be incorrect, but I think it should be done anyway
             for token_addr, change in tf.meta.get('token', {}).items():
-                token_price = prices[known[token_addr]['price_id']]
+                token_price = price_of(prices, known[token_addr]['price_id'], when)
                 value += float(change) * token_price
         elif any_in(tf.tags, DEX_TRADE_TAGS):
             for token_addr, change in tf.meta.get('token', {}).items():
-                token_price = prices[known[token_addr]['price_id']]
+                token_price = price_of(prices, known[token_addr]['price_id'], when)
                 value += abs(float(change)) * token_price
     else:
-        value = abs(float(tf.value())) * prices['cg:idena']
+        value = abs(float(tf.value())) * price_of(prices, 'cg:idena', when)
     return value
 
 def aggregate_dex_trades(tfs, known_addr: dict) -> dict:
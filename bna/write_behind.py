@@ -0,0 +1,113 @@
+import asyncio
+from logging import Logger
+from itertools import islice
+from typing import Awaitable, Callable, Hashable
+
+from bna.resilience import Backoff
+
+FLUSH_INTERVAL = 1  # seconds between flushes when records are trickling in
+MAX_BATCH = 2000  # records per table in one transaction
+MAX_PENDING = 50_000  # records waiting for the store before writers have to wait for a flush
+
+
+class WriteBehind:
+    """
+    Queues records for the backing store and writes them from a background task, all tables
+    in one transaction per batch. Records are keyed like the cache, so a record that changes
+    before it's written is only written once. When `max_pending` records are waiting, `put`
+    waits for the flusher, which keeps memory bounded while the store is slow or down.
+    """
+    def __init__(self, log: Logger, write: Callable[..., Awaitable], tables: tuple[str, ...],
+                 flush_interval: float = FLUSH_INTERVAL, max_batch: int = MAX_BATCH, max_pending: int = MAX_PENDING):
+        self.log = log.getChild("WB")
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.pending: dict[str, dict[Hashable, object]] = {t: {} for t in tables}
+        self.wake = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.lock = asyncio.Lock()
+        self.backoff = Backoff(base=flush_interval, cap=60)
+        self.task: asyncio.Task = None
+        self.stats = {'queued': 0, 'coalesced': 0, 'written': 0, 'batches': 0, 'failures': 0, 'waits': 0}
+
+    def __len__(self):
+        return sum(len(p) for p in self.pending.values())
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name="write_behind")
+
+    async def put(self, table: str, records: dict[Hashable, object]):
+        while len(self) >= self.max_pending:
+            self.stats['waits'] += 1
+            self.not_full.clear()
+            self.wake.set()
+            await self.not_full.wait()
+        pending = self.pending[table]
+        for k, r in records.items():
+            if k in pending:
+                self.stats['coalesced'] += 1
+            pending[k] = r
+        self.stats['queued'] += len(records)
+        if len(pending) >= self.max_batch:
+            self.wake.set()
+
+    def discard(self, table: str, key: Hashable):
+        self.pending[table].pop(key, None)
+
+    async def flush(self):
+        "Writes everything that's pending. Failed batches stay queued and the error is raised."
+        async with self.lock:
+            while len(self):
+                batch = {t: dict(islice(p.items(), self.max_batch)) for t, p in self.pending.items()}
+                try:
+                    await self.write(**{t: list(b.values()) for t, b in batch.items()})
+                except Exception:
+                    self.stats['failures'] += 1
+                    raise
+                for t, b in batch.items():
+                    pending = self.pending[t]
+                    for k, r in b.items():
+                        # A newer version that was queued during the write stays for the next batch
+                        if pending.get(k) is r:
+                            del pending[k]
+                self.stats['batches'] += 1
+                self.stats['written'] += sum(len(b) for b in batch.values())
+                if len(self) < self.max_pending:
+                    self.not_full.set()
+
+    async def run(self):
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.log.error(f"Failed to write {len(self)} records, attempt {failures}: {e}", exc_info=failures == 1)
+                await asyncio.sleep(self.backoff.delay(failures))
+
+    async def close(self):
+        "Stops the flusher and writes what's left"
+        if self.task:
+            # Not in the middle of a write, so the connection isn't left with half a transaction
+            async with self.lock:
+                self.task.cancel()
+                await asyncio.gather(self.task, return_exceptions=True)
+                self.task = None
+        if len(self):
+            self.log.info(f"Writing {len(self)} pending records before closing")
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return {**self.stats, 'pending': {t: len(p) for t, p in self.pending.items()}}
@@ -3,16 +3,20 @@ import sys
 import asyncio
 from decimal import getcontext
 from logging import Logger
-from asyncio.queues import Queue as AsyncQueue
 
 from bna import init_logging
 from bna.config import Config
 from bna.database import Database
+from bna.event_bus import EventBus
+from bna.http_client import HttpClient
+from bna.recorder import Recorder
+from bna.metrics import REGISTRY, MetricsServer
+from bna.poll_scheduler import PollScheduler, POLL_GROUP_CEX
 from bna.discord_bot import Bot, create_bot
 from bna.bsc_listener import BscListener
 from bna.idena_listener import IdenaListener
 from bna.tracker import Tracker
-from bna.cex_listeners import bitmart_trades, probit_trades, vitex_trades
+from bna.cex_listeners import BitmartConnector, ProbitConnector, VitexConnector
 from bna.oracle import Oracle
 
 # TODO:
@@ -28,43 +32,89 @@ from bna.oracle import Oracle
 # - None (as a 10x engineer)
 # - Signer field breaks MEV bots. But without signer buyer addresses would be pools
 # - Plenty of memory leaks (some tagged with todo, others left as an exercise to the reader)
-# - Removed logs don't remove notifications or roll back state, but there's a time buffer before finality
-# - Impossible to tell which pool the node undelegated from unless you catch the TX live
+# - Pool of an undelegation is unknown if the identity isn't cached and its delegation was never stored
 # HARD-CODED:
 # - No separation of transfers between chains
 # - Assumption (stemming from no chain separation) that zero address is the bridge
 # - Stored invites don't identify the sender and the recepient, but it's not needed anywhere
 # - Mass pool event threshold is bounded by regular transfers threshold, but can be solved by state persistence
-# - When fetching old TXes their values are calculated based on the current price
+# - When fetching TXes older than the stored price history their values are calculated based on the oldest price
+
+def register_metrics(db: Database, bot: Bot, bus: EventBus, http: HttpClient, scheduler: PollScheduler,
+                     bsc: BscListener, idna: IdenaListener):
+    "Values that the components already keep, read only when metrics are scraped"
+    REGISTRY.gauge('bna_block_lag_seconds', "Age of the oldest block that wasn't processed yet", labels=('chain',),
+                   collect=lambda: {'idena': idna.lag(), 'bsc': bsc.lag()[1]})
+    REGISTRY.gauge('bna_block_lag_blocks', "Blocks between the head and the oldest unprocessed block", labels=('chain',),
+                   collect=lambda: {'bsc': bsc.lag()[0]})
+    REGISTRY.gauge('bna_last_block', "Last block seen", labels=('chain',),
+                   collect=lambda: {'idena': idna.last_block, 'bsc': bsc.last_block})
+    REGISTRY.gauge('bna_queue_depth', "Events waiting in a channel", labels=('channel',),
+                   collect=lambda: {name: m['depth'] for name, m in bus.metrics().items()})
+    REGISTRY.gauge('bna_queue_lag_seconds', "Delivery lag of a channel", labels=('channel',),
+                   collect=lambda: {name: m['lag'] for name, m in bus.metrics().items()})
+    REGISTRY.gauge('bna_cache_size', "Entries in in-memory caches", labels=('cache',),
+                   collect=lambda: {'transfers': len(db.cache['transfers']), 'trades': len(db.cache['trades']),
+                                    'identities': len(db.cache['identities']), 'tx_signers': len(bsc.tx_signers),
+                                    'idena_txs': len(idna.tx_cache), 'ev_to_msg': len(bot.ev_to_msg),
+                                    'describe': len(bot.describe_cache), 'pending_writes': len(db.writes)})
+    REGISTRY.counter('bna_http_requests_total', "HTTP requests per endpoint", labels=('endpoint',),
+                     collect=lambda: {e: m['requests'] for e, m in http.metrics().items()})
+    REGISTRY.counter('bna_http_errors_total', "Failed HTTP requests per endpoint", labels=('endpoint',),
+                     collect=lambda: {e: m['errors'] for e, m in http.metrics().items()})
+    REGISTRY.counter('bna_idena_tx_cache_total', "Block transactions found in the mempool cache or fetched", labels=('result',),
+                     collect=lambda: {'hit': idna.tx_cache.hits, 'miss': idna.tx_cache.misses})
+    REGISTRY.gauge('bna_poll_interval_seconds', "Current interval of a poller", labels=('source',),
+                   collect=lambda: {s: m['interval'] for s, m in scheduler.metrics().items()})
+    REGISTRY.gauge('bna_price_age_seconds', "Seconds since a price was updated", labels=('price_id',),
+                   collect=lambda: {p: m['age'] for p, m in db.prices.metrics().items()})
 
 async def main(db: Database, bot: Bot, conf: Config, log: Logger):
     log.info("Starting tasks")
     passive = '-passive' in sys.argv
     try:
         await db.connect(drop_existing=False)
-        bsc = BscListener(conf=conf.bsc, db=db, log=log)
-        idna = IdenaListener(conf=conf.idena, db=db, log=log)
-        oracle = Oracle(db, log)
-        bsc_event_chan = AsyncQueue()
-        idna_event_chan = AsyncQueue()
-        trade_event_chan = AsyncQueue()
-        tracker_event_chan = AsyncQueue()
+        http = HttpClient(log)
+        if os.environ.get('RECORD_PATH'):
+            http.recorder = Recorder(log, os.environ['RECORD_PATH'])
+        scheduler = PollScheduler(log)
+        bsc = BscListener(conf=conf.bsc, db=db, log=log, http=http)
+        idna = IdenaListener(conf=conf.idena, db=db, log=log, http=http)
+        oracle = Oracle(db, log, http=http, dex_price=bsc.dex_price, scheduler=scheduler)
+        # Exchanges are checked right away when the iDNA price moves
+        db.prices.subscribe(lambda price_id, old, new: scheduler.refresh(POLL_GROUP_CEX) if price_id == 'cg:idena' else None,
+                            threshold=0.01)
+        bus = EventBus(log)
+        chain_event_chan = bus.channel('chain')
+        trade_event_chan = bus.channel('trades', capacity=1000)
+        tracker_event_chan = bus.channel('tracker')
         cex_log = log.getChild("CX")
         if not passive:
-            asyncio.create_task(bitmart_trades(cex_log, conf.cex, db.prices, trade_event_chan), name="bitmart_trades")
-            asyncio.create_task(probit_trades(cex_log, conf.cex, db.prices, trade_event_chan), name="probit_trades")
-            asyncio.create_task(vitex_trades(cex_log, conf.cex, db.prices, trade_event_chan), name="vitex_trades")
-            asyncio.create_task(idna.run(idna_event_chan), name="idna_run")
-            asyncio.create_task(bsc.run(bsc_event_chan), name="bsc_run")
+            for connector in (BitmartConnector, ProbitConnector, VitexConnector):
+                market = connector.market.upper()
+                cex = connector(cex_log, conf.cex, db.prices, http, ws_url=os.environ.get(f'{market}_WS_URL'),
+                                rest_url=os.environ.get(f'{market}_REST_URL'), scheduler=scheduler)
+                asyncio.create_task(cex.run(trade_event_chan), name=f"{cex.market}_trades")
+            asyncio.create_task(idna.run(chain_event_chan), name="idna_run")
+            asyncio.create_task(bsc.run(chain_event_chan), name="bsc_run")
         cg_tokens = db.addrs_of_type('token', full=True)
         # log.info(f"{cg_tokens=}")
         asyncio.create_task(oracle.run(cg_tokens), name="oracle_run")
-        t = Tracker(bsc=bsc_event_chan, conf=conf.tracker, bot=bot, idna=idna_event_chan,
+        t = Tracker(chain=chain_event_chan, conf=conf.tracker, bot=bot,
                     trades=trade_event_chan, event_chan=tracker_event_chan, db=db, log=log)
         bot.tracker = t  # @TODO: DIRTY
+        t.poll_scheduler = scheduler  # @TODO: DIRTY
+        bot.poll_scheduler = scheduler  # @TODO: DIRTY
+        bot.bus = bus  # @TODO: DIRTY
+        bot.http = http  # @TODO: DIRTY
         bot.bsc_listener = bsc  # @TODO: DIRTY
         bot.idena_listener = idna  # @TODO: DIRTY
         asyncio.create_task(t.run(), name="tracker_run")
+        metrics_server = None
+        if os.environ.get('METRICS_PORT'):
+            register_metrics(db, bot, bus, http, scheduler, bsc, idna)
+            metrics_server = MetricsServer(log, int(os.environ['METRICS_PORT']))
+            await metrics_server.start()
 
         if not passive:
             log.debug("Tasks started, waiting to check for events...")
@@ -73,6 +123,11 @@ async def main(db: Database, bot: Bot, conf: Config, log: Logger):
 
         await bot.run_publisher(tracker_event_chan)
         log.info("Main stopping")
+        if metrics_server:
+            await metrics_server.stop()
+        await http.close()
+        if http.recorder:
+            http.recorder.close()
         await db.close()
     except Exception as e:
         log.error(f"Main exception: {e}", exc_info=True)
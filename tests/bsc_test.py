@@ -1,6 +1,18 @@
+import asyncio
+import logging
+import pytest
 from decimal import Decimal
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bna import bsc_listener
+from bna.config import Config, BscConfig
+from bna.event import ChainRevertEvent, ChainTransferEvent
+from bna.event_bus import EventChannel
 from bna.transfer import Transfer, BscLog
-from bna.bsc_listener import BscListener
+from bna.bsc_listener import BscListener, JournaledBlock, NULL_ADDRESS, REVISION_DELAY
+from bna.resilience import Backoff, BREAKER_CLOSED
+from bna.rpc_pool import RpcPool
+from bench.tracker_bench import BenchDatabase
 
 logs = [([
     {
@@ -67,3 +79,88 @@ def test_squash():
       tfs = list(map(lambda bl: Transfer.from_bsc_log(bl), blogs))
       sq = BscListener.squash(tfs)
       assert sq == case[1]
+
+
+def bsc_log(raw: dict, **kwargs) -> BscLog:
+    log = BscLog(**{**raw, **kwargs})
+    log.convert()
+    return log
+
+
+@pytest.fixture
+def listener(monkeypatch):
+    monkeypatch.setenv('BSC_RPC_URL', 'http://127.0.0.1:1')
+    monkeypatch.setenv('BSC_WS_URL', 'ws://127.0.0.1:1')
+    listener = BscListener(BscConfig(), BenchDatabase(logging.getLogger(), Config(), {}), logging.getLogger())
+    blogs = [bsc_log(l) for l in logs[0][0]]
+    num = blogs[0].blockNumber
+    listener.tx_signers[blogs[0].transactionHash] = NULL_ADDRESS
+    listener.journal[num] = JournaledBlock(blogs[0].blockHash, {l.logIndex: l for l in blogs}, listener.process_block(blogs))
+    return listener
+
+
+@pytest.mark.asyncio
+async def test_removed_log_revises_block(listener):
+    num, entry = listener.journal.peekitem(0)
+    sent = entry.tfs[0]
+    removed = bsc_log(logs[0][0][2], removed=True)
+    assert listener.revise(removed)
+    assert not listener.revise(removed)
+
+    chan = EventChannel('chain')
+    listener.revised[num] -= REVISION_DELAY
+    await listener.process_revisions(chan)
+    revert, added = chan.get_nowait(), chan.get_nowait()
+    assert isinstance(revert, ChainRevertEvent) and revert.tfs == [sent]
+    assert isinstance(added, ChainTransferEvent) and added.tfs[0].hash == sent.hash
+    assert added.tfs[0].changes != sent.changes and added.tfs[0].meta['block_hash'] == entry.hash
+    assert num not in listener.revised and entry.tfs == added.tfs
+
+
+@pytest.mark.asyncio
+async def test_replaced_head_reverts_block(listener):
+    num, entry = listener.journal.peekitem(0)
+    sent = entry.tfs
+    identical = bsc_log(logs[0][0][0])
+    assert not listener.revise(identical)
+    await listener.new_head({'number': hex(num), 'hash': '0x01', 'timestamp': '0x0'}, asyncio.Queue())
+    assert entry.logs == {} and entry.hash == '0x01'
+
+    chan = EventChannel('chain')
+    listener.revised[num] -= REVISION_DELAY
+    await listener.process_revisions(chan)
+    revert = chan.get_nowait()
+    assert revert.tfs == sent and chan.empty()
+
+
+@pytest.mark.asyncio
+async def test_unindexed_tx_isnt_endpoint_failure(listener, monkeypatch):
+    "The node returns null for txs it hasn't indexed yet, that's retried without opening its breaker"
+    calls = []
+    async def rpc(request):
+        calls.append(await request.json())
+        return web.json_response({'id': 0, 'result': None if len(calls) < 5 else {'from': '0xABC'}})
+    app = web.Application()
+    app.router.add_post('/', rpc)
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(bsc_listener, 'EMPTY_RESULT_BACKOFF', Backoff(base=0.001))
+    listener.rpc_pool = RpcPool('bsc_rpc', [str(server.make_url('/'))], listener.http, logging.getLogger())
+    try:
+        assert await listener.fetch_signer('0x1') == '0xabc' and len(calls) == 5
+        breaker = listener.http.resilience.breaker('bsc_rpc:0')
+        assert breaker.failures == 0 and breaker.state == BREAKER_CLOSED
+    finally:
+        await listener.http.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_missing_releases_sticky(listener, monkeypatch):
+    async def rpc_req(method, params, pool=None, sticky=None, **kwargs):
+        pool.pick(sticky)
+        raise Exception("Timeout")
+    monkeypatch.setattr(listener, 'rpc_req', rpc_req)
+    with pytest.raises(Exception):
+        await listener.fetch_missing(from_=100, until=200)
+    assert listener.history_pool.sticky == {}
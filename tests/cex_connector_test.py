@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bna import init_logging
+from datetime import datetime, timedelta
+from bna.cex_listeners import BitmartConnector, ProbitConnector, VitexConnector, Trade, VITEX_PAGE_SIZE, VITEX_SMALL_PAGE_SIZE, \
+    PROBIT_BACKFILL_WINDOW, PROBIT_FIRST_PAGE_SIZE, PROBIT_PAGE_SIZE
+from bna.config import CexConfig
+from bna.http_client import HttpClient
+
+
+def probit_trade(num: int) -> dict:
+    return {'id': f"IDNA-USDT:{num}", 'price': "0.01", 'quantity': "1000", 'side': "buy",
+            'time': f"2023-01-03T14:16:{num:02d}.000Z", 'tick_direction': "up"}
+
+async def start_exchange() -> TestServer:
+    "Fake ProBit with a trade stream that skips trades 4 and 5"
+    state = {'rest': [1, 2], 'rest_calls': 0, 'queries': [], 'subscribed': asyncio.Event()}
+
+    async def trades(request):
+        state['rest_calls'] += 1
+        state['queries'].append((request.query['start_time'], int(request.query['limit'])))
+        return web.json_response({'data': [probit_trade(n) for n in reversed(state['rest'])]})
+
+    async def ws_handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sub = await ws.receive_json()
+        assert sub['channel'] == 'marketdata' and sub['market_id'] == 'IDNA-USDT'
+        await ws.send_json({'channel': 'marketdata', 'reset': True, 'recent_trades': [probit_trade(1), probit_trade(2)]})
+        await ws.send_json({'channel': 'marketdata', 'recent_trades': [probit_trade(3)]})
+        await asyncio.sleep(0.1)
+        state['rest'] = [1, 2, 3, 4, 5, 6]
+        await ws.send_json({'channel': 'marketdata', 'recent_trades': [probit_trade(6)]})
+        state['subscribed'].set()
+        async for _ in ws:
+            pass
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/trade', trades)
+    app.router.add_get('/ws', ws_handler)
+    server = TestServer(app)
+    server.state = state
+    await server.start_server()
+    return server
+
+@pytest.mark.asyncio
+async def test_probit_stream():
+    server = await start_exchange()
+    http = HttpClient(init_logging())
+    conn = ProbitConnector(init_logging(), CexConfig(), {'cg:tether': 1}, http,
+                           ws_url=str(server.make_url('/ws')).replace('http', 'ws'), rest_url=str(server.make_url('/trade')))
+    chan = asyncio.Queue()
+    task = asyncio.create_task(conn.run(chan))
+    try:
+        await asyncio.wait_for(server.state['subscribed'].wait(), 5)
+        await asyncio.sleep(0.2)
+        batches = []
+        while not chan.empty():
+            batches.append([t.id for t in chan.get_nowait()])
+        # REST on connect, then the stream, and REST again only for the gap. Nothing is sent twice.
+        assert batches == [[2, 1], [3], [6, 5, 4]]
+        assert server.state['rest_calls'] == 2
+        assert conn.stats['ws'] == 1 and conn.stats['rest'] == 5 and conn.stats['gaps'] == 1
+        assert conn.last_seq == 6
+        # Only a short window is fetched until there's a trade to continue from
+        (first_start, first_limit), (next_start, next_limit) = server.state['queries']
+        first_start = datetime.fromisoformat(first_start.rstrip('Z'))
+        assert datetime.utcnow() - first_start < timedelta(seconds=PROBIT_BACKFILL_WINDOW + 60)
+        assert first_limit == PROBIT_FIRST_PAGE_SIZE and next_limit == PROBIT_PAGE_SIZE
+        assert next_start == "2023-01-03T14:16:03.000Z"
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await http.close()
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_vitex_incremental():
+    state = {'trades': [], 'limits': []}
+
+    async def trades(request):
+        limit = int(request.query['limit'])
+        state['limits'].append(limit)
+        etag = f'"{len(state["trades"])}-{limit}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        page = state['trades'][::-1][:limit]
+        return web.json_response({'data': page}, headers={'ETag': etag})
+
+    def add_trades(count: int):
+        start = len(state['trades'])
+        state['trades'].extend({'timestamp': 1672361525000 + i, 'price': "0.0000005", 'amount': "100", 'side': 0}
+                               for i in range(start, start + count))
+
+    app = web.Application()
+    app.router.add_get('/trades', trades)
+    server = TestServer(app)
+    await server.start_server()
+    http = HttpClient(init_logging())
+    conn = VitexConnector(init_logging(), CexConfig(), {'cg:bitcoin': 20000}, http,
+                          rest_url=str(server.make_url('/trades')) + '?symbol=IDNA-000_BTC-000')
+    chan = asyncio.Queue()
+    try:
+        add_trades(150)
+        await conn.backfill(chan)
+        assert len(chan.get_nowait()) == VITEX_PAGE_SIZE and state['limits'] == [VITEX_PAGE_SIZE]
+
+        # Nothing new: all trades on the small page are skipped, then it isn't modified
+        state['limits'].clear()
+        await conn.backfill(chan)
+        await conn.backfill(chan)
+        assert chan.empty() and state['limits'] == [VITEX_SMALL_PAGE_SIZE] * 2
+        assert conn.stats['skipped'] == VITEX_SMALL_PAGE_SIZE and conn.stats['not_modified'] == 1
+
+        # A few new trades fit on the small page, and only those are parsed
+        add_trades(3)
+        state['limits'].clear()
+        await conn.backfill(chan)
+        assert len(chan.get_nowait()) == 3 and state['limits'] == [VITEX_SMALL_PAGE_SIZE]
+        assert conn.stats['skipped'] == VITEX_SMALL_PAGE_SIZE * 2 - 3
+
+        # Many new trades need the full page
+        add_trades(20)
+        state['limits'].clear()
+        await conn.backfill(chan)
+        assert len(chan.get_nowait()) == 20 and state['limits'] == [VITEX_SMALL_PAGE_SIZE, VITEX_PAGE_SIZE]
+    finally:
+        await http.close()
+        await server.close()
+
+def test_bitmart_stream_ids():
+    conn = BitmartConnector(init_logging(), CexConfig(), {'cg:tether': 1}, None)
+    rest = Trade.from_bitmart({'order_time': 1672755376123, 'count': '1000', 'price': '0.01', 'type': 'buy'}, 1)
+    ws = {'table': 'spot/trade', 'data': [{'ms_t': 1672755376123, 's_t': 1672755376, 'size': '1000', 'price': '0.01', 'side': 'buy'}]}
+    trades, snapshot = conn.parse_message(ws)
+    assert [t.id for t in trades] == [rest.id] and not conn.has_gap(trades)
+    # Without the millisecond time the trade's ID wouldn't match the REST one, so it's backfilled instead
+    ws['data'].append({'s_t': 1672755377, 'size': '5', 'price': '0.01', 'side': 'sell'})
+    trades, snapshot = conn.parse_message(ws)
+    assert len(trades) == 1 and conn.has_gap(trades)
@@ -0,0 +1,55 @@
+import pytest
+from decimal import Decimal
+from datetime import datetime, timezone
+
+from bna import init_logging
+from bna.config import Config
+from bna.discord_bot import Bot
+from bna.event import TransferEvent
+from bna.tags import IDENA_TAG_SEND, IDENA_TAG_KILL
+from bna.transfer import Transfer, CHAIN_IDENA
+from bench.tracker_bench import BenchDatabase
+
+NOW = datetime(2023, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def bot():
+    log = init_logging()
+    db = BenchDatabase(log, Config(), {'0xb': {'name': 'Exchange', 'type': 'exchange'}})
+    return Bot(None, Config().discord, db, 0, log)
+
+
+def tf(n: int, tags=[IDENA_TAG_SEND], **meta) -> Transfer:
+    return Transfer(changes={'0xa': Decimal(-n), '0xb': Decimal(n)}, hash=f'0x{n}', blockNumber=n, logIndex=0,
+                    chain=CHAIN_IDENA, timeStamp=NOW, signer='0xa', tags=tags, meta={'usd_value': n, **meta})
+
+
+def test_describe_cache(bot):
+    first = bot.describe_tf(tf(1000))
+    copy = tf(1000)
+    cached = bot.describe_tf(copy)
+    assert cached == {**first, 'tf': copy} and 'Exchange' in cached['desc'] and len(bot.describe_cache) == 1
+    # Cached descriptions aren't changed through the copies callers get
+    cached['short'] = ''
+    assert bot.describe_tf(tf(1000))['short'] == first['short']
+
+    # A kill that got its value and age from the indexer is described again
+    kill = tf(5, tags=[IDENA_TAG_KILL])
+    assert '**?**' in bot.describe_tf(kill)['desc']
+    kill.meta['age'] = 7
+    assert '**7**' in bot.describe_tf(kill)['desc']
+
+    bot.db.known_version += 1
+    bot.describe_tf(tf(1000))
+    assert len(bot.describe_cache) == 4
+
+
+def test_pages_render_from_cache(bot, monkeypatch):
+    ev = TransferEvent(by='0xa', amount=Decimal(0), tfs=[tf(n) for n in range(1, 31)], time=NOW)
+    pages = [bot.build_tf_list_embed(ev, start).description for start in (0, 10, 20)]
+    assert len(bot.describe_cache) == 30
+    def describe(tf, ev_by=''):
+        raise AssertionError(f"{tf.hash} was described again")
+    monkeypatch.setattr(bot, '_describe_tf', describe)
+    assert [bot.build_tf_list_embed(ev, start).description for start in (0, 10, 20)] == pages
@@ -0,0 +1,63 @@
+import time
+import pytest
+from types import SimpleNamespace
+from bna import init_logging
+from bna.dex_price import DexPriceEngine, VWAP_WINDOW
+from bna.price_service import PriceService
+from bna.transfer import BscLog
+
+IDNA = "0x0de08c1abe5fb86dd7fd2ac90400ace305138d5b"
+BUSD = "0xe9e7cea3dedca5984780bafc599bd69add087d56"
+WBNB = "0xbb4cdb9cbd36b01bd1cbaebf2de08d9173bc095c"
+BUSD_POOL = "0xc1bcdc9eb37d8e72ff0e0ca4bc8d19735b1b38ce"
+BNB_POOL = "0xaa4dce8585528265c6bac502ca9578343f82630f"
+
+
+def fake_db():
+    known = {
+        BUSD_POOL: {'type': 'pool', 'token0': IDNA, 'token1': BUSD},
+        BNB_POOL: {'type': 'pool', 'token0': IDNA, 'token1': WBNB},
+        IDNA: {'type': 'token', 'price_id': 'cg:idena', 'decimals': 18},
+        BUSD: {'type': 'token', 'price_id': 'cg:binance-usd', 'decimals': 18},
+        WBNB: {'type': 'token', 'price_id': 'cg:binancecoin', 'decimals': 18},
+    }
+    prices = PriceService(init_logging(), {'cg:idena': 0.01, 'cg:binance-usd': 1, 'cg:binancecoin': 200})
+    return SimpleNamespace(known=known, known_by_type={'pool': {BUSD_POOL: {}, BNB_POOL: {}}}, prices=prices)
+
+def reserves_data(idna: float, token: float) -> str:
+    return "0x{:064x}{:064x}".format(int(idna * 10**18), int(token * 10**18))
+
+def sync(pool: str, block: int, index: int, idna: float, token: float) -> BscLog:
+    return BscLog(address=pool, topics=[], data=reserves_data(idna, token), blockNumber=block,
+                  transactionHash="0x1", transactionIndex=0, blockHash="0x2", logIndex=index, removed=False)
+
+@pytest.mark.asyncio
+async def test_dex_price():
+    db = fake_db()
+    engine = DexPriceEngine(db, init_logging(), idna_token=IDNA)
+    assert engine.price() is None and not engine.is_live()
+
+    async def rpc_req(method, params, allow_none=True):
+        assert method == 'eth_call'
+        pool = params[0]['to']
+        return reserves_data(1_000_000, 20_000) if pool == BUSD_POOL else reserves_data(100_000, 5)
+
+    # Liquidity weighted before any trades: $40k at $0.02 and $2k at $0.01
+    await engine.load(rpc_req)
+    assert engine.price() == pytest.approx((0.02 * 40000 + 0.01 * 2000) / 42000)
+    assert db.prices['cg:idena'] == engine.last_price
+    engine.seen_head()
+    assert engine.is_live()
+
+    # Volume weighted once there are trades
+    now = time.time()
+    engine.process_syncs([sync(BUSD_POOL, 100, 1, 1_010_000, 19_802)], 100, now)
+    engine.process_syncs([sync(BNB_POOL, 101, 3, 90_000, 5.5556), sync(BUSD_POOL, 101, 1, 1_000_000, 20_000)], 101, now + 3)
+    p1, p2, p3 = 19_802 / 1_010_000, 20_000 / 1_000_000, 5.5556 / 90_000 * 200
+    assert engine.price() == pytest.approx((p1 * 10_000 + p2 * 10_000 + p3 * 10_000) / 30_000)
+    assert db.prices.price_at('cg:idena', now + 3) == pytest.approx(engine.price())
+
+    # Trades fall out of the window
+    engine.process_syncs([], 101 + VWAP_WINDOW, now + 60)
+    assert len(engine.trades) == 0
+    assert engine.price() == pytest.approx((0.02 * 40000 + p3 * 2 * 5.5556 * 200) / (40000 + 2 * 5.5556 * 200))
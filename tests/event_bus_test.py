@@ -0,0 +1,103 @@
+import pytest
+import asyncio
+from bna import init_logging
+from bna.event import BlockEvent, ChainRevertEvent, ChainTransferEvent, ClubEvent, RetractEvent, TransferEvent
+from bna.event_bus import EventBus, EventChannel, PRIORITY_STATUS
+from bna.transfer import CHAIN_BSC, CHAIN_IDENA
+
+
+def tf_event(n: int) -> ChainTransferEvent:
+    return ChainTransferEvent(chain=CHAIN_IDENA, tfs=[n])
+
+def test_reverts_keep_order():
+    "Transfers re-added after a revert mustn't overtake it"
+    chan = EventChannel('test')
+    for ev in [ChainRevertEvent(chain=CHAIN_BSC, tfs=[1]), tf_event(1), RetractEvent(hashes=['0x1']), TransferEvent()]:
+        chan.put_nowait(ev)
+    got = [type(chan.get_nowait()) for _ in range(4)]
+    assert got == [ChainRevertEvent, ChainTransferEvent, RetractEvent, TransferEvent]
+
+@pytest.mark.asyncio
+async def test_priority_order():
+    chan = EventChannel('test')
+    chan.put_nowait(BlockEvent(chain=CHAIN_IDENA, height=1))
+    chan.put_nowait(ClubEvent(addr='0x1', stake=1, club=1))
+    chan.put_nowait(tf_event(1))
+    chan.put_nowait(tf_event(2))
+    chan.put_nowait(['trade'])  # anything unknown gets the normal priority
+    assert chan.qsize() == 5
+    got = [chan.get_nowait() for _ in range(5)]
+    assert got[0].tfs == [1] and got[1].tfs == [2]
+    assert type(got[2]) == ClubEvent
+    assert got[3] == ['trade']
+    assert type(got[4]) == BlockEvent
+    assert chan.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        chan.get_nowait()
+
+@pytest.mark.asyncio
+async def test_status_drop_oldest():
+    chan = EventChannel('test', status_capacity=3)
+    for i in range(10):
+        chan.put_nowait(BlockEvent(chain=CHAIN_BSC, height=i))
+    assert [chan.get_nowait().height for _ in range(3)] == [7, 8, 9]
+    assert chan.stats['dropped'] == 7
+
+@pytest.mark.asyncio
+async def test_backpressure():
+    chan = EventChannel('test', capacity=2)
+    chan.put_nowait(tf_event(1))
+    await chan.put(tf_event(2))
+    with pytest.raises(asyncio.QueueFull):
+        chan.put_nowait(tf_event(3))
+    # Status events still go through when the channel is full
+    chan.put_nowait(BlockEvent(chain=CHAIN_IDENA, height=1))
+
+    put_task = asyncio.create_task(chan.put(tf_event(3)))
+    await asyncio.sleep(0.01)
+    assert not put_task.done()
+    assert chan.stats['blocked'] == 1
+    assert chan.get_nowait().tfs == [1]
+    await asyncio.wait_for(put_task, timeout=1)
+    assert [chan.get_nowait().tfs for _ in range(2)] == [[2], [3]]
+
+@pytest.mark.asyncio
+async def test_get_waits_and_lag():
+    bus = EventBus(init_logging())
+    chan = bus.channel('idna')
+    assert bus.channel('idna') is chan
+    get_task = asyncio.create_task(chan.get())
+    await asyncio.sleep(0.01)
+    assert not get_task.done()
+    chan.put_nowait(tf_event(1))
+    assert (await asyncio.wait_for(get_task, timeout=1)).tfs == [1]
+
+    chan.put_nowait(BlockEvent(chain=CHAIN_IDENA, height=1))
+    await asyncio.sleep(0.05)
+    m = bus.metrics()['idna']
+    assert m['depth'] == 1 and m['depth_by_priority'][PRIORITY_STATUS] == 1
+    assert m['lag'] >= 0.05
+    await chan.get()
+    assert chan.stats['last_lag'] >= 0.05
+    assert bus.metrics()['idna']['lag'] == 0
+    bus.log_metrics()
+
+@pytest.mark.asyncio
+async def test_merged_chains_and_timeout():
+    chan = EventChannel('chain')
+    with pytest.raises(asyncio.TimeoutError):
+        await chan.get(timeout=0.01)
+
+    async def producer(chain, n):
+        for i in range(n):
+            await chan.put(ChainTransferEvent(chain=chain, tfs=[i]))
+            await asyncio.sleep(0)
+    await asyncio.gather(producer(CHAIN_IDENA, 50), producer(CHAIN_BSC, 50))
+    got = {CHAIN_IDENA: [], CHAIN_BSC: []}
+    while not chan.empty():
+        ev = await chan.get(timeout=1)
+        got[ev.chain].extend(ev.tfs)
+    assert got[CHAIN_IDENA] == list(range(50)) and got[CHAIN_BSC] == list(range(50))
+    # A timed out getter doesn't consume anything
+    chan.put_nowait(tf_event(1))
+    assert (await chan.get(timeout=0.01)).tfs == [1]
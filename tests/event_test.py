@@ -238,3 +238,39 @@ async def test_event_join():
     assert de.buy_usd == de_orig.buy_usd * 2
     assert de.sell_usd == de_orig.sell_usd * 2
     assert len(de.tfs) == 2 * len(de_orig.tfs)
+
+class FakeTransferDb:
+    "Counts transfer lookups instead of querying Postgres"
+    def __init__(self, tfs: list[Transfer]):
+        self.tfs = {tf.hash: tf for tf in tfs}
+        self.queries = []
+
+    async def get_transfers(self, hashes: list[str]) -> list[Transfer]:
+        self.queries.append(hashes)
+        return [self.tfs.get(h) for h in hashes]
+
+@pytest.mark.asyncio
+async def test_lazy_rehydration():
+    ktf = Transfer.from_dict(json.loads(kill_pooled_tf_json))
+    db = FakeTransferDb([ktf, kill_delegator_tf])
+
+    kev = await event_from_dict(json.loads(top_kill_json), db, lazy=True)
+    assert db.queries == []
+    assert len(kev) == 2
+    assert json.dumps(kev.to_dict()) == top_kill_json
+    with pytest.raises(LookupError):
+        kev.items[0]
+    await kev.items.load(db, 1, 2)
+    assert db.queries == [[kill_delegator_tf.hash]]
+    assert kev.items[1:2] == [kill_delegator_tf]
+    await kev.items.load(db, 0, 2)
+    await kev.items.load(db, 0, 2)
+    assert db.queries == [[kill_delegator_tf.hash], [ktf.hash]]
+    assert kev == await TopKillEvent.from_dict(json.loads(top_kill_json), db)
+
+    # Pool changes are shown from their summaries without loading any transfers
+    db.queries.clear()
+    mpe = await event_from_dict(json.loads(mass_pool_event_1_json), db, lazy=True)
+    assert db.queries == []
+    assert [ch.stake for ch in mpe.changes] == [ch.stake for ch in mass_pool_event_1.changes]
+    assert json.dumps(mpe.to_dict()) == mass_pool_event_1_json
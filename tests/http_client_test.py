@@ -0,0 +1,120 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bna import init_logging
+from bna.http_client import HttpClient, HttpError
+from bna.resilience import Backoff, CircuitOpenError, Resilience
+
+
+async def start_server(fail_times: int = 0) -> TestServer:
+    state = {'fails': fail_times, 'peers': set()}
+
+    async def ok(request):
+        state['peers'].add(request.transport.get_extra_info('peername'))
+        return web.json_response({'result': 'ok'})
+
+    async def flaky(request):
+        if state['fails'] > 0:
+            state['fails'] -= 1
+            return web.Response(status=503)
+        return web.json_response({'result': 'finally'})
+
+    async def missing(request):
+        return web.Response(status=404)
+
+    async def etag(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({'result': 'v1'}, headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/ok', ok)
+    app.router.add_post('/flaky', flaky)
+    app.router.add_get('/missing', missing)
+    app.router.add_get('/etag', etag)
+    server = TestServer(app)
+    server.state = state
+    await server.start_server()
+    return server
+
+@pytest.mark.asyncio
+async def test_reuses_connections():
+    server = await start_server()
+    http = HttpClient(init_logging())
+    try:
+        for _ in range(5):
+            assert await http.get_json(str(server.make_url('/ok')), endpoint='test') == {'result': 'ok'}
+        # Keep-alive: all sequential requests went over the same connection
+        assert len(server.state['peers']) == 1
+        m = http.metrics()['test']
+        assert m['requests'] == 5 and m['errors'] == 0 and m['statuses'] == {200: 5}
+    finally:
+        await http.close()
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_retries_and_errors():
+    server = await start_server(fail_times=2)
+    log = init_logging()
+    http = HttpClient(log, resilience=Resilience(log, backoff=Backoff(base=0.01)))
+    try:
+        j = await http.post_json(str(server.make_url('/flaky')), attempts=3)
+        assert j == {'result': 'finally'}
+        host = server.make_url('/').host
+        m = http.metrics()[host]
+        assert m['retries'] == 2 and m['statuses'] == {503: 2, 200: 1}
+
+        # Client errors aren't retried
+        with pytest.raises(HttpError) as e:
+            await http.get_json(str(server.make_url('/missing')), endpoint='missing', attempts=3)
+        assert e.value.status == 404
+        assert http.metrics()['missing']['requests'] == 1
+        resp = await http.request('GET', str(server.make_url('/missing')), raise_for_status=False)
+        assert resp.status == 404
+        assert http.resilience.metrics()['missing']['failures'] == 0
+
+        # Invalid results are retried too
+        results = iter([{}, {'result': 1}])
+        def check(j):
+            j = next(results)
+            if 'result' not in j:
+                raise Exception("No result")
+            return j['result']
+        assert await http.get_json(str(server.make_url('/ok')), endpoint='check', attempts=2, check=check) == 1
+    finally:
+        await http.close()
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    server = await start_server(fail_times=100)
+    log = init_logging()
+    http = HttpClient(log, resilience=Resilience(log, backoff=Backoff(base=0.01), failure_threshold=3, reset_timeout=60))
+    try:
+        with pytest.raises(HttpError):
+            await http.post_json(str(server.make_url('/flaky')), endpoint='flaky', attempts=10)
+        # The breaker stops retries once it opens and rejects new requests without sending them
+        assert http.metrics()['flaky']['requests'] == 3
+        with pytest.raises(CircuitOpenError):
+            await http.post_json(str(server.make_url('/flaky')), endpoint='flaky')
+        assert http.metrics()['flaky']['requests'] == 3
+        assert http.resilience.metrics()['flaky']['state'] == 'open'
+    finally:
+        await http.close()
+        await server.close()
+
+@pytest.mark.asyncio
+async def test_conditional_get():
+    server = await start_server()
+    http = HttpClient(init_logging())
+    try:
+        url = str(server.make_url('/etag'))
+        assert await http.get_json_if_modified(url, endpoint='etag') == {'result': 'v1'}
+        assert await http.get_json_if_modified(url, endpoint='etag') is None
+        assert http.metrics()['etag']['statuses'] == {200: 1, 304: 1}
+        # Responses without validators aren't remembered
+        assert await http.get_json_if_modified(str(server.make_url('/ok'))) == {'result': 'ok'}
+        assert list(http.validators.keys()) == [url]
+    finally:
+        await http.close()
+        await server.close()
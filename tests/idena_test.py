@@ -1,13 +1,18 @@
 import os
 import time
+import asyncio
 import pytest
+from collections import defaultdict
 from decimal import Decimal
 from datetime import datetime, timezone, timedelta
 
-from bna import init_logging
+from bna import init_logging, idena_listener
+from bna.config import Config
+from bna.resilience import Backoff
 from bna.transfer import Transfer
 from bna.database import Database
-from bna.idena_listener import IdenaListener
+from bna.idena_listener import IdenaListener, TxCache
+from bench.tracker_bench import BenchDatabase
 
 @pytest.mark.asyncio
 async def test_fetch_and_process_block():
@@ -145,3 +150,74 @@ async def test_process_tx():
         for key, expected_value in expected_transfer.to_dict().items():
             print(f"{tr[key]} == {expected_value}")
             assert tr[key] == expected_value
+
+
+def test_tx_cache():
+    cache = TxCache(size=2, ttl=60)
+    for n in range(3):
+        cache.put({'hash': f'0x{n}', 'amount': '1'})
+    assert len(cache) == 2 and cache.pop('0x0') is None
+    tx = cache.pop('0x1')
+    tx['amount'] = '2'
+    assert cache.pop('0x1') is None and (cache.hits, cache.misses) == (1, 2)
+    cache.txs['0x2'] = (time.time() - 61, cache.txs['0x2'][1])
+    cache.expire()
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_block_txs_from_mempool(monkeypatch):
+    listener = IdenaListener(conf=None, log=init_logging(), db=None)
+    fetched = []
+    async def rpc_req(method=None, params=[], **kwargs):
+        fetched.append(params[0])
+        return {'hash': params[0], 'timestamp': 1670626028, 'blockHash': '0xb'}
+    monkeypatch.setattr(listener, 'rpc_req', rpc_req)
+    listener.tx_cache.put({'hash': '0x1', 'timestamp': 0, 'blockHash': None})
+    block = {'hash': '0xb', 'timestamp': 1670626028}
+    assert await listener.get_tx('0x1', block) == {'hash': '0x1', 'timestamp': 1670626028, 'blockHash': '0xb'}
+    assert await listener.get_tx('0x2', block) == {'hash': '0x2', 'timestamp': 1670626028, 'blockHash': '0xb'}
+    assert fetched == ['0x2']
+
+
+@pytest.mark.asyncio
+async def test_killtx_indexer_lag(monkeypatch):
+    "Kills the indexer hasn't caught up with are retried on their own, without failing the others"
+    log = init_logging()
+    listener = IdenaListener(conf=None, log=log, db=BenchDatabase(log, Config(), {}))
+    listener.api_url = 'http://127.0.0.1:1'
+    monkeypatch.setattr(idena_listener, 'KILLTX_BACKOFF', Backoff(base=0.001))
+    calls = defaultdict(int)
+    async def api_req(path, **kwargs):
+        calls[path] += 1
+        if calls[path] < 3:
+            return None
+        return {'birthEpoch': 90} if 'identity' in path else {'data': {'transfer': '100'}}
+    monkeypatch.setattr(listener, 'api_req', api_req)
+    kills = []
+    for n in range(10):
+        tf = Transfer(changes={}, hash=f'0x{n}', blockNumber=n, logIndex=0, chain='idena',
+                      timeStamp=datetime.now(tz=timezone.utc), signer=f'0x{n}', meta={'killedIdentity': f'0x{n}'})
+        kills.append(listener.fetch_killtx({'epoch': 100, 'from': f'0x{n}', 'to': None, 'hash': tf.hash}, tf))
+    await asyncio.gather(*kills)
+    assert len(listener.slow_tfs) == 10 and all(tf.meta['age'] == 10 for tf in listener.slow_tfs)
+    assert listener.http.resilience.breakers == {}
+
+
+@pytest.mark.asyncio
+async def test_mempool_fetch_concurrency(monkeypatch):
+    listener = IdenaListener(conf=None, log=init_logging(), db=None)
+    running, most = 0, 0
+    async def rpc_req(method=None, params=[], **kwargs):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+        if params[0] == '0x7':
+            raise Exception("Timeout")
+        return {'hash': params[0]}
+    monkeypatch.setattr(listener, 'rpc_req', rpc_req)
+    txs = await listener.fetch_mempool_txs([f'0x{n}' for n in range(100)])
+    assert most == idena_listener.MEMPOOL_FETCH_CONCURRENCY and isinstance(txs[7], Exception)
+    assert [tx['hash'] for tx in txs if not isinstance(tx, Exception)] == [f'0x{n}' for n in range(100) if n != 7]
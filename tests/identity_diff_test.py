@@ -0,0 +1,37 @@
+from decimal import Decimal
+
+from bna.identity_diff import diff_identities
+
+
+def ident(addr: str, **fields) -> dict:
+    return {'address': addr, 'stake': '100', 'state': 'Human', 'delegatee': None, 'online': False,
+            'age': 10, '_fetchTime': 1, **fields}
+
+
+def test_diff_identities():
+    cached = {a: ident(a) for a in ('0xa', '0xb', '0xc', '0xd', '0xe')}
+    fetched = [
+        ident('0xa', _fetchTime=2),
+        ident('0xb', stake='150.5', _fetchTime=2),
+        ident('0xc', state='Verified', delegatee='0xpool', online=True),
+        ident('0xd', stake='100.0', age=11),
+        ident('0xf'),
+    ]
+    changes = diff_identities(cached, fetched, full=True)
+    assert changes.unchanged == 1 and changes.removed == ['0xe']
+    assert [ch.addr for ch in changes.changes] == ['0xb', '0xc', '0xd', '0xf']
+
+    b, c, d, f = changes.changes
+    assert b.stake == (Decimal(100), Decimal('150.5')) and b.stake_delta == Decimal('50.5')
+    assert b.state is None and b.delegatee is None and b.online is None
+    assert c.state == ('Human', 'Verified') and c.delegatee == (None, '0xpool') and c.online == (False, True)
+    # Same stake written differently isn't a stake change, but the identity is still written
+    assert d.stake is None and d.stake_delta == 0
+    assert f.added and f.prev is None
+    assert [ch.addr for ch in changes.of('stake')] == ['0xb'] and [ch.addr for ch in changes.of('added')] == ['0xf']
+
+
+def test_partial_refresh_removes_nothing():
+    cached = {'0xa': ident('0xa'), '0xb': ident('0xb')}
+    changes = diff_identities(cached, [ident('0xA', online=True)])
+    assert changes.removed == [] and changes.changes[0].addr == '0xa' and changes.changes[0].online == (False, True)
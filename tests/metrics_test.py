@@ -0,0 +1,42 @@
+import pytest
+import aiohttp
+from bna import init_logging
+from bna.metrics import MetricsRegistry, MetricsServer, timed
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    registry = MetricsRegistry()
+    hist = registry.histogram('test_seconds', "Test durations", ('step',), buckets=(0.1, 1))
+    hist.observe(0.0625, 'a')
+    hist.observe(0.5, 'a')
+    hist.observe(5, 'a')
+    sizes = {'transfers': 3}
+    registry.gauge('test_cache_size', "Cache sizes", labels=('cache',), collect=lambda: sizes)
+    registry.gauge('test_lag', "Lag", collect=lambda: 1.5)
+
+    @timed(hist)
+    async def check_events():
+        return 1
+    assert await check_events() == 1
+
+    server = MetricsServer(init_logging(), port=0, registry=registry)
+    await server.start()
+    try:
+        port = server.runner.addresses[0][1]
+        sizes['transfers'] = 4  # read at scrape time
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                assert resp.status == 200 and resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+                lines = (await resp.text()).splitlines()
+    finally:
+        await server.stop()
+
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{step="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{step="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{step="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{step="a"} 5.5625' in lines
+    assert 'test_seconds_count{step="check_events"} 1' in lines
+    assert 'test_cache_size{cache="transfers"} 4.0' in lines
+    assert 'test_lag 1.5' in lines
@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+from bna import init_logging
+from bna.poll_scheduler import PollScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_adaptive_interval():
+    clock = FakeClock()
+    s = PollScheduler(init_logging(), idle_factor=2, clock=clock)
+    src = s.register('vitex', 10, 60, groups=('cex',))
+    assert src.next_at == clock.now
+    for expected in [20, 40, 60, 60]:
+        s.done('vitex', 0)
+        assert src.interval == expected
+        assert expected <= src.next_at - clock.now <= expected + 1
+    s.done('vitex', 3)
+    assert src.interval == 10
+
+    s.failed('vitex')
+    assert 5 <= src.next_at - clock.now <= 10
+    assert s.metrics()['vitex']['failures'] == 1
+
+@pytest.mark.asyncio
+async def test_refresh_and_concurrency():
+    s = PollScheduler(init_logging(), max_concurrent=2)
+    for name in ['a', 'b', 'c']:
+        s.register(name, 60, 600, groups=('cex',))
+        s.done(name, 0)
+    s.register('prices', 60, 600)
+    s.done('prices', 0)
+
+    running = 0
+    max_running = 0
+    polled = []
+
+    async def poller(name: str):
+        nonlocal running, max_running
+        async with s.turn(name):
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+        polled.append(name)
+
+    tasks = [asyncio.create_task(poller(name)) for name in ['a', 'b', 'c', 'prices']]
+    await asyncio.sleep(0.05)
+    assert polled == []
+    # A refresh wakes up the whole group, but only two polls run at once
+    s.refresh('cex')
+    await asyncio.sleep(0.3)
+    assert sorted(polled) == ['a', 'b', 'c'] and max_running == 2
+    assert s.sources['a'].interval == 60 and s.metrics()['a']['refreshes'] == 1
+    tasks[-1].cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,78 @@
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+
+from bna.pool_index import PoolIndex
+from bna.transfer import Transfer, CHAIN_IDENA
+
+NOW = datetime(2023, 3, 1, tzinfo=timezone.utc)
+
+
+def ident(addr: str, **fields) -> dict:
+    return {'address': addr, 'stake': '100', 'state': 'Human', 'delegatee': None, 'online': False,
+            'isPool': False, 'age': 10, **fields}
+
+
+def online_miners(identities: dict) -> int:
+    "What `get_online_miners` counted by scanning every identity"
+    solo, pools = 0, {}
+    for i in identities.values():
+        if i['online']:
+            if not i['isPool']:
+                solo += 1
+            else:
+                pools.setdefault(i['address'], {'delegators': 0, 'online': False})['online'] = True
+                if i['state'] in ('Newbie', 'Verified', 'Human'):
+                    solo += 1
+        elif i['delegatee'] and i['state'] in ('Newbie', 'Verified', 'Human'):
+            pools.setdefault(i['delegatee'], {'delegators': 0, 'online': False})['delegators'] += 1
+    return solo + sum(p['delegators'] for p in pools.values() if p['online'])
+
+
+def test_pool_index():
+    identities = {i['address']: i for i in [
+        ident('0xp', isPool=True, online=True, state='Undefined', stake='0'),
+        ident('0xa', delegatee='0xp'),
+        ident('0xb', delegatee='0xp', stake='50.5', age=3),
+        ident('0xc', delegatee='0xp', state='Suspended'),
+        ident('0xd', online=True),
+        ident('0xq', isPool=True, state='Undefined'),
+        ident('0xe', delegatee='0xq'),
+    ]}
+    index = PoolIndex()
+    index.rebuild(identities)
+    p = index.pools['0xp']
+    assert p.delegators == {'0xa', '0xb', '0xc'} and p.stake == Decimal('250.5') and p.age == 23 and p.mining == 2
+    assert index.online_miners() == online_miners(identities) == 3
+
+    # Pool goes online, a delegator moves, a solo miner goes offline, a pool identity disappears
+    changes = [('0xq', ident('0xq', isPool=True, online=True, state='Undefined')),
+               ('0xa', ident('0xa', delegatee='0xq')),
+               ('0xd', ident('0xd')),
+               ('0xp', None)]
+    for addr, new in changes:
+        index.update(identities[addr], new)
+        if new is None:
+            del identities[addr]
+        else:
+            identities[addr] = new
+        assert index.online_miners() == online_miners(identities)
+    assert index.pools['0xq'].delegators == {'0xa', '0xe'} and not index.pools['0xp'].online
+    index.update(identities['0xb'], ident('0xb'))
+    index.update(identities['0xc'], ident('0xc'))
+    assert '0xp' not in index.pools
+
+
+def test_delegation_ledger():
+    index = PoolIndex()
+    def tf(n: int, tag: str, pool: str, age: int) -> Transfer:
+        return Transfer(changes={'0xa': Decimal(0)}, hash=f'0x{n}', blockNumber=n, logIndex=0, chain=CHAIN_IDENA,
+                        timeStamp=NOW - timedelta(hours=age), signer='0xa', tags=[tag], meta={'pool': pool})
+    index.record(tf(2, 'undelegate', '0xp', 1))
+    index.record(tf(1, 'delegate', '0xp', 30))
+    index.record(tf(3, 'send', '0xp', 0))
+    assert index.ledger['0xa'].tag == 'undelegate'
+    assert index.pool_of('0xa', {'0xa': ident('0xa')}) == '0xp'
+    assert index.pool_of('0xa', {'0xa': ident('0xa', delegatee='0xq')}) == '0xq'
+    assert [t.blockNumber for t in index.recent(NOW - timedelta(hours=24))] == [2]
+    index.forget_before(NOW - timedelta(hours=2))
+    assert list(index.pool_tfs) == [(2, 0)]
@@ -0,0 +1,124 @@
+import pytest
+from decimal import Decimal
+from datetime import datetime, timezone
+from bna import init_logging, price_service
+from bna.price_service import PriceService
+from bna.transfer import Transfer
+from bna.utils import calculate_usd_value
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+class FakePriceStore:
+    def __init__(self, rows=None):
+        self.rows = rows or []
+
+    async def get_prices(self, after):
+        return [r for r in self.rows if r[1] > after]
+
+    async def insert_prices(self, rows):
+        self.rows.extend(rows)
+
+    async def remove_prices(self, before):
+        self.rows = [r for r in self.rows if r[1] >= before]
+
+def test_price_at():
+    clock = FakeClock()
+    prices = PriceService(init_logging(), {'cg:idena': 0.01}, clock=clock)
+    # Placeholder prices have no history
+    assert prices['cg:idena'] == 0.01 and prices.price_at('cg:idena', clock.now - 100) == 0.01
+    assert prices.is_stale('cg:idena')
+
+    start = clock.now
+    for i, price in enumerate([1, 2, 4]):
+        prices.update('cg:idena', price, start + i * 60)
+    clock.now = start + 120
+    assert prices['cg:idena'] == 4
+    assert prices.price_at('cg:idena', start - 1000) == 1
+    assert prices.price_at('cg:idena', start + 30) == 1.5
+    assert prices.price_at('cg:idena', datetime.fromtimestamp(start + 90, tz=timezone.utc)) == 3
+    assert prices.price_at('cg:idena', start + 1000) == 4
+    with pytest.raises(KeyError):
+        prices.price_at('cg:unknown', start)
+
+    # Late points are inserted in order and don't replace the latest price
+    prices.update('cg:idena', 10, start + 90)
+    assert prices.price_at('cg:idena', start + 90) == 10 and prices['cg:idena'] == 4
+
+    assert not prices.is_stale('cg:idena')
+    clock.now += prices.stale_after + 1
+    assert prices.stale() == ['cg:idena']
+
+    # History is trimmed to the history period
+    clock.now = start + prices.history_period + 90
+    prices.update('cg:idena', 5)
+    assert prices.series['cg:idena'].times[0] == start + 90
+
+def test_usd_value_at_transfer_time():
+    clock = FakeClock()
+    prices = PriceService(init_logging(), clock=clock)
+    prices.update('cg:idena', 1, clock.now - 3600)
+    prices.update('cg:idena', 2, clock.now)
+    tf = Transfer(chain='idena', hash='0x1', blockNumber=1, logIndex=0,
+                  timeStamp=datetime.fromtimestamp(clock.now - 3600, tz=timezone.utc), changes={'0xa': Decimal(-100), '0xb': Decimal(100)})
+    assert calculate_usd_value(tf, prices, {}) == 100
+    tf.timeStamp = None
+    assert calculate_usd_value(tf, prices, {}) == 200
+
+def test_subscriptions():
+    prices = PriceService(init_logging(), {'cg:idena': 1})
+    moves = []
+    sub = prices.subscribe(lambda price_id, old, new: moves.append((price_id, old, new)), threshold=0.1)
+    for price in [1.05, 1.09, 1.1, 1.15, 0.9]:
+        prices['cg:idena'] = price
+    assert moves == [('cg:idena', 1, 1.1), ('cg:idena', 1.1, 0.9)]
+    # First price of a new ID is the reference
+    prices['cg:bitcoin'] = 100
+    assert len(moves) == 2
+    prices.unsubscribe(sub)
+    prices['cg:idena'] = 10
+    assert len(moves) == 2
+
+@pytest.mark.asyncio
+async def test_flush_and_load():
+    clock = FakeClock()
+    store = FakePriceStore()
+    prices = PriceService(init_logging(), store=store, clock=clock)
+    prices.update('cg:idena', 1, clock.now - 60)
+    prices.update('cg:idena', 2, clock.now)
+    await prices.flush()
+    assert len(store.rows) == 2 and prices.pending == []
+
+    restarted = PriceService(init_logging(), {'cg:idena': 0.5}, store=store, clock=clock)
+    await restarted.load()
+    assert restarted['cg:idena'] == 2 and restarted.price_at('cg:idena', clock.now - 30) == 1.5
+    assert restarted.pending == []
+
+@pytest.mark.asyncio
+async def test_flush_removes_old_prices():
+    clock = FakeClock()
+    old = datetime.fromtimestamp(clock.now - price_service.HISTORY_PERIOD - 60, tz=timezone.utc)
+    store = FakePriceStore([('cg:idena', old, 1)])
+    prices = PriceService(init_logging(), store=store, clock=clock)
+    prices.update('cg:idena', 2, clock.now)
+    await prices.flush()
+    assert [row[2] for row in store.rows] == [2]
+
+@pytest.mark.asyncio
+async def test_pending_capped(monkeypatch):
+    monkeypatch.setattr(price_service, 'MAX_PENDING', 3)
+    clock = FakeClock()
+    store = FakePriceStore()
+    async def insert_prices(rows):
+        raise Exception("Store is down")
+    store.insert_prices = insert_prices
+    prices = PriceService(init_logging(), store=store, clock=clock)
+    for n in range(5):
+        prices.update('cg:idena', n, clock.now + n)
+        await prices.flush()
+    assert [row[2] for row in prices.pending] == [2, 3, 4]
@@ -0,0 +1,33 @@
+import time
+import asyncio
+import pytest
+from bna.profiler import SamplingProfiler
+
+
+def check_transfers_slowly():
+    end = time.perf_counter() + 0.3
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+async def blocker():
+    await asyncio.sleep(0.2)
+    check_transfers_slowly()
+
+@pytest.mark.asyncio
+async def test_profiler():
+    profiler = SamplingProfiler(interval=0.002)
+    task = asyncio.create_task(blocker(), name="tracker_run")
+    await profiler.run(0.8)
+    await task
+
+    assert profiler.samples > 50 and profiler.idle_samples > 0
+    assert any(name.startswith('check_transfers_slowly') for name, _ in profiler.cumulative.most_common(5))
+    assert profiler.tasks.most_common(1)[0][0] == 'tracker_run'
+    assert len(profiler.blocks) == 1
+    block = profiler.blocks[0]
+    assert block.task == 'tracker_run' and 0.15 < block.duration < 0.35
+    assert 'check_transfers_slowly' in next(iter(block.stacks))
+
+    report = profiler.report(top=5)
+    assert 'Loop blocked for more than 100ms 1 times' in report and 'tracker_run' in report
+    assert 'tracker_run' in profiler.summary()
@@ -0,0 +1,215 @@
+import time
+import pytest
+import asyncio
+from decimal import Decimal
+from datetime import datetime, timezone
+from bna import init_logging
+from bna.config import Config
+from bna.discord_bot import Bot
+from bna.event import TransferEvent, RetractEvent
+from bna.publisher import PublishScheduler
+from bna.tags import IDENA_TAG_SEND
+from bna.transfer import Transfer, CHAIN_IDENA
+
+
+class FakeChannel:
+    "Records requests the way a Discord channel would receive them"
+    def __init__(self, fail_times: int = 0, retry_after: float = None):
+        self.calls = []
+        self.fail_times = fail_times
+        self.retry_after = retry_after
+
+    async def send(self, content):
+        self._maybe_fail()
+        self.calls.append(('send', content, time.monotonic()))
+
+    async def edit(self, msg_id, content):
+        self._maybe_fail()
+        self.calls.append(('edit', (msg_id, content), time.monotonic()))
+
+    async def change_presence(self, name):
+        self._maybe_fail()
+        self.calls.append(('presence', name, time.monotonic()))
+
+    def _maybe_fail(self):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            e = Exception("429 Too Many Requests")
+            e.retry_after = self.retry_after
+            raise e
+
+
+def get_scheduler(**kwargs) -> PublishScheduler:
+    limits = {'send': (5, 5), 'edit': (5, 5), 'presence': (1, 10)}
+    limits.update(kwargs.pop('limits', {}))
+    return PublishScheduler(init_logging(), limits=limits, retry_delay=0.01, **kwargs)
+
+@pytest.mark.asyncio
+async def test_sends_before_edits():
+    chan = FakeChannel()
+    s = get_scheduler()
+    s.presence(lambda: chan.change_presence('blocks'))
+    s.edit('edit:1', 10, lambda: chan.edit(10, 'a'))
+    s.send('send:1', lambda: chan.send('first'))
+    s.send('send:1', lambda: chan.send('second'))
+    await s.drain()
+    assert [c[0] for c in chan.calls] == ['send', 'send', 'edit', 'presence']
+    assert [c[1] for c in chan.calls if c[0] == 'send'] == ['first', 'second']
+
+@pytest.mark.asyncio
+async def test_coalescing():
+    chan = FakeChannel()
+    s = get_scheduler()
+    state = {'text': 'v1'}
+    for i in range(5):
+        state['text'] = f'v{i}'
+        assert s.edit('edit:1', 10, lambda: chan.edit(10, state['text'])) == (i > 0)
+    s.edit('edit:1', 11, lambda: chan.edit(11, 'other'))
+    for i in range(3):
+        s.presence(lambda i=i: chan.change_presence(f'block {i}'))
+    assert len(s) == 3
+    await s.drain()
+    assert [c[1] for c in chan.calls] == [(10, 'v4'), (11, 'other'), 'block 2']
+    assert s.stats['coalesced'] == 6
+
+@pytest.mark.asyncio
+async def test_route_limits():
+    chan = FakeChannel()
+    s = get_scheduler(limits={'send': (2, 0.2)})
+    for i in range(3):
+        s.send('send:1', lambda i=i: chan.send(i))
+    s.send('send:2', lambda: chan.send('other channel'))
+    await s.drain()
+    sends = {c[1]: c[2] for c in chan.calls}
+    assert sends[2] - sends[0] >= 0.19
+    # Other channels have their own bucket and don't wait for the first one
+    assert sends['other channel'] < sends[2]
+
+@pytest.mark.asyncio
+async def test_retries():
+    chan = FakeChannel(fail_times=2, retry_after=0.1)
+    s = get_scheduler()
+    start = time.monotonic()
+    s.send('send:1', lambda: chan.send('hello'))
+    await s.drain()
+    assert [c[1] for c in chan.calls] == ['hello']
+    assert chan.calls[0][2] - start >= 0.2
+    assert s.stats['retried'] == 2
+
+    chan = FakeChannel(fail_times=5)
+    s = get_scheduler(max_attempts=3)
+    s.send('send:1', lambda: chan.send('never'))
+    await s.drain()
+    assert chan.calls == []
+    assert s.stats['failed'] == 1
+
+@pytest.mark.asyncio
+async def test_run_wakes_up():
+    chan = FakeChannel()
+    s = get_scheduler()
+    task = asyncio.create_task(s.run())
+    await asyncio.sleep(0.01)
+    s.send('send:1', lambda: chan.send('late'))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert [c[1] for c in chan.calls] == ['late']
+
+
+class FakeMessage:
+    def __init__(self, id: int, channel, msg: dict):
+        self.id = id
+        self.channel = channel
+        self.msg = msg
+        self.created_at = datetime.now(tz=timezone.utc)
+        self.components = msg.get('components')
+
+    async def edit(self, **msg):
+        self.channel.calls.append(('edit', self.id, msg))
+
+    async def delete(self):
+        self.channel.calls.append(('delete', self.id, None))
+
+
+class FakeDiscord:
+    "Stands in for the Discord client and its notification channel"
+    def __init__(self):
+        self.id = 1
+        self.calls = []
+
+    def get_channel(self, id):
+        return self
+
+    async def send(self, **msg):
+        msg_obj = FakeMessage(len(self.calls) + 1, self, msg)
+        self.calls.append(('send', msg_obj.id, msg))
+        return msg_obj
+
+
+class FakeDatabase:
+    "Just enough of `Database` to render and save transfer events"
+    def __init__(self):
+        self.known = {}
+        self.known_version = 1
+        self.prices = {'cg:idena': 0.01}
+        self.events = []
+
+    async def insert_event(self, msg, ev):
+        self.events.append(ev.id)
+
+@pytest.fixture
+def bot():
+    log = init_logging()
+    bot = Bot(FakeDiscord(), Config().discord, FakeDatabase(), 0, log)
+    bot.scheduler = get_scheduler()
+    return bot
+
+
+def transfer_event(*ns: int, to: str = '0xb') -> TransferEvent:
+    now = datetime.now(tz=timezone.utc)
+    tfs = [Transfer(changes={'0xa': Decimal(-n), to: Decimal(n)}, hash=f'0x{n}', blockNumber=n, logIndex=0,
+                    chain=CHAIN_IDENA, timeStamp=now, signer='0xa', tags=[IDENA_TAG_SEND], meta={'usd_value': n})
+           for n in ns]
+    return TransferEvent(by='0xa', amount=sum(tf.value() for tf in tfs), tfs=tfs, time=now)
+
+@pytest.mark.asyncio
+async def test_joins_pending_events(bot):
+    first = transfer_event(1, 2)
+    await bot.publish_event(first)
+    await bot.publish_event(transfer_event(3, 4))
+    assert len(bot.pending_events) == 1
+    await bot.scheduler.drain()
+    calls = bot.disbot.calls
+    assert len(calls) == 1 and [tf.hash for tf in first.tfs] == ['0x1', '0x2', '0x3', '0x4']
+    assert not bot.pending_events and bot.db.events == [first.id] and bot.ev_to_msg[first.id][1].id == calls[0][1]
+
+@pytest.mark.asyncio
+async def test_failed_save_doesnt_resend(bot):
+    async def insert_event(msg, ev):
+        raise Exception("Store is down")
+    bot.db.insert_event = insert_event
+    ev = transfer_event(1, 2)
+    await bot.publish_event(ev)
+    await bot.scheduler.drain()
+    assert len(bot.disbot.calls) == 1 and bot.scheduler.stats['retried'] == 0 and ev.id in bot.ev_to_msg
+
+@pytest.mark.asyncio
+async def test_retracted_transfers_readded(bot):
+    "A revised transfer keeps its hash, it's reverted and then added again"
+    # Published message
+    sent = transfer_event(1, to='0xc')
+    await bot.publish_event(sent)
+    await bot.scheduler.drain()
+    # Pending message
+    pending = transfer_event(2, 3)
+    await bot.publish_event(pending)
+    await bot.publish_event(RetractEvent(hashes=['0x1', '0x2']))
+    assert [tf.hash for tf in pending.tfs] == ['0x3'] and sent.id not in bot.ev_to_msg
+    await bot.publish_event(transfer_event(1, to='0xc'))
+    await bot.publish_event(transfer_event(2))
+    await bot.scheduler.drain()
+    calls = bot.disbot.calls
+    assert sorted(c[0] for c in calls) == ['delete', 'send', 'send', 'send']
+    assert [tf.hash for tf in pending.tfs] == ['0x3', '0x2']
+    readded = next(ev for ev, msg in bot.ev_to_msg.values() if ev.id not in (sent.id, pending.id))
+    assert [tf.hash for tf in readded.tfs] == ['0x1']
@@ -0,0 +1,82 @@
+import json
+import pytest
+import websockets
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bna import init_logging
+from bna.http_client import HttpClient
+from bna.recorder import Recorder
+from bench.playback import Playback, playback_url
+
+
+async def start_upstream() -> TestServer:
+    async def rpc(request):
+        j = await request.json()
+        return web.json_response({'id': j['id'], 'result': [j['method'], j['params']]})
+
+    async def trades(request):
+        return web.json_response({'data': [request.query['start']]}, headers={'ETag': '"t1"'})
+
+    async def ws_handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            sub = json.loads(msg.data)
+            await ws.send_str(json.dumps({'id': sub['id'], 'result': '0xsub'}))
+            await ws.send_str(json.dumps({'method': 'eth_subscription', 'params': {'subscription': '0xsub', 'result': 1}}))
+            await ws.send_bytes(b'\xff\x00compressed')
+        return ws
+
+    app = web.Application()
+    app.router.add_post('/', rpc)
+    app.router.add_get('/trades', trades)
+    app.router.add_get('/ws', ws_handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+async def exercise(http: HttpClient, rpc_url: str, trades_url: str, ws_url: str, rpc_id: int) -> list:
+    "What a listener would do, returns everything it got back"
+    got = [await http.post_json(rpc_url, data=json.dumps({'method': 'bcn_blockAt', 'params': [5], 'id': rpc_id, 'key': 'secret'})),
+           await http.get_json(trades_url)]
+    ws = await websockets.connect(ws_url)
+    if http.recorder:
+        ws = http.recorder.wrap_ws(ws, ws_url)
+    await ws.send(json.dumps({'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}))
+    got += [await ws.recv() for _ in range(3)]
+    await ws.close()
+    return got
+
+@pytest.mark.asyncio
+async def test_record_and_playback(tmp_path):
+    log = init_logging()
+    path = str(tmp_path / 'traffic.jsonl')
+    upstream = await start_upstream()
+    http = HttpClient(log)
+    http.recorder = Recorder(log, path)
+    rpc_url, trades_url, ws_url = (str(upstream.make_url('/')), str(upstream.make_url('/trades?start=1')),
+                                   str(upstream.make_url('/ws')).replace('http', 'ws'))
+    try:
+        recorded = await exercise(http, rpc_url, trades_url, ws_url, rpc_id=7)
+    finally:
+        http.recorder.close()
+        await http.close()
+        await upstream.close()
+    assert recorded[0] == {'id': 7, 'result': ['bcn_blockAt', [5]]}
+    assert isinstance(recorded[4], bytes)
+    assert 'secret' not in open(path).read()
+
+    playback = Playback(log, path, speed=0)
+    await playback.start()
+    http = HttpClient(log)
+    try:
+        base = playback.base_url()
+        played = await exercise(http, playback_url(base, rpc_url), playback_url(base, trades_url).replace('start=1', 'start=2'),
+                                playback_url(base, ws_url), rpc_id=8)
+    finally:
+        await http.close()
+        await playback.stop()
+    # The response is for the new request id, and the trades poll with another start time gets the recorded one
+    assert played[0] == {'id': 8, 'result': ['bcn_blockAt', [5]]}
+    assert played[1:] == recorded[1:]
+    assert playback.stats['unmatched'] == 0 and playback.stats['frames'] == 3
@@ -0,0 +1,49 @@
+import pytest
+import json
+import multiprocessing
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from bna.config import Config
+from bench.tracker_bench import Load, SyntheticChain, IDENA_FIRST_BLOCK, IDENA_BLOCK_TIME
+from bench.replay import replay, replay_configs, compare
+
+
+def history(blocks: int):
+    "Synthetic records from long ago, so that only the virtual clock makes them recent"
+    known = {a.lower(): i for a, i in json.load(open("known_addresses.json")).items()}
+    chain = SyntheticChain(Load(whales=1, pool_kill_bursts=0.2, pool_kill_size=10, interesting=0.5), known)
+    ts = datetime(2023, 3, 1, tzinfo=timezone.utc)
+    tfs, trs = [], []
+    for block in range(blocks):
+        ts += timedelta(seconds=IDENA_BLOCK_TIME)
+        tfs += chain.idena_block(IDENA_FIRST_BLOCK + block, ts)
+        trs += chain.trades(ts)
+    return tfs, trs
+
+
+@pytest.mark.asyncio
+async def test_replay():
+    tfs, trs = history(100)
+    conf = Config()
+    conf.tracker.stats_interval = 600
+    result = await replay(tfs, trs, conf)
+    assert result['steps'] == 200 and result['events']
+    assert result['counts']['StatsEvent'] == 100 * IDENA_BLOCK_TIME // 600
+    assert result['counts'].get('TransferEvent', 0) > 0
+    assert all(ev['time'].startswith('2023-03-01') for ev in result['events'])
+    # Replays are deterministic
+    assert compare(result, await replay(tfs, trs, conf)) == {'missing': [], 'extra': []}
+
+
+def test_replay_configs():
+    tfs, trs = history(50)
+    base = Config()
+    quiet = deepcopy(base)
+    quiet.tracker.recent_transfers_threshold = 10**12
+    base_result, quiet_result = replay_configs(tfs, trs, [base, quiet], stats=False)
+    assert quiet_result['counts'].get('TransferEvent', 0) < base_result['counts']['TransferEvent']
+    diff = compare(base_result, quiet_result)
+    assert diff['missing'] and all(t != 'CexEvent' for t, _ in diff['missing'])
+    # Spawned workers don't inherit the records
+    spawned = replay_configs(tfs, trs, [base], stats=False, mp_context=multiprocessing.get_context('spawn'))
+    assert spawned[0]['counts'] == base_result['counts'] and spawned[0]['transfers'] == len(tfs)
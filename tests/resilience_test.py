@@ -0,0 +1,76 @@
+import pytest
+from bna import init_logging
+from bna.resilience import (Backoff, CircuitBreaker, CircuitOpenError, Resilience, RetryBudget,
+                            BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_backoff():
+    b = Backoff(base=1, cap=10)
+    for attempt, expected in [(1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (20, 10)]:
+        for _ in range(20):
+            assert expected / 2 <= b.delay(attempt) <= expected
+
+def test_breaker_states():
+    clock = FakeClock()
+    br = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    br.record_failure()
+    assert br.allow() and br.state == BREAKER_CLOSED
+    br.record_failure()
+    assert br.state == BREAKER_OPEN and not br.allow()
+    clock.now += 10
+    # Only one trial request is let through
+    assert br.allow() and br.state == BREAKER_HALF_OPEN
+    assert not br.allow()
+    br.record_failure()
+    assert br.state == BREAKER_OPEN and br.retry_in() == 10
+    clock.now += 10
+    assert br.allow()
+    br.record_success()
+    assert br.state == BREAKER_CLOSED and br.failures == 0
+    assert br.stats == {'opened': 2, 'rejected': 2}
+
+def test_retry_budget():
+    clock = FakeClock()
+    budget = RetryBudget(ratio=0.5, min_retries=2, window=60, clock=clock)
+    for _ in range(10):
+        budget.record_request()
+    assert sum(budget.try_retry() for _ in range(10)) == 5
+    assert budget.exhausted == 5
+    clock.now += 61
+    assert budget.try_retry() and budget.try_retry() and not budget.try_retry()
+
+@pytest.mark.asyncio
+async def test_call():
+    res = Resilience(init_logging(), backoff=Backoff(base=0.001), failure_threshold=3)
+    calls = []
+
+    async def flaky(fail_times: int, exc=Exception):
+        calls.append(1)
+        if len(calls) <= fail_times:
+            raise exc("fail")
+        return 'ok'
+
+    assert await res.call('a', lambda: flaky(2), attempts=3) == 'ok'
+    assert res.metrics()['a']['retries'] == 2 and res.metrics()['a']['failures'] == 0
+
+    # Non-retryable errors are raised right away
+    calls.clear()
+    with pytest.raises(KeyError):
+        await res.call('a', lambda: flaky(5, KeyError), attempts=3, retry_on=lambda e: not isinstance(e, KeyError))
+    assert len(calls) == 1 and res.breaker('a').failures == 0
+
+    calls.clear()
+    with pytest.raises(Exception):
+        await res.call('b', lambda: flaky(10), attempts=10)
+    assert len(calls) == 3
+    with pytest.raises(CircuitOpenError):
+        await res.call('b', lambda: flaky(10))
+    assert len(calls) == 3
+    assert res.metrics()['b']['state'] == BREAKER_OPEN
@@ -0,0 +1,59 @@
+import random
+from decimal import Decimal
+from datetime import datetime, timezone
+
+from bna.reward_model import RewardModel, EpochData, calculate_average
+
+EPOCH = EpochData(epoch=100, validation_time=datetime(2023, 3, 1, tzinfo=timezone.utc), epoch_days=21, staking_rewards=300000.0)
+
+
+def identities(n: int = 500, seed: int = 1) -> dict[str, dict]:
+    rng = random.Random(seed)
+    states = ['Human', 'Verified', 'Newbie', 'Suspended', 'Zombie', 'Undefined']
+    idents = {}
+    for i in range(n):
+        addr = f'0x{i:040x}'
+        idents[addr] = {'address': addr, 'stake': str(Decimal(rng.randint(0, 10**6)) / 100), 'age': rng.randint(0, 60),
+                        'state': rng.choice(states), 'online': rng.random() < 0.3, 'delegatee': None}
+    return idents
+
+
+def staking_weights(idents: dict) -> tuple[float, float]:
+    "What `get_staking_weights` computed on every /rank"
+    total_weight, miner_weights = 0, []
+    for ident in idents.values():
+        if ident['state'] in ('Newbie', 'Verified', 'Human'):
+            weight = float(ident['stake']) ** 0.9
+            total_weight += weight
+            if ident['online'] or idents.get(ident.get('delegatee'), {}).get('online', False):
+                miner_weights.append(weight)
+    av1 = sum(miner_weights) / len(miner_weights)
+    miner_weights.sort()
+    return total_weight, (av1 + calculate_average(miner_weights, 101)) / 2
+
+
+def test_reward_model():
+    idents = identities()
+    model = RewardModel(idents, EPOCH, online_miners=150)
+    total_weight, average = staking_weights(idents)
+    assert abs(model.total_weight - total_weight) < 1e-6 * total_weight
+    assert abs(model.average_miner_weight - average) < 1e-6 * average
+
+    rewards, apy = model.rewards(10000.0)
+    assert rewards > 0 and abs(apy - rewards * 100 / 10000 * 366 / 21) < 1e-9
+    assert model.rewards(0) == (0.0, 0.0)
+
+
+def test_batch_rank():
+    idents = identities()
+    model = RewardModel(idents, EPOCH, online_miners=150)
+    # One identity got more stake after the model was built
+    fresher = dict(idents['0x' + '0' * 40], stake='5000.5')
+    ranks = model.rank([fresher] + list(idents.values())[1:20])
+    # The others are ranked against the identities the model was built from
+    for rank, current in zip(ranks, [{**idents, fresher['address']: fresher}] + [idents] * 19):
+        ident = current[rank.addr]
+        assert rank.stake_rank == sum(1 for i in current.values() if Decimal(i['stake']) >= Decimal(ident['stake']))
+        assert rank.age_rank == sum(1 for i in current.values() if i['age'] >= ident['age'])
+        assert (rank.rewards, rank.apy) == model.rewards(float(ident['stake']))
+    assert ranks[0].network_size == sum(1 for i in idents.values() if i['state'] not in ('Undefined',))
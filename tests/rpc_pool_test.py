@@ -0,0 +1,80 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from bna import init_logging
+from bna.http_client import HttpClient
+from bna.resilience import Backoff, Resilience
+from bna.rpc_pool import RpcPool, parse_urls
+
+
+async def start_node(name: str, healthy: bool = True) -> TestServer:
+    state = {'healthy': healthy, 'calls': 0}
+
+    async def rpc(request):
+        state['calls'] += 1
+        if not state['healthy']:
+            return web.Response(status=502)
+        j = await request.json()
+        return web.json_response({'id': j['id'], 'result': name})
+
+    app = web.Application()
+    app.router.add_post('/', rpc)
+    server = TestServer(app)
+    server.state = state
+    await server.start_server()
+    return server
+
+def result(j: dict):
+    return j['result']
+
+def test_parse_urls():
+    assert parse_urls(None) == []
+    assert parse_urls("http://a") == ["http://a"]
+    assert parse_urls("http://a, http://b,") == ["http://a", "http://b"]
+
+@pytest.mark.asyncio
+async def test_failover():
+    nodes = [await start_node('a', healthy=False), await start_node('b')]
+    log = init_logging()
+    http = HttpClient(log, resilience=Resilience(log, failure_threshold=2, reset_timeout=60))
+    pool = RpcPool('bsc', [str(n.make_url('/')) for n in nodes], http, log, backoff=Backoff(base=0.01))
+    try:
+        for _ in range(10):
+            assert await pool.request({'method': 'eth_blockNumber', 'id': 0}, check=result) == 'b'
+        # The broken endpoint is picked less and less, and stops getting calls once its breaker opens
+        assert nodes[0].state['calls'] <= 2
+        m = pool.metrics()
+        assert m['bsc:0']['errors'] == nodes[0].state['calls'] and m['bsc:1']['errors'] == 0
+        assert m['bsc:1']['score'] >= m['bsc:0']['score']
+
+        # Every endpoint failing raises the last error after backing off
+        nodes[1].state['healthy'] = False
+        with pytest.raises(Exception):
+            await pool.request({'method': 'eth_blockNumber', 'id': 0}, check=result, attempts=3)
+    finally:
+        await http.close()
+        for n in nodes:
+            await n.close()
+
+@pytest.mark.asyncio
+async def test_sticky():
+    nodes = [await start_node('a'), await start_node('b'), await start_node('c')]
+    log = init_logging()
+    http = HttpClient(log)
+    pool = RpcPool('bsc', [str(n.make_url('/')) for n in nodes], http, log, backoff=Backoff(base=0.01))
+    try:
+        first = await pool.request({'method': 'eth_getLogs', 'id': 0}, check=result, sticky='gap')
+        for _ in range(10):
+            assert await pool.request({'method': 'eth_getLogs', 'id': 0}, check=result, sticky='gap') == first
+
+        # A failing sticky endpoint is replaced and the key moves to the new one
+        nodes['abc'.index(first)].state['healthy'] = False
+        second = await pool.request({'method': 'eth_getLogs', 'id': 0}, check=result, sticky='gap')
+        assert second != first
+        assert pool.sticky['gap'].name == f"bsc:{'abc'.index(second)}"
+        pool.release('gap')
+        assert 'gap' not in pool.sticky
+    finally:
+        await http.close()
+        for n in nodes:
+            await n.close()
@@ -0,0 +1,102 @@
+import time
+import pickle
+import asyncio
+import threading
+import pytest
+from decimal import Decimal
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from bna import init_logging
+from bna.pool_index import PoolIndex
+from bna.snapshot import Snapshot
+from bna.transfer import Transfer, CHAIN_IDENA, CHAIN_BSC
+from bna.write_behind import WriteBehind
+
+NOW = datetime.now(tz=timezone.utc)
+
+
+def tf(block: int, chain: str = CHAIN_IDENA, age: int = 60) -> Transfer:
+    return Transfer(changes={'0x1': Decimal(-1), '0x2': Decimal(1)}, hash=f"0x{block}", blockNumber=block, logIndex=0,
+                    timeStamp=NOW - timedelta(seconds=age), chain=chain)
+
+class FakeStore:
+    def __init__(self, identities, transfers):
+        self.identities = identities
+        self.transfers = {(t.blockNumber, t.logIndex): t for t in transfers}
+
+    async def get_identities(self):
+        return self.identities
+
+    async def get_transfers(self, after):
+        return {k: t for k, t in self.transfers.items() if t.timeStamp > after}
+
+    async def get_trades(self, after):
+        return {}
+
+def fake_db(store=None):
+    log = init_logging()
+    db = SimpleNamespace(cache={'transfers': {}, 'trades': {}, 'identities': {}}, store=store, pools=PoolIndex(),
+                         oldest_cached_tf=datetime.max.replace(tzinfo=timezone.utc),
+                         oldest_cached_tr=datetime.max.replace(tzinfo=timezone.utc))
+    db.writes = WriteBehind(log, None, tables=('transfers', 'trades'))
+    return db
+
+@pytest.mark.asyncio
+async def test_snapshot(tmp_path):
+    path = str(tmp_path / 'state' / 'snapshot.pickle')
+    db = fake_db()
+    db.cache['identities'] = {'0xa': {'address': '0xa', 'stake': '100', '_fetchTime': 10}}
+    for t in [tf(100), tf(101), tf(5000, CHAIN_BSC)]:
+        db.cache['transfers'][(t.blockNumber, t.logIndex)] = t
+    db.oldest_cached_tf = NOW - timedelta(hours=1)
+    Snapshot(db, init_logging(), path).save()
+
+    # The previous run crashed after writing block 102 to the store, and before writing block 101
+    store = FakeStore({'0xa': {'address': '0xa', 'stake': '200', '_fetchTime': 20},
+                       '0xb': {'address': '0xb', '_fetchTime': 1}}, [tf(100), tf(102, age=10)])
+    db = fake_db(store)
+    snap = Snapshot(db, init_logging(), path)
+    assert snap.load()
+    assert len(db.cache['transfers']) == 3 and db.cache['identities']['0xa']['stake'] == '100'
+    assert snap.cursors == {CHAIN_IDENA: 101, CHAIN_BSC: 5000}
+    # Not saved on shutdown, so the cache isn't trusted until it's reconciled
+    assert db.oldest_cached_tf.year == 9999
+
+    await snap.reconcile()
+    assert db.cache['identities']['0xa']['stake'] == '200' and '0xb' in db.cache['identities']
+    assert sorted(k[0] for k in db.cache['transfers']) == [100, 101, 102, 5000]
+    assert sorted(k[0] for k in db.writes.pending['transfers']) == [101, 5000]
+    assert db.oldest_cached_tf == tf(5000).timeStamp
+
+@pytest.mark.asyncio
+async def test_snapshot_rejected(tmp_path):
+    path = str(tmp_path / 'snapshot.pickle')
+    db = fake_db()
+    assert not Snapshot(db, init_logging(), path).load()
+    Snapshot(db, init_logging(), path).save(clean=True)
+    assert Snapshot(db, init_logging(), path).load()
+    assert not Snapshot(db, init_logging(), path, max_age=0).load()
+    open(path, 'wb').write(b'garbage')
+    assert not Snapshot(db, init_logging(), path).load()
+
+@pytest.mark.asyncio
+async def test_snapshot_saved_in_thread(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshot.pickle')
+    db = fake_db()
+    db.cache['identities'] = {'0xa': {'address': '0xa'}}
+    snap = Snapshot(db, init_logging(), path, interval=0)
+    written = []
+    write = snap.write
+    def write_in_thread(data):
+        written.append(threading.current_thread() is not threading.main_thread())
+        # The loop keeps changing the cache while the copy is pickled
+        db.cache['identities']['0xb'] = {'address': '0xb'}
+        write(data)
+    monkeypatch.setattr(snap, 'write', write_in_thread)
+    await snap.save_async()
+    assert written == [True] and '0xb' not in pickle.load(open(path, 'rb'))['identities']
+    snap.start()
+    await asyncio.sleep(0.05)
+    await snap.close()
+    # Periodic snapshots are written in a thread, the one on shutdown isn't
+    assert len(written) > 2 and all(written[:-1]) and not written[-1] and snap.task is None
@@ -0,0 +1,47 @@
+import json
+import pytest
+import asyncio
+from datetime import datetime, timezone
+from bna import init_logging
+from bna.config import Config
+from bna.event_bus import EventChannel
+from bna.tracker import Tracker
+from bench.tracker_bench import BenchDatabase, Load, SyntheticChain, run, regressions, STAGES, IDENA_FIRST_BLOCK, BSC_FIRST_BLOCK
+
+
+@pytest.mark.asyncio
+async def test_tracker_bench():
+    "Small run to make sure the benchmark still drives every check"
+    load = Load(whales=1, dex_swaps=10, pool_kill_bursts=0.5, pool_kill_size=10, interesting=0.5, stats_every=5)
+    result = await run(20, load, trace_memory=True)
+    assert result['transfers'] > 20 * load.sends and result['events'] > 0
+    for stage in STAGES:
+        assert result['stages'][stage]['calls'] > 0
+    assert result['state']['cached_transfers'] == result['transfers']
+
+    assert regressions(result, result, 0.2) == []
+    slower = {'stages': {s: {**v, 'p90': v['p90'] * 2} for s, v in result['stages'].items()}}
+    assert len(regressions(slower, result, 0.2)) == len([s for s in STAGES if result['stages'][s]['p90']])
+
+@pytest.mark.asyncio
+async def test_full_channel_backpressure():
+    "A full event channel makes the checks wait instead of losing events"
+    log, conf = init_logging(), Config()
+    known = {a.lower(): i for a, i in json.load(open("known_addresses.json")).items()}
+    db = BenchDatabase(log, conf, known)
+    chan = EventChannel('tracker', capacity=1)
+    tracker = Tracker(db, conf.tracker, None, None, None, chan, log)
+    chain = SyntheticChain(Load(whales=2, dex_swaps=10, interesting=2), known)
+    ts = datetime.now(tz=timezone.utc)
+    await db.insert_transfers(chain.idena_block(IDENA_FIRST_BLOCK, ts) + chain.bsc_block(BSC_FIRST_BLOCK, ts))
+
+    check = asyncio.create_task(tracker.check_events())
+    got = []
+    while True:
+        try:
+            got.append(await chan.get(timeout=0.1))
+        except asyncio.TimeoutError:
+            if check.done():
+                break
+    await check
+    assert len(got) > 1 and chan.stats['blocked'] > 0
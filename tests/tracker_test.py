@@ -228,7 +228,7 @@ async def test_transfer_events():
     now = int(time.time())
     bot = Bot(None, Config().discord, db, 0, log)
     bot.stopped = True
-    tracker = Tracker(db, None, None, None, None, None, events, log)
+    tracker = Tracker(db, None, None, None, None, events, log)
     for t, table in enumerate([transfer_cases, majority_transfer_cases,
                                kill_cases, interesting_cases]):
         table_config, cases = table['config'], table['cases']
@@ -283,6 +283,7 @@ async def run_transfer_case(t: Tracker, tf_evs: list[(Transfer, dict)], bot: Bot
         got_ev = compare_transfer_event(chan, ev)
         if got_ev:
             await bot._publish_event(got_ev) # to test that it doesn't crash
+            await bot.scheduler.drain()
 
     print("Going backwards")
     # removing transfers
@@ -324,7 +325,7 @@ def compare_transfer_event(chan: AsyncQueue, expected_event: dict | None) -> dic
 async def test_cex_trade_events():
     log, events, db = await get_test_env()
 
-    tracker = Tracker(db, None, None, None, None, None, events, log)
+    tracker = Tracker(db, None, None, None, None, events, log)
     bot = Bot(None, Config().discord, db, 0, log)
     bot.stopped = True
     i = 0
@@ -370,6 +371,7 @@ async def run_cex_trade_case(t: Tracker, tr_evs: list[(Trade, dict)], bot: Bot):
         ev = compare_trade_event(chan, ev)
         if ev:
             await bot._publish_event(ev) # to test that it doesn't crash
+            await bot.scheduler.drain()
 
     print("Going backwards")
     # removing trades
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from bna import init_logging
+from bna.write_behind import WriteBehind
+
+
+class FakeStore:
+    def __init__(self):
+        self.batches = []
+        self.fail = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def insert_batch(self, transfers, trades):
+        await self.release.wait()
+        if self.fail:
+            self.fail -= 1
+            raise Exception("Store is down")
+        self.batches.append((transfers, trades))
+
+@pytest.mark.asyncio
+async def test_write_behind():
+    store = FakeStore()
+    writes = WriteBehind(init_logging(), store.insert_batch, tables=('transfers', 'trades'), flush_interval=0.01, max_batch=3)
+    writes.start()
+    try:
+        # Writers don't wait for the store, and records of both tables go in one batch
+        store.release.clear()
+        await writes.put('transfers', {(1, 0): 'tf1', (1, 1): 'tf2'})
+        await writes.put('trades', {(5, 'm'): 'tr1'})
+        await asyncio.sleep(0.05)
+        assert store.batches == [] and len(writes) == 3
+        # Changed while the batch was being written, so it's written again
+        await writes.put('transfers', {(1, 0): 'tf1b'})
+        store.release.set()
+        await asyncio.sleep(0.05)
+        assert store.batches == [(['tf1', 'tf2'], ['tr1']), (['tf1b'], [])]
+        assert len(writes) == 0 and writes.stats['coalesced'] == 1
+
+        # Failed batches stay queued and are retried
+        store.batches.clear()
+        store.fail = 1
+        await writes.put('trades', {(6, 'm'): 'tr2'})
+        await asyncio.sleep(0.1)
+        assert store.batches == [([], ['tr2'])] and writes.stats['failures'] == 1
+    finally:
+        await writes.close()
+
+@pytest.mark.asyncio
+async def test_write_behind_bounded():
+    store = FakeStore()
+    writes = WriteBehind(init_logging(), store.insert_batch, tables=('transfers', 'trades'),
+                         flush_interval=60, max_batch=2, max_pending=4)
+    writes.start()
+    await writes.put('transfers', {i: i for i in range(4)})
+    # Full, so the writer waits until the flusher makes room
+    await asyncio.wait_for(writes.put('transfers', {4: 4}), 1)
+    assert writes.stats['waits'] == 1 and len(writes) <= 4
+    # Everything is written on close
+    await writes.put('trades', {'a': 'a'})
+    await writes.close()
+    assert len(writes) == 0
+    assert sorted(tf for tfs, _ in store.batches for tf in tfs) == [0, 1, 2, 3, 4]
+    assert [tr for _, trs in store.batches for tr in trs] == ['a']